@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""Prints the bytes the object model takes per cons cell, number and binding.
+
+Sizes are what sys.getsizeof reports for the objects themselves and their
+instance dicts, under the Python running this script, which needs pypy on
+the PYTHONPATH like the tests. Values bound and symbols are shared, so they
+are not counted.
+
+    python benchmarks/memory.py
+"""
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from qoppy.runtime import get_runtime
+from qoppy.execution_model import (W_Integer, W_Real, W_List, ListBuilder,
+                                   symbol, w_nil, w_true)
+from qoppy.primitives import cons
+
+COUNT = 1000
+
+
+def object_size(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, "__dict__"):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def cells_size(w_obj, seen):
+    # the size of the pairs reachable from w_obj through car and cdr
+    size = 0
+    todo = [w_obj]
+    while todo:
+        w_obj = todo.pop()
+        if not isinstance(w_obj, W_List) or w_obj.is_nil() or id(w_obj) in seen:
+            continue
+        seen.add(id(w_obj))
+        size += object_size(w_obj)
+        index = getattr(w_obj, "index", None)
+        if index is not None:
+            size += object_size(index) + sys.getsizeof(index.bindings)
+        elif isinstance(getattr(w_obj, "bindings", None), dict):
+            size += sys.getsizeof(w_obj.bindings)
+        todo.append(w_obj.car)
+        todo.append(w_obj.cdr)
+    return size
+
+
+def cons_cell():
+    builder = ListBuilder()
+    for i in range(COUNT):
+        builder.append(w_true)
+    return float(cells_size(builder.finish(), set())) / COUNT
+
+
+def local_binding():
+    # the frame a call of a fexpr with COUNT parameters binds
+    runtime = get_runtime()
+    values = ListBuilder()
+    for i in range(COUNT):
+        values.append(w_true)
+    params = ListBuilder()
+    for i in range(COUNT):
+        params.append(symbol("p%d" % i))
+    w_frame = runtime.bind(params.finish(), values.finish())
+    return float(cells_size(w_frame, set())) / COUNT
+
+
+def global_binding():
+    # COUNT defines into the global frame, made by cons like the define of
+    # prelude.qop does, looking each one up as a program would
+    runtime = get_runtime()
+    seen = set()
+    before = cells_size(runtime.global_env, seen)
+    for i in range(COUNT):
+        w_name = symbol("g%d" % i)
+        w_frame = cons(cons(w_name, cons(w_true, w_nil)), runtime.global_env.car)
+        runtime.global_env.set_car(w_frame)
+        runtime.global_value(w_name)
+    after = cells_size(runtime.global_env, set())
+    return float(after - before) / COUNT
+
+
+def main():
+    print("cons cell       %6.1f bytes" % cons_cell())
+    print("integer         %6.1f bytes" % object_size(W_Integer(1 << 40)))
+    print("real            %6.1f bytes" % object_size(W_Real(0.5)))
+    print("local binding   %6.1f bytes" % local_binding())
+    print("global binding  %6.1f bytes" % global_binding())
+
+
+if __name__ == "__main__":
+    main()
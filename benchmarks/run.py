@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""Runs the benchmarks in this directory and compares them to a baseline.
+
+Every benchmark is run as a separate process of the interpreter, either
+targetqoppystandalone.py under the Python running this script (which needs
+pypy on the PYTHONPATH, like the tests) or a binary built by retranslate.sh,
+given with --binary. The prelude is evaluated once into a heap image that
+every benchmark starts from.
+
+For each benchmark the result records the best wall time of --repeat runs,
+the number of steps of the interpreter loop and the peak resident memory.
+With --baseline, a benchmark whose time grew by more than --threshold
+against the baseline fails the run.
+
+    python benchmarks/run.py --output base.json
+    python benchmarks/run.py --binary ./qoppy-c --baseline base.json fib cond
+"""
+from __future__ import print_function
+
+import json
+import optparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARK_DIR)
+
+STEPS = re.compile(r"^interpreter steps: (\d+)$", re.M)
+
+
+def benchmark_names():
+    return sorted(name[:-len(".qop")] for name in os.listdir(BENCHMARK_DIR)
+                  if name.endswith(".qop"))
+
+
+def interpreter_command(binary):
+    if binary is not None:
+        return [os.path.abspath(binary)]
+    return [sys.executable, os.path.join(ROOT, "targetqoppystandalone.py")]
+
+
+def run_once(command):
+    # the files take the output, so wait4 can reap the child and give its
+    # rusage, which the pipes of communicate would not
+    with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+        start = time.time()
+        process = subprocess.Popen(command, cwd=ROOT, stdout=out, stderr=err)
+        _, status, rusage = os.wait4(process.pid, 0)
+        elapsed = time.time() - start
+        process.returncode = status
+        out.seek(0)
+        err.seek(0)
+        output = out.read().decode("latin-1")
+        errors = err.read().decode("latin-1")
+    # the interpreter reports its errors on stdout and still exits 0 from
+    # some of them, so check both
+    if status != 0 or "error" in output.lower():
+        raise RuntimeError("%s failed:\n%s%s" % (" ".join(command), output, errors))
+    match = STEPS.search(errors)
+    steps = int(match.group(1)) if match else None
+    # ru_maxrss is in kilobytes on Linux
+    return elapsed, steps, rusage.ru_maxrss
+
+
+def run_benchmark(command, image, cache_dir, name, repeat):
+    path = os.path.join(BENCHMARK_DIR, name + ".qop")
+    command = command + ["--cache-stats", "--parse-cache-dir", cache_dir,
+                         "--image", image, path]
+    times = []
+    max_rss = 0
+    steps = None
+    for i in range(repeat):
+        elapsed, steps, rss = run_once(command)
+        times.append(elapsed)
+        max_rss = max(max_rss, rss)
+    return {"time": min(times), "steps": steps, "max_rss_kb": max_rss}
+
+
+def compare(results, baseline, threshold):
+    # the names of the benchmarks slower than threshold times the baseline
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old = baseline[name]["time"]
+        new = results[name]["time"]
+        ratio = new / old if old else 1.0
+        flag = ""
+        if ratio > threshold:
+            regressions.append(name)
+            flag = "  SLOWER"
+        print("%-10s %8.3fs -> %8.3fs  %5.2fx%s" % (name, old, new, ratio, flag))
+    return regressions
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options] [benchmark ...]")
+    parser.add_option("--binary", default=None,
+                      help="translated interpreter to run, like ./qoppy-c")
+    parser.add_option("--repeat", type="int", default=3,
+                      help="runs of each benchmark, the fastest one counts")
+    parser.add_option("--output", default=None,
+                      help="write the results to this JSON file")
+    parser.add_option("--baseline", default=None,
+                      help="JSON results of an earlier run to compare against")
+    parser.add_option("--threshold", type="float", default=1.10,
+                      help="slowdown against the baseline that fails the run")
+    options, names = parser.parse_args(argv[1:])
+    available = benchmark_names()
+    for name in names:
+        if name not in available:
+            parser.error("unknown benchmark %s, there are %s" % (name, ", ".join(available)))
+    if not names:
+        names = available
+
+    command = interpreter_command(options.binary)
+    work_dir = tempfile.mkdtemp(prefix="qoppy-bench-")
+    try:
+        image = os.path.join(work_dir, "prelude.img")
+        run_once(command + ["--parse-cache-dir", work_dir,
+                            "--save-image", image, os.path.join(ROOT, "prelude.qop")])
+        results = {}
+        for name in names:
+            result = run_benchmark(command, image, work_dir, name, options.repeat)
+            results[name] = result
+            print("%-10s %8.3fs %10s steps %8d KB" % (
+                name, result["time"], result["steps"], result["max_rss_kb"]))
+    finally:
+        shutil.rmtree(work_dir)
+
+    report = {"interpreter": " ".join(command), "benchmarks": results}
+    if options.output is not None:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write("\n")
+    if options.baseline is not None:
+        with open(options.baseline) as f:
+            baseline = json.load(f)["benchmarks"]
+        regressions = compare(results, baseline, options.threshold)
+        if regressions:
+            print("slower than %.2fx the baseline: %s" % (
+                options.threshold, ", ".join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,298 @@
+from pypy.rlib import jit
+
+from execution_model import (W_Object, W_List, W_Symbol, W_Fexpr,
+                             W_BasePrimitive,
+                             QuoppaException, frame_version, code_version,
+                             symbol)
+
+
+# A second execution engine that lowers a fexpr body to a flat array of
+# opcodes and runs it in one dispatch loop per call, instead of pushing an
+# instruction per s-expression node.
+#
+# Every fexpr may get its operands unevaluated, so whether the operands of a
+# call are evaluated is decided when it runs: CALL looks at the callee and
+# either hands an operative the operand list or falls through into the code
+# evaluating the operands, which ends in APPLY.
+#
+# A frame that calls out pushes itself back on the operand stack as the
+# continuation and returns to Runtime.interpret, the result of the call is
+# then on top of the value stack when it resumes.
+
+LOAD_CONST = 0    # const index
+LOAD_LOCAL = 1    # slot, const index of the name
+LOAD_GLOBAL = 2   # const index of the name
+CALL = 3          # const index of the operands, target when operative
+APPLY = 4         # operand count
+RETURN = 5
+
+opcode_names = ["LOAD_CONST", "LOAD_LOCAL", "LOAD_GLOBAL", "CALL", "APPLY",
+                "RETURN"]
+
+w_underscore = symbol("_")
+
+
+class CannotCompile(Exception):
+    pass
+
+
+class W_Code(W_Object):
+    __slots__ = ["code", "consts_w", "env_param", "params", "cells_w",
+                 "cars_w", "cdrs_w", "version", "valid"]
+    _immutable_fields_ = ["code[*]", "consts_w[*]", "env_param", "params"]
+
+    def __init__(self, code, consts_w, env_param, params, cells_w):
+        self.code = code
+        self.consts_w = consts_w
+        self.env_param = env_param
+        self.params = params
+        # the body's cells with what they held when compiled
+        self.cells_w = cells_w
+        self.cars_w = [w_cell.car for w_cell in cells_w]
+        self.cdrs_w = [w_cell.cdr for w_cell in cells_w]
+        self.version = code_version.counter
+        self.valid = True
+
+    def is_valid(self):
+        if self.version != code_version.counter:
+            # some compiled body was written, check whether it was this one
+            for i in range(len(self.cells_w)):
+                w_cell = self.cells_w[i]
+                if w_cell.car is not self.cars_w[i] or w_cell.cdr is not self.cdrs_w[i]:
+                    self.valid = False
+            self.version = code_version.counter
+        return self.valid
+
+    def to_repr(self):
+        return "#<code>"
+
+    def disassemble(self):
+        lines = []
+        pc = 0
+        while pc < len(self.code):
+            op = self.code[pc]
+            if op == LOAD_CONST or op == LOAD_GLOBAL:
+                arg = self.consts_w[self.code[pc + 1]].to_repr()
+                size = 2
+            elif op == LOAD_LOCAL:
+                arg = "%d %s" % (self.code[pc + 1],
+                                 self.consts_w[self.code[pc + 2]].to_repr())
+                size = 3
+            elif op == CALL:
+                arg = "%s -> %d" % (self.consts_w[self.code[pc + 1]].to_repr(),
+                                    self.code[pc + 2])
+                size = 3
+            elif op == APPLY:
+                arg = str(self.code[pc + 1])
+                size = 2
+            else:
+                arg = ""
+                size = 1
+            lines.append("%d %s %s" % (pc, opcode_names[op], arg))
+            pc += size
+        return "\n".join(lines)
+
+
+class Compiler(object):
+    def __init__(self, env_param, params):
+        self.code = []
+        self.consts_w = []
+        self.cells_w = []
+        self.slots = {}
+        self.slot_count = 0
+        # the pairs Runtime.bind makes for (env_param . params), in order
+        self.add_slots(W_List(env_param, params))
+
+    def add_slots(self, param):
+        while isinstance(param, W_List) and not param.is_nil():
+            self.add_slots(param.car)
+            param = param.cdr
+        if isinstance(param, W_Symbol) and param is not w_underscore:
+            if param not in self.slots:
+                self.slots[param] = self.slot_count
+            self.slot_count += 1
+
+    def const(self, w_obj):
+        for i in range(len(self.consts_w)):
+            if self.consts_w[i] is w_obj:
+                return i
+        self.consts_w.append(w_obj)
+        return len(self.consts_w) - 1
+
+    def emit(self, op, arg=-1, arg2=-1):
+        self.code.append(op)
+        if arg != -1:
+            self.code.append(arg)
+        if arg2 != -1:
+            self.code.append(arg2)
+
+    def compile_expr(self, w_exp):
+        if isinstance(w_exp, W_Symbol):
+            slot = self.slots.get(w_exp, -1)
+            if slot == -1:
+                self.emit(LOAD_GLOBAL, self.const(w_exp))
+            else:
+                self.emit(LOAD_LOCAL, slot, self.const(w_exp))
+        elif isinstance(w_exp, W_List) and not w_exp.is_nil():
+            self.cells_w.append(w_exp)
+            self.compile_expr(w_exp.car)
+            w_operands = w_exp.cdr
+            self.emit(CALL, self.const(w_operands), 0)
+            target_index = len(self.code) - 1
+            argcount = 0
+            while not w_operands.is_nil():
+                if not isinstance(w_operands, W_List):
+                    raise CannotCompile
+                self.cells_w.append(w_operands)
+                self.compile_expr(w_operands.car)
+                w_operands = w_operands.cdr
+                argcount += 1
+            self.emit(APPLY, argcount)
+            self.code[target_index] = len(self.code)
+        else:
+            self.emit(LOAD_CONST, self.const(w_exp))
+
+    def finish(self, env_param, params):
+        self.emit(RETURN)
+        return W_Code(self.code, self.consts_w, env_param, params, self.cells_w)
+
+
+def compile_body(w_fexpr):
+    compiler = Compiler(w_fexpr.env_param, w_fexpr.params)
+    compiler.compile_expr(w_fexpr.body)
+    for w_cell in compiler.cells_w:
+        code_version.add(w_cell)
+    return compiler.finish(w_fexpr.env_param, w_fexpr.params)
+
+
+w_uncompilable = W_Code([RETURN], [], None, None, [])
+w_uncompilable.valid = False
+
+
+class W_CodeFrame(W_Object):
+    # one run of a compiled body, the locals are read straight from the
+    # pairs bind made as long as no frame was changed structurally since
+    __slots__ = ["w_code", "env", "w_pairs", "version", "pc"]
+
+    def __init__(self, w_code, env, w_pairs):
+        self.w_code = w_code
+        self.env = env
+        self.w_pairs = w_pairs
+        self.version = frame_version.counter
+        self.pc = 0
+
+    def to_repr(self):
+        return "#<frame %d>" % self.pc
+
+    def lookup_local(self, runtime, slot, w_name):
+        if self.version == frame_version.counter:
+            w_pairs = self.w_pairs
+            for i in range(slot):
+                assert isinstance(w_pairs, W_List)
+                w_pairs = w_pairs.cdr
+            assert isinstance(w_pairs, W_List)
+            return w_pairs.car
+        return runtime.lookup(w_name, self.env)
+
+    def lookup_global(self, runtime, w_name):
+        if self.version == frame_version.counter:
+            # not a parameter, so not in the local frame
+            return runtime.lookup(w_name, self.env.cdr)
+        return runtime.lookup(w_name, self.env)
+
+    def call(self, runtime, machine, w_instruction, pc):
+        # returns whether the call is done, otherwise this frame resumes
+        # at pc once it is
+        if self.w_code.code[pc] == RETURN:
+            # a tail call, nothing is left to resume
+            w_instruction.compile(runtime, machine)
+            return False
+        self.pc = pc
+        machine.operand_stack.push(self)
+        depth = machine.operand_stack.depth
+        w_instruction.compile(runtime, machine)
+        if machine.operand_stack.depth == depth:
+            machine.operand_stack.pop()
+            return True
+        return False
+
+    def compile(self, runtime, machine):
+        code = self.w_code.code
+        consts_w = self.w_code.consts_w
+        stack = machine.stack
+        pc = self.pc
+        while True:
+            op = code[pc]
+            if op == LOAD_CONST:
+                stack.push(consts_w[code[pc + 1]])
+                pc += 2
+            elif op == LOAD_LOCAL:
+                w_pair = self.lookup_local(runtime, code[pc + 1], consts_w[code[pc + 2]])
+                stack.push(binding_value(w_pair))
+                pc += 3
+            elif op == LOAD_GLOBAL:
+                w_pair = self.lookup_global(runtime, consts_w[code[pc + 1]])
+                stack.push(binding_value(w_pair))
+                pc += 2
+            elif op == CALL:
+                w_fexpr = stack.top()
+                if not isinstance(w_fexpr, W_Fexpr):
+                    raise QuoppaException("cannot call %s" % w_fexpr.to_string())
+                if w_fexpr.takes_values():
+                    pc += 3
+                else:
+                    stack.pop()
+                    stack.push(consts_w[code[pc + 1]])
+                    pc = code[pc + 2]
+                    if not self.call(runtime, machine, w_fexpr, pc):
+                        return
+            elif op == APPLY:
+                argcount = code[pc + 1]
+                w_fexpr = stack.pop_below(argcount)
+                assert isinstance(w_fexpr, W_BasePrimitive)
+                pc += 2
+                if not self.call(runtime, machine, w_fexpr.call_instruction_for(argcount), pc):
+                    return
+            else:
+                assert op == RETURN
+                return
+
+
+def binding_value(w_pair):
+    cdr = w_pair.cdr
+    assert isinstance(cdr, W_List) and not cdr.is_nil()
+    return cdr.car
+
+
+class AstEngine(object):
+    # runs fexpr bodies as s-expressions
+    def body_instruction(self, w_fexpr, local_env, w_pairs):
+        return w_fexpr.body_instruction
+
+
+class BytecodeEngine(AstEngine):
+    def __init__(self):
+        self.code_cache = {}
+
+    def body_instruction(self, w_fexpr, local_env, w_pairs):
+        w_code = w_fexpr.code
+        if w_code is None:
+            w_code = self.code_for(w_fexpr)
+            w_fexpr.code = w_code
+        if not w_code.is_valid():
+            return w_fexpr.body_instruction
+        return W_CodeFrame(w_code, local_env, w_pairs)
+
+    def code_for(self, w_fexpr):
+        # closures made from the same source share the body's code
+        w_code = self.code_cache.get(w_fexpr.body, None)
+        if (w_code is not None and w_code.is_valid() and
+                w_code.env_param is w_fexpr.env_param and
+                w_code.params.equal(w_fexpr.params)):
+            return w_code
+        try:
+            w_code = compile_body(w_fexpr)
+        except CannotCompile:
+            return w_uncompilable
+        self.code_cache[w_fexpr.body] = w_code
+        return w_code
@@ -1,5 +1,9 @@
 from pypy.rlib import jit
-from pypy.rlib.objectmodel import specialize
+from pypy.rlib.objectmodel import (specialize, r_dict, compute_hash,
+                                   compute_identity_hash)
+from pypy.rlib.rarithmetic import intmask
+from pypy.rlib.rbigint import rbigint
+from pypy.rlib.rfloat import INFINITY
 
 class QuoppaException(Exception):
     def __init__(self, msg=None):
@@ -28,14 +32,24 @@ class W_Object(object):
     eqv = eq
     equal = eqv
 
-    def compile(self, runtime, env_stack, stack, operand_stack):
-        return env_stack, W_List(self, stack), operand_stack
+    # hashes that agree with eqv and equal, objects they find the same hash
+    # the same
+    def hash_eqv(self):
+        return compute_identity_hash(self)
+
+    def hash_equal(self):
+        return self.hash_eqv()
+
+    def compile(self, runtime, machine):
+        machine.stack.push(self)
 
     def is_nil(self):
         return False
 
 
 class W_Undefined(W_Object):
+    __slots__ = []
+
     def to_repr(self):
         return "#<undefined>"
 
@@ -45,6 +59,8 @@ w_undefined = W_Undefined()
 
 
 class W_True(W_Object):
+    __slots__ = []
+
     def to_repr(self):
         return "#t"
     to_string = to_repr
@@ -53,6 +69,8 @@ w_true = W_True()
 
 
 class W_False(W_Object):
+    __slots__ = []
+
     def to_repr(self):
         return "#f"
     to_string = to_repr
@@ -64,6 +82,8 @@ w_false = W_False()
 
 
 class W_String(W_Object):
+    __slots__ = ["strval"]
+
     def __init__(self, val):
         self.strval = val
 
@@ -72,7 +92,7 @@ class W_String(W_Object):
 
     def to_repr(self):
         str_lst = ["\""]
-        for ch in self.strval:
+        for ch in self.to_string():
             if ch in ["\"", "\\"]:
                 str_lst.append("\\" + ch)
             else:
@@ -82,30 +102,110 @@ class W_String(W_Object):
         return ''.join(str_lst)
 
     def __repr__(self):
-        return "<W_String \"" + self.strval + "\">"
+        return "<W_String \"" + self.to_string() + "\">"
+
+    def length(self):
+        return len(self.strval)
+
+    def char_at(self, i):
+        return self.strval[i]
+
+    def find(self, ch, start):
+        # the index of ch from start on, -1 if it is not there
+        return self.strval.find(ch, start, len(self.strval))
+
+    def substring(self, start, end):
+        return W_Substring(self.strval, start, end)
 
     def equal(self, w_obj):
-        if not isinstance(w_obj, W_String):
+        if not isinstance(w_obj, W_String) or self.length() != w_obj.length():
             return False
-        return self.strval == w_obj.strval
+        return self.to_string() == w_obj.to_string()
+
+    def hash_equal(self):
+        return compute_hash(self.to_string())
+
+
+class W_Substring(W_String):
+    # the characters from start to end of a string, sharing its storage, so
+    # taking one apart doesn't copy it. Substrings of a substring share the
+    # storage too
+    __slots__ = ["start", "end"]
+
+    def __init__(self, val, start, end):
+        self.strval = val
+        self.start = start
+        self.end = end
+
+    def to_string(self):
+        start = self.start
+        end = self.end
+        assert start >= 0 and end >= 0
+        return self.strval[start:end]
+
+    def length(self):
+        return self.end - self.start
+
+    def char_at(self, i):
+        return self.strval[self.start + i]
+
+    def find(self, ch, start):
+        index = self.strval.find(ch, self.start + start, self.end)
+        if index == -1:
+            return -1
+        return index - self.start
+
+    def substring(self, start, end):
+        return W_Substring(self.strval, self.start + start, self.start + end)
+
+
+class W_StringBuilder(W_Object):
+    # a mutable string, appends are collected and only joined when the
+    # string is asked for, like a string output port does
+    __slots__ = ["pieces", "size"]
+
+    def __init__(self):
+        self.pieces = []
+        self.size = 0
+
+    def to_repr(self):
+        return "#<string-builder>"
+
+    to_string = to_repr
+
+    def append(self, s):
+        self.pieces.append(s)
+        self.size += len(s)
+
+    def build(self):
+        s = "".join(self.pieces)
+        self.pieces = [s]
+        return s
 
 
 class W_Symbol(W_Object):
     #class dictionary for symbol storage
+    __slots__ = ["name", "cache_env", "cache_pair", "cache_version"]
     obarray = {}
 
     def __init__(self, val):
         self.name = val
+        # symbols are interned, so this is the lookup cache shared by all
+        # sites evaluating this name: the env cell the binding was last
+        # found in, valid while no frame was structurally mutated
+        self.cache_env = None
+        self.cache_pair = None
+        self.cache_version = -1
 
     def to_repr(self):
         return self.name
 
     to_string = to_repr
 
-    def compile(self, runtime, env_stack, stack, operand_stack):
-        cdr = runtime.lookup(self, env_stack.car).cdr
+    def compile(self, runtime, machine):
+        cdr = runtime.lookup(self, machine.env_stack.top()).cdr
         assert isinstance(cdr, W_List) and not cdr.is_nil()
-        return env_stack, W_List(cdr.car, stack), operand_stack
+        machine.stack.push(cdr.car)
 
     def equal(self, w_obj):
         return self is w_obj
@@ -115,7 +215,10 @@ def symbol(name):
     #use this to create new symbols, it stores all symbols
     #in W_Symbol.obarray dict
     #if already in obarray return it 
-    name = name.lower()
+    return intern_symbol(name.lower())
+
+def intern_symbol(name):
+    # for names known to be lower case already
     w_symb = W_Symbol.obarray.get(name, None)
     if w_symb is None:
         w_symb = W_Symbol(name)
@@ -125,9 +228,24 @@ def symbol(name):
     return w_symb
 
 
-class W_Real(W_Object):
+class W_Number(W_Object):
+    # the numbers hold their value in a single field of their own class
+    __slots__ = []
+
+    def to_number(self):
+        return self.to_float()
+
+    def to_fixnum(self):
+        raise NotImplementedError
+
+    def to_float(self):
+        raise NotImplementedError
+
+
+class W_Real(W_Number):
+    __slots__ = ["realval"]
+
     def __init__(self, val):
-        self.exact = False
         self.realval = val
 
     def to_string(self):
@@ -137,9 +255,6 @@ class W_Real(W_Object):
         # return repr(self.realval)
         return str(float(self.realval))
 
-    def to_number(self):
-        return self.to_float()
-
     def to_fixnum(self):
         return int(self.realval)
 
@@ -164,20 +279,19 @@ class W_Real(W_Object):
         return self.realval == self.round()
 
     def eqv(self, w_obj):
-        return isinstance(w_obj, W_Real) \
-            and self.exact is w_obj.exact \
-            and self.realval == w_obj.realval
+        return isinstance(w_obj, W_Real) and self.realval == w_obj.realval
     equal = eqv
 
+    def hash_eqv(self):
+        return compute_hash(self.realval)
+    hash_equal = hash_eqv
 
-W_Number = W_Real
 
+class W_Integer(W_Number):
+    __slots__ = ["intval"]
 
-class W_Integer(W_Real):
     def __init__(self, val):
         self.intval = val
-        self.realval = val
-        self.exact = True
 
     def to_string(self):
         return str(self.intval)
@@ -195,108 +309,210 @@ class W_Integer(W_Real):
     def to_float(self):
         return float(self.intval)
 
+    def eqv(self, w_obj):
+        return isinstance(w_obj, W_Integer) and self.intval == w_obj.intval
+    equal = eqv
+
+    def hash_eqv(self):
+        return self.intval
+    hash_equal = hash_eqv
 
-class W_EofObject(W_Object):
-    pass
-w_eof = W_EofObject()
 
+class W_BigInteger(W_Number):
+    # an exact integer that doesn't fit a machine word, arithmetic makes
+    # these only on overflow and turns results that fit back into W_Integer
+    __slots__ = ["bigval"]
 
-class W_Stream(W_Object):
-    def __init__(self, filename):
-        from pypy.rlib.streamio import open_file_as_stream
-        self.filename = filename
-        self.contents = open_file_as_stream(filename).readall()
-        self.sexprs = None
-        self.sexpr_pos = 0
+    def __init__(self, bigval):
+        self.bigval = bigval
 
     def to_string(self):
-        return "#<FileStream #{%s}>" % self.filename
+        return self.bigval.str()
+
     to_repr = to_string
 
-    def next_sexpr(self):
-        if self.sexprs and self.sexpr_pos < len(self.sexprs):
-            sexpr = self.sexprs[self.sexpr_pos]
-            self.sexpr_pos += 1
-            return sexpr
-        else:
-            return w_eof
+    def to_fixnum(self):
+        return int(self.to_float())
+
+    def to_float(self):
+        try:
+            return self.bigval.tofloat()
+        except OverflowError:
+            if self.bigval.sign < 0:
+                return -INFINITY
+            return INFINITY
+
+    def eqv(self, w_obj):
+        return isinstance(w_obj, W_BigInteger) and self.bigval.eq(w_obj.bigval)
+    equal = eqv
+
+    def hash_eqv(self):
+        return self.bigval.hash()
+    hash_equal = hash_eqv
+
+
+SMALL_INT_MIN = -128
+SMALL_INT_MAX = 1024
+
+# preallocated, so loop counters and the like don't allocate
+small_ints_w = [W_Integer(i) for i in range(SMALL_INT_MIN, SMALL_INT_MAX + 1)]
+
+def w_integer(intval):
+    if SMALL_INT_MIN <= intval <= SMALL_INT_MAX:
+        return small_ints_w[intval - SMALL_INT_MIN]
+    return W_Integer(intval)
+
+def w_bigint(bigval):
+    try:
+        return w_integer(bigval.toint())
+    except OverflowError:
+        return W_BigInteger(bigval)
+
+def to_bigint(w_int):
+    if isinstance(w_int, W_BigInteger):
+        return w_int.bigval
+    assert isinstance(w_int, W_Integer)
+    return rbigint.fromint(w_int.intval)
+
+def is_exact_integer(w_obj):
+    return isinstance(w_obj, W_Integer) or isinstance(w_obj, W_BigInteger)
+
+
+class W_EofObject(W_Object):
+    __slots__ = []
+w_eof = W_EofObject()
+
+
+class ListAllocations(object):
+    # counts the W_List cells made once the --stats of stats.py started it
+    _immutable_fields_ = ["counting?"]
+
+    def __init__(self):
+        self.counting = False
+        self.count = 0
+
+    def start(self):
+        self.counting = True
+        self.count = 0
+
+list_allocations = ListAllocations()
 
 
 class W_List(W_Object):
+    __slots__ = ["car", "cdr"]
+
     def __init__(self, car, cdr):
         self.car = car
         self.cdr = cdr
+        if list_allocations.counting:
+            list_allocations.count += 1
 
     def to_string(self):
-        return "(" + self.to_lstring() + ")"
-
-    def to_lstring(self):
-        car = self.car.to_string()
-        cdr = self.cdr
-        if cdr.is_nil():
-            return car
-        elif isinstance(cdr, W_List): #still proper list
-            return car + " " + cdr.to_lstring()
-        else: #end proper list with dotted
-            return car + " . " + cdr.to_string()
+        return print_iteratively(self, False)
 
     def to_array(self):
         ary = []
         l = self
         while not l.is_nil():
             assert isinstance(l, W_List)
-            l.append(l.car)
-            l.cdr
+            ary.append(l.car)
+            l = l.cdr
         return ary
 
     def to_repr(self):
-        return "(" + self.to_lrepr() + ")"
-
-    def to_lrepr(self):
-        car = self.car.to_repr()
-        cdr = self.cdr
-        if cdr.is_nil(): #end of proper list
-            return car
-        elif isinstance(cdr, W_List): #still proper list
-            return car + " " + cdr.to_lrepr()
-        else: #end proper list with dotted
-            return car + " . " + cdr.to_repr()
+        return print_iteratively(self, True)
 
     def __repr__(self):
         return "<W_List " + self.to_repr() + ">"
 
+    def set_car(self, w_val):
+        if isinstance(self.car, W_Symbol) or isinstance(self.car, W_List):
+            # may rename a binding or replace the pair of a frame
+            frame_version.bump()
+        if isinstance(self.car, W_Frame):
+            # an env cell holding an indexed frame, e.g. the global env
+            global_version.bump()
+        code_version.written(self)
+        self.car = w_val
+
+    def set_cdr(self, w_val):
+        if not isinstance(self.car, W_Symbol) and isinstance(self.cdr, W_List):
+            # may splice a frame, binding pairs only change their value
+            frame_version.bump()
+        if isinstance(self.car, W_Frame):
+            global_version.bump()
+        code_version.written(self)
+        self.cdr = w_val
+
     def equal(self, w_obj):
-        return isinstance(w_obj, W_List) and \
-            self.car.equal(w_obj.car) and \
-            self.cdr.equal(w_obj.cdr)
+        return equal_iteratively(self, w_obj)
+
+    def hash_equal(self):
+        return hash_iteratively(self)
 
     def cons(self, w_pair):
-        if self.cdr.is_nil():
-            return W_List(self.car, w_pair)
-        else:
-            return W_List(self.car, self.cdr.cons(w_pair))
+        builder = ListBuilder()
+        builder.append_copy(self)
+        return builder.finish(w_pair)
 
     def comma(self, w_pair):
-        if self.cdr.is_nil():
-            self.cdr = w_pair
-            return self
-        else:
-            self.cdr.comma(w_pair)
-            return self
+        builder = ListBuilder()
+        builder.append_list(self)
+        return builder.finish(w_pair)
 
-    def compile(self, runtime, env_stack, stack, operand_stack):
-        return env_stack, stack, w_list([self.car, W_Call(self.cdr)]).comma(operand_stack)
+    def compile(self, runtime, machine):
+        machine.operand_stack.push(W_Call(self.cdr))
+        machine.operand_stack.push(instruction(self.car))
 
 
 @jit.unroll_safe
-def w_list(args):
-    w_l = W_List(args[0], w_nil)
-    for w_item in args[1:]:
-        w_l.comma(W_List(w_item, w_nil))
-    return w_l
+def w_list(args, w_rest=None):
+    builder = ListBuilder()
+    for w_item in args:
+        builder.append(w_item)
+    return builder.finish(w_rest)
+
+
+class ListBuilder(object):
+    # builds a list front to back in O(1) per element by keeping a pointer
+    # to the last cell
+    def __init__(self):
+        self.w_head = None
+        self.w_tail = None
+
+    def append(self, w_obj):
+        self.link(W_List(w_obj, w_nil))
+
+    def link(self, w_cell):
+        if self.w_tail is None:
+            self.w_head = w_cell
+        else:
+            self.w_tail.cdr = w_cell
+        self.w_tail = w_cell
+
+    def append_list(self, w_lst):
+        # shares the cells of w_lst, whose last cdr gets overwritten by
+        # whatever comes next
+        while isinstance(w_lst, W_List) and not w_lst.is_nil():
+            self.link(w_lst)
+            w_lst = w_lst.cdr
+
+    def append_copy(self, w_lst):
+        while isinstance(w_lst, W_List) and not w_lst.is_nil():
+            self.append(w_lst.car)
+            w_lst = w_lst.cdr
+
+    def finish(self, w_rest=None):
+        if w_rest is None:
+            w_rest = w_nil
+        if self.w_tail is None:
+            return w_rest
+        self.w_tail.cdr = w_rest
+        return self.w_head
 
 
 class W_Nil(W_List):
+    __slots__ = []
     _w_nil = None
     def __new__(cls):
         if cls._w_nil is None:
@@ -319,8 +535,14 @@ class W_Nil(W_List):
 
     cons = comma
 
-    def compile(self, runtime, env_stack, stack, operand_stack):
-        return env_stack, W_List(self, stack), operand_stack
+    def equal(self, w_obj):
+        return self is w_obj
+
+    def hash_equal(self):
+        return self.hash_eqv()
+
+    def compile(self, runtime, machine):
+        machine.stack.push(self)
 
     def is_nil(self):
         return True
@@ -328,146 +550,671 @@ class W_Nil(W_List):
 w_nil = W_Nil()
 
 
+class W_Vector(W_Object):
+    # a fixed length array, indexed in constant time
+    __slots__ = ["items_w"]
+
+    def __init__(self, items_w):
+        self.items_w = items_w
+
+    def to_string(self):
+        return print_iteratively(self, False)
+
+    def to_repr(self):
+        return print_iteratively(self, True)
+
+    def equal(self, w_obj):
+        return equal_iteratively(self, w_obj)
+
+    def hash_equal(self):
+        return hash_iteratively(self)
+
+
+def print_iteratively(w_obj, write):
+    # prints lists and vectors with an explicit stack of what is left to
+    # print, an object or, where it is None, the text next to it. Other
+    # objects print themselves
+    out = []
+    todo_w = [w_obj]
+    texts = [""]
+    while todo_w:
+        w_obj = todo_w.pop()
+        text = texts.pop()
+        if w_obj is None:
+            out.append(text)
+        elif isinstance(w_obj, W_Vector):
+            push_items(todo_w, texts, "#(", w_obj.items_w, None)
+        elif isinstance(w_obj, W_List) and not w_obj.is_nil():
+            items_w = []
+            w_rest = w_obj
+            while isinstance(w_rest, W_List) and not w_rest.is_nil():
+                items_w.append(w_rest.car)
+                w_rest = w_rest.cdr
+            push_items(todo_w, texts, "(", items_w, None if w_rest.is_nil() else w_rest)
+        elif write:
+            out.append(w_obj.to_repr())
+        else:
+            out.append(w_obj.to_string())
+    return "".join(out)
+
+def push_items(todo_w, texts, opening, items_w, w_tail):
+    # pushed in reverse, so they come off the stack in order
+    todo_w.append(None)
+    texts.append(")")
+    if w_tail is not None:
+        todo_w.append(w_tail)
+        texts.append("")
+        todo_w.append(None)
+        texts.append(" . ")
+    for i in range(len(items_w) - 1, -1, -1):
+        todo_w.append(items_w[i])
+        texts.append("")
+        if i > 0:
+            todo_w.append(None)
+            texts.append(" ")
+    todo_w.append(None)
+    texts.append(opening)
+
+def equal_iteratively(w_a, w_b):
+    # compares lists and vectors element by element with a stack of the
+    # pairs of objects left to compare
+    todo_a = [w_a]
+    todo_b = [w_b]
+    while todo_a:
+        w_a = todo_a.pop()
+        w_b = todo_b.pop()
+        if w_a is w_b:
+            continue
+        if isinstance(w_a, W_Vector):
+            if not isinstance(w_b, W_Vector) or len(w_a.items_w) != len(w_b.items_w):
+                return False
+            for i in range(len(w_a.items_w)):
+                todo_a.append(w_a.items_w[i])
+                todo_b.append(w_b.items_w[i])
+        elif isinstance(w_a, W_List) and not w_a.is_nil():
+            if not isinstance(w_b, W_List) or w_b.is_nil():
+                return False
+            todo_a.append(w_a.cdr)
+            todo_b.append(w_b.cdr)
+            todo_a.append(w_a.car)
+            todo_b.append(w_b.car)
+        elif not w_a.equal(w_b):
+            return False
+    return True
+
+# structural hashes only look at this many objects, which keeps them cheap
+# for long lists and finite for circular ones
+HASH_LIMIT = 64
+
+def hash_iteratively(w_obj):
+    # visits lists and vectors in the order equal_iteratively compares them,
+    # mixing in the shape and the hashes of the other objects
+    h = 0x345678
+    todo_w = [w_obj]
+    limit = HASH_LIMIT
+    while todo_w and limit > 0:
+        w_obj = todo_w.pop()
+        limit -= 1
+        if isinstance(w_obj, W_Vector):
+            h = intmask((h ^ len(w_obj.items_w)) * 1000003)
+            for i in range(len(w_obj.items_w) - 1, -1, -1):
+                todo_w.append(w_obj.items_w[i])
+        elif isinstance(w_obj, W_List) and not w_obj.is_nil():
+            h = intmask((h ^ 0x1ce) * 1000003)
+            todo_w.append(w_obj.cdr)
+            todo_w.append(w_obj.car)
+        else:
+            h = intmask((h ^ w_obj.hash_equal()) * 1000003)
+    return h
+
+
+def eqv_keys(w_a, w_b):
+    return w_a.eqv(w_b)
+
+def eqv_hash(w_obj):
+    return w_obj.hash_eqv()
+
+def equal_keys(w_a, w_b):
+    return w_a.equal(w_b)
+
+def equal_hash(w_obj):
+    return w_obj.hash_equal()
+
+
+class W_HashTable(W_Object):
+    # a mutable table from keys to values, compared either with eqv or with
+    # equal and hashed to match
+    __slots__ = ["entries"]
+
+    def __init__(self, equal):
+        if equal:
+            self.entries = r_dict(equal_keys, equal_hash)
+        else:
+            self.entries = r_dict(eqv_keys, eqv_hash)
+
+    def to_repr(self):
+        return "#<hashtable>"
+
+    to_string = to_repr
+
+
+class FrameVersion(object):
+    # bumped on set-car!/set-cdr! that may change what a lookup finds;
+    # invalidates frame indexes and symbol lookup caches
+    def __init__(self):
+        self.counter = 0
+
+    def bump(self):
+        self.counter += 1
+
+frame_version = FrameVersion()
+
+
+class GlobalVersion(object):
+    # bumped when a W_Frame or W_Binding cell is written, which are the only
+    # cells the global frame is made of; lookups of global names are
+    # constant-folded by the JIT as long as the version is unchanged
+    _immutable_fields_ = ["version?"]
+
+    def __init__(self):
+        self.version = 0
+
+    def bump(self):
+        self.version += 1
+
+global_version = GlobalVersion()
+
+
+class CodeVersion(object):
+    # bumped when a cell of a fexpr body the bytecode engine compiled is
+    # written, code objects then check whether their own cells changed
+    def __init__(self):
+        self.counter = 0
+        self.cells = {}
+
+    def add(self, w_cell):
+        self.cells[w_cell] = True
+
+    def written(self, w_cell):
+        if w_cell in self.cells:
+            self.counter += 1
+
+code_version = CodeVersion()
+
+
+class W_Binding(W_List):
+    # a (name value) pair of an indexed frame. set-cdr! rebinds the value
+    # in place, so traces that folded the lookup of this cell stay valid
+    __slots__ = []
+
+    def set_car(self, w_val):
+        frame_version.bump()
+        global_version.bump()
+        code_version.written(self)
+        self.car = w_val
+
+
+class FrameIndex(object):
+    # the pairs reachable from a W_Frame by name, valid for one frame_version
+    def __init__(self, bindings, foldable, version):
+        self.bindings = bindings
+        self.foldable = foldable
+        self.version = version
+
+
+class W_Frame(W_List):
+    # A frame whose pairs are indexed by name. The index covers every pair
+    # reachable from this cell and is rebuilt lazily after a structural
+    # set-car!/set-cdr!, so the frame still behaves like a plain assoc list.
+    # Only frames that get looked up in have an index, the ones behind them
+    # are a cell with a binding like any other.
+    __slots__ = ["index"]
+
+    def __init__(self, car, cdr):
+        W_List.__init__(self, car, cdr)
+        self.index = None
+
+    def set_car(self, w_val):
+        frame_version.bump()
+        global_version.bump()
+        self.car = w_val
+
+    def set_cdr(self, w_val):
+        frame_version.bump()
+        global_version.bump()
+        self.cdr = w_val
+
+    def current_index(self):
+        index = self.index
+        if index is None or index.version != frame_version.counter:
+            index = self.reindex()
+        return index
+
+    def find(self, w_name):
+        return self.current_index().bindings.get(w_name, None)
+
+    def is_foldable(self):
+        # whether every cell reachable from here bumps global_version when
+        # written, which makes find() pure for a given version
+        return self.current_index().foldable
+
+    def reindex(self):
+        bindings = {}
+        foldable = True
+        frame = self
+        while not frame.is_nil():
+            if not isinstance(frame, W_Frame):
+                foldable = False
+            if not isinstance(frame, W_List):
+                raise QuoppaException("Consistency! Non pair %s as frame" % frame.to_string())
+            pair = frame.car
+            if not isinstance(pair, W_List) or pair.is_nil():
+                raise QuoppaException("Consistency! Non pair %s in frame" % pair.to_string())
+            w_name = pair.car
+            if not isinstance(w_name, W_Symbol):
+                raise QuoppaException("Consistency! Non symbol %s in pair" % pair.to_string())
+            if not isinstance(pair, W_Binding):
+                foldable = False
+            if w_name not in bindings:
+                bindings[w_name] = pair
+            frame = frame.cdr
+        index = FrameIndex(bindings, foldable, frame_version.counter)
+        self.index = index
+        return index
+
+    def extend(self, w_pair):
+        assert isinstance(w_pair, W_List)
+        w_frame = W_Frame(w_pair, self)
+        index = self.index
+        if index is not None and index.version == frame_version.counter:
+            # the index moves on to the new frame instead of being copied,
+            # this one builds a new one if it is ever looked up in again
+            index.bindings[w_pair.car] = w_pair
+            w_frame.index = index
+            self.index = None
+        return w_frame
+
+
+class W_CallEnv(W_List):
+    # the env a call of a fexpr runs its body in, which remembers the fexpr
+    # so the sampling profiler can tell the calls on the env stack apart
+    __slots__ = ["w_fexpr"]
+
+    def __init__(self, car, cdr, w_fexpr):
+        W_List.__init__(self, car, cdr)
+        self.w_fexpr = w_fexpr
+
+
+FRAME_INDEX_MIN_LENGTH = 8
+
+def indexed_frame(w_pairs):
+    length = 0
+    w_rest = w_pairs
+    while isinstance(w_rest, W_List) and not w_rest.is_nil():
+        length += 1
+        w_rest = w_rest.cdr
+    if length < FRAME_INDEX_MIN_LENGTH:
+        return w_pairs
+    assert isinstance(w_pairs, W_List)
+    return W_Frame(w_pairs.car, w_pairs.cdr)
+
+
+def is_binding(w_obj):
+    return (isinstance(w_obj, W_List) and not w_obj.is_nil() and
+            isinstance(w_obj.car, W_Symbol))
+
+
+class W_Literal(W_Object):
+    __slots__ = ["w_value"]
+
+    def __init__(self, w_value):
+        self.w_value = w_value
+
+    def to_repr(self):
+        return "#<literal %s>" % self.w_value.to_repr()
+
+    def compile(self, runtime, machine):
+        machine.stack.push(self.w_value)
+
+
+def instruction(w_exp):
+    # fexprs on the operand stack get called, so a fexpr that appears as an
+    # expression (e.g. spliced in by (cons list args)) must be pushed as is
+    if isinstance(w_exp, W_Fexpr):
+        return W_Literal(w_exp)
+    return w_exp
+
+
+class Stack(object):
+    # growable array stack, push and pop don't allocate once it is warm
+    def __init__(self, size=16):
+        self.items_w = [None] * size
+        self.depth = 0
+
+    def push(self, w_obj):
+        if self.depth == len(self.items_w):
+            self.items_w = self.items_w + [None] * len(self.items_w)
+        self.items_w[self.depth] = w_obj
+        self.depth += 1
+
+    def pop(self):
+        depth = self.depth - 1
+        assert depth >= 0
+        w_obj = self.items_w[depth]
+        self.items_w[depth] = None
+        self.depth = depth
+        return w_obj
+
+    def top(self):
+        depth = self.depth - 1
+        assert depth >= 0
+        return self.items_w[depth]
+
+    def is_empty(self):
+        return self.depth == 0
+
+    @jit.unroll_safe
+    def pop_below(self, count):
+        # removes the item under the top count items
+        index = self.depth - count - 1
+        assert index >= 0
+        w_obj = self.items_w[index]
+        for i in range(index, self.depth - 1):
+            self.items_w[i] = self.items_w[i + 1]
+        self.depth -= 1
+        self.items_w[self.depth] = None
+        return w_obj
+
+    def put(self, index, w_obj):
+        assert 0 <= index < self.depth
+        self.items_w[index] = w_obj
+
+    @jit.unroll_safe
+    def reverse_top(self, base):
+        i = base
+        j = self.depth - 1
+        while i < j:
+            w_obj = self.items_w[i]
+            self.items_w[i] = self.items_w[j]
+            self.items_w[j] = w_obj
+            i += 1
+            j -= 1
+
+
+class MachineState(object):
+    # the registers of Runtime.interpret: the env stack, the value stack
+    # and the operand stack of instructions still to run
+    def __init__(self):
+        self.env_stack = Stack()
+        self.stack = Stack()
+        self.operand_stack = Stack()
+
+    def push_frame(self, env):
+        # a call followed directly by a return is in tail position: the
+        # frame it would return to is finished, so its env is replaced
+        # instead of stacking another env and return
+        if not self.operand_stack.is_empty() and self.operand_stack.top() is w_return:
+            self.env_stack.pop()
+        else:
+            self.operand_stack.push(w_return)
+        self.env_stack.push(env)
+
+
 class W_PrimitiveCall(W_Object):
+    __slots__ = ["w_primitive"]
+    _immutable_fields_ = ["w_primitive"]
+
     def __init__(self, w_primitive):
         self.w_primitive = w_primitive
 
-    def compile(self, runtime, env_stack, stack, operand_stack):
-        operands_w = []
-        for i in xrange(self.w_primitive.arg_count):
-            assert isinstance(stack, W_List)
-            operands_w.append(stack.car)
-            stack = stack.cdr
-        w_res = self.w_primitive.fun(operands_w)
-        return env_stack, W_List(w_res, stack), operand_stack
+    def to_repr(self):
+        return "#<call %s>" % self.w_primitive.to_string()
+
+
+class W_PrimitiveCall0(W_PrimitiveCall):
+    __slots__ = []
+
+    def compile(self, runtime, machine):
+        w_primitive = self.w_primitive
+        assert isinstance(w_primitive, W_Primitive0)
+        machine.stack.push(w_primitive.fun())
+
+
+class W_PrimitiveCall1(W_PrimitiveCall):
+    __slots__ = []
+
+    def compile(self, runtime, machine):
+        w_primitive = self.w_primitive
+        assert isinstance(w_primitive, W_Primitive1)
+        w_a = machine.stack.pop()
+        machine.stack.push(w_primitive.fun(w_a))
+
+
+class W_PrimitiveCall2(W_PrimitiveCall):
+    __slots__ = []
+
+    def compile(self, runtime, machine):
+        w_primitive = self.w_primitive
+        assert isinstance(w_primitive, W_Primitive2)
+        w_b = machine.stack.pop()
+        w_a = machine.stack.pop()
+        machine.stack.push(w_primitive.fun(w_a, w_b))
+
+
+class W_PrimitiveCall3(W_PrimitiveCall):
+    __slots__ = []
+
+    def compile(self, runtime, machine):
+        w_primitive = self.w_primitive
+        assert isinstance(w_primitive, W_Primitive3)
+        w_c = machine.stack.pop()
+        w_b = machine.stack.pop()
+        w_a = machine.stack.pop()
+        machine.stack.push(w_primitive.fun(w_a, w_b, w_c))
+
+
+class W_VariadicPrimitiveCall(W_PrimitiveCall):
+    __slots__ = ["arg_count"]
+    _immutable_fields_ = ["arg_count"]
+
+    def __init__(self, w_primitive, arg_count):
+        self.w_primitive = w_primitive
+        self.arg_count = arg_count
+
+    @jit.unroll_safe
+    def compile(self, runtime, machine):
+        w_primitive = self.w_primitive
+        assert isinstance(w_primitive, W_VariadicPrimitive)
+        args_w = [None] * self.arg_count
+        for i in xrange(self.arg_count - 1, -1, -1):
+            args_w[i] = machine.stack.pop()
+        machine.stack.push(w_primitive.fun(args_w))
+
+
+class W_LookupCall(W_PrimitiveCall):
+    __slots__ = []
+
+    def compile(self, runtime, machine):
+        env = machine.stack.pop()
+        w_name = machine.stack.pop()
+        machine.stack.push(runtime.lookup(w_name, env))
 
     def to_repr(self):
-        return "#<primitive %s>" % self.w_primitive.fun
+        return "#<lookup>"
 
 
 class W_OperateCall(W_PrimitiveCall):
-    def compile(self, runtime, env_stack, stack, operand_stack):
-        op_env = stack.car
-        stack = stack.cdr
-        assert isinstance(stack, W_List)
-        fexpr = stack.car
-        stack = stack.cdr
-        assert isinstance(stack, W_List)
-        operands = stack.car
-        stack = stack.cdr
-        return W_List(op_env, env_stack), W_List(operands, stack), w_list([fexpr, W_Return()]).comma(operand_stack)
+    __slots__ = []
+
+    def compile(self, runtime, machine):
+        operands = machine.stack.pop()
+        fexpr = machine.stack.pop()
+        op_env = machine.stack.pop()
+        if op_env is not machine.env_stack.top():
+            machine.push_frame(op_env)
+        machine.stack.push(operands)
+        machine.operand_stack.push(fexpr)
 
     def to_repr(self):
         return "#<operate>"
 
 
 class W_EvalCall(W_PrimitiveCall):
-    def compile(self, runtime, env_stack, stack, operand_stack):
-        eval_env = stack.car
-        stack = stack.cdr
-        assert isinstance(stack, W_List)
-        w_exp = stack.car
-        stack = stack.cdr
-        return W_List(eval_env, env_stack), stack, w_list([w_exp, W_Return()]).comma(operand_stack)
+    __slots__ = []
+
+    def compile(self, runtime, machine):
+        w_exp = machine.stack.pop()
+        eval_env = machine.stack.pop()
+        if eval_env is not machine.env_stack.top():
+            machine.push_frame(eval_env)
+        machine.operand_stack.push(instruction(w_exp))
 
     def to_repr(self):
         return "#<eval>"
 
 
+class W_WrapCall(W_PrimitiveCall):
+    __slots__ = []
+
+    def compile(self, runtime, machine):
+        w_operative = machine.stack.pop()
+        if not isinstance(w_operative, W_Fexpr):
+            raise QuoppaException("cannot wrap %s" % w_operative.to_string())
+        machine.stack.push(W_Applicative(w_operative))
+
+    def to_repr(self):
+        return "#<wrap>"
+
+
+class W_UnwrapCall(W_PrimitiveCall):
+    __slots__ = []
+
+    def compile(self, runtime, machine):
+        w_applicative = machine.stack.pop()
+        if not isinstance(w_applicative, W_Applicative):
+            raise QuoppaException("cannot unwrap %s" % w_applicative.to_string())
+        machine.stack.push(w_applicative.w_operative)
+
+    def to_repr(self):
+        return "#<unwrap>"
+
+
 class W_Call(W_Object):
+    __slots__ = ["w_operands"]
+
     def __init__(self, w_operands):
         self.w_operands = w_operands
 
     def to_repr(self):
         return "#<call>"
 
-    def compile(self, runtime, env_stack, stack, operand_stack):
-        fexpr = stack.car
-        stack = stack.cdr
+    def compile(self, runtime, machine):
+        fexpr = machine.stack.pop()
         assert isinstance(fexpr, W_Fexpr)
-        return env_stack, W_List(self.w_operands, stack), W_List(fexpr, operand_stack)
+        machine.stack.push(self.w_operands)
+        machine.operand_stack.push(fexpr)
 
 
 class W_Return(W_Object):
-    def compile(self, runtime, env_stack, stack, operand_stack):
-        return env_stack.cdr, stack, operand_stack
+    __slots__ = []
+
+    def compile(self, runtime, machine):
+        machine.env_stack.pop()
 
     def to_repr(self):
         return "#<return>"
 
+w_return = W_Return()
+
 
 class W_Fexpr(W_Object):
+    __slots__ = ["env_param", "params", "static_env", "body",
+                 "body_instruction", "code"]
+    _immutable_fields_ = ["env_param", "params", "static_env", "body",
+                          "body_instruction"]
+
     def __init__(self, env_param, params, static_env, body):
         self.env_param = env_param
         self.params = params
         self.static_env = static_env
         self.body = body
+        self.body_instruction = instruction(body)
+        # the bytecode of the body, set by the bytecode engine on the first call
+        self.code = None
 
     def to_string(self):
         return '#<an fexpr>'
 
     to_repr = to_string
 
-    def compile(self, runtime, env_stack, stack, operand_stack):
-        w_operands = stack.car
-        stack = stack.cdr
+    def compile(self, runtime, machine):
+        w_operands = machine.stack.pop()
 
         local_names = W_List(self.env_param, self.params)
-        local_values = W_List(env_stack.car, w_operands)
-        local_env = W_List(runtime.bind(local_names, local_values), self.static_env)
+        local_values = W_List(machine.env_stack.top(), w_operands)
+        w_pairs = runtime.bind(local_names, local_values)
+        local_env = W_CallEnv(indexed_frame(w_pairs), self.static_env, self)
+
+        machine.push_frame(local_env)
+        machine.operand_stack.push(runtime.engine.body_instruction(self, local_env, w_pairs))
+
+    def takes_values(self):
+        # whether call_with_values can skip operand evaluation, which is
+        # only the case for fexprs that evaluate all their operands anyway
+        return False
 
-        return W_List(local_env, env_stack), stack, w_list([self.body, W_Return()]).comma(operand_stack)
+    def call_with_values(self, machine, args_w):
+        raise NotImplementedError
 
 
 class W_BasePrimitive(W_Fexpr):
+    __slots__ = ["arg_count", "call_instruction"]
     CallClass = W_PrimitiveCall
 
-    def __init__(self):
-        self.arg_count = 0
+    def __init__(self, arg_count=0):
+        self.arg_count = arg_count
+        # call instructions are stateless, so every call shares this one
+        self.call_instruction = self.CallClass(self)
+
+    def call_instruction_for(self, argcount):
+        if argcount < self.arg_count:
+            raise QuoppaException("too few arguments to primitive")
+        elif argcount > self.arg_count:
+            raise QuoppaException("too many arguments to primitive")
+        return self.call_instruction
 
     @jit.unroll_safe
-    def compile(self, runtime, env_stack, stack, operand_stack):
+    def compile(self, runtime, machine):
         argcount = 0
-        w_operands = stack.car
-        stack = stack.cdr
-        operand_stack = W_List(self.CallClass(self), operand_stack)
+        w_operands = machine.stack.pop()
+        call_index = machine.operand_stack.depth
+        machine.operand_stack.push(None)
+        # operands are evaluated left to right, so the first one goes on top
+        base = machine.operand_stack.depth
         while not w_operands.is_nil():
             assert isinstance(w_operands, W_List)
-            operand_stack = W_List(w_operands.car, operand_stack)
+            machine.operand_stack.push(instruction(w_operands.car))
             w_operands = w_operands.cdr
             argcount += 1
-        if argcount < self.arg_count:
-            raise QuoppaException("too few arguments to primitive")
-        elif argcount > self.arg_count:
-            raise QuoppaException("too many arguments to primitive")
-        return env_stack, stack, operand_stack
+        machine.operand_stack.put(call_index, self.call_instruction_for(argcount))
+        machine.operand_stack.reverse_top(base)
+
+    def takes_values(self):
+        return True
+
+    @jit.unroll_safe
+    def call_with_values(self, machine, args_w):
+        for w_arg in args_w:
+            machine.stack.push(w_arg)
+        machine.operand_stack.push(self.call_instruction_for(len(args_w)))
 
 
 class W_Primitive(W_BasePrimitive):
-    @specialize.memo()
+    __slots__ = ["fun", "name"]
+
     def __init__(self, fun):
-        code = fun.__code__
-
-        lines = []
-        lines.append("def %s(args_w):" % fun.__name__)
-        lines.append("    args = ()")
-
-        arg_count = 0
-        for i, argname in enumerate(code.co_varnames[:code.co_argcount]):
-            if argname != "self":
-                coerce_code = "args_w[{:d}]".format(arg_count)
-                lines.append("    if len(args_w) > {}:".format(arg_count))
-                lines.append("        args += ({},)".format(coerce_code))
-                lines.append("    else:")
-                lines.append("        raise Exception({}, '{}')".format(i, argname))
-                arg_count += 1
-        lines.append("    return func(*args)")
-
-        source = "\n".join(lines)
-        namespace = {"func": fun}
-        exec source in namespace
-        self.arg_count = arg_count
-        self.fun = namespace[fun.__name__]
+        W_BasePrimitive.__init__(self, fun.__code__.co_argcount)
+        self.fun = fun
         self.name = fun.__name__
 
     def to_string(self):
@@ -475,22 +1222,99 @@ class W_Primitive(W_BasePrimitive):
     to_repr = to_string
 
 
-class W_Vau(W_Primitive):
-    def compile(self, runtime, env_stack, stack, operand_stack):
-        w_operands = stack.car
-        stack = stack.cdr
-        return env_stack, W_List(self.fun([env_stack.car, w_operands]), stack), operand_stack
+class W_Primitive0(W_Primitive):
+    __slots__ = []
+    CallClass = W_PrimitiveCall0
+
+
+class W_Primitive1(W_Primitive):
+    __slots__ = []
+    CallClass = W_PrimitiveCall1
+
+
+class W_Primitive2(W_Primitive):
+    __slots__ = []
+    CallClass = W_PrimitiveCall2
+
+
+class W_Primitive3(W_Primitive):
+    __slots__ = []
+    CallClass = W_PrimitiveCall3
+
+
+class W_VariadicPrimitive(W_Primitive):
+    # gets its evaluated operands as a list, opt in with @variadic
+    __slots__ = ["calls_w"]
+    CallClass = W_VariadicPrimitiveCall
+
+    def __init__(self, fun):
+        self.arg_count = -1
+        self.fun = fun
+        self.name = fun.__name__
+        self.calls_w = []
+
+    @jit.elidable
+    def call_instruction_for(self, argcount):
+        while len(self.calls_w) <= argcount:
+            self.calls_w.append(W_VariadicPrimitiveCall(self, len(self.calls_w)))
+        return self.calls_w[argcount]
+
+
+def variadic(fun):
+    fun.variadic = True
+    return fun
+
+
+@specialize.memo()
+def primitive(fun):
+    if getattr(fun, "variadic", False):
+        return W_VariadicPrimitive(fun)
+    arg_count = fun.__code__.co_argcount
+    if arg_count == 0:
+        return W_Primitive0(fun)
+    elif arg_count == 1:
+        return W_Primitive1(fun)
+    elif arg_count == 2:
+        return W_Primitive2(fun)
+    elif arg_count == 3:
+        return W_Primitive3(fun)
+    raise ValueError("primitive %s takes %d arguments, make it @variadic" % (
+        fun.__name__, arg_count))
+
+
+class W_Vau(W_BasePrimitive):
+    __slots__ = []
+
+    def compile(self, runtime, machine):
+        w_operands = machine.stack.pop()
+        machine.stack.push(runtime.vau(machine.env_stack.top(), w_operands))
+
+    def takes_values(self):
+        return False
 
     def to_string(self):
         return "#<primitive vau>"
     to_repr = to_string
 
 
+class W_Lookup(W_BasePrimitive):
+    __slots__ = []
+    CallClass = W_LookupCall
+
+    def __init__(self):
+        W_BasePrimitive.__init__(self, 2)
+
+    def to_string(self):
+        return "#<primitive lookup>"
+    to_repr = to_string
+
+
 class W_Operate(W_BasePrimitive):
+    __slots__ = []
     CallClass = W_OperateCall
 
     def __init__(self):
-        self.arg_count = 3
+        W_BasePrimitive.__init__(self, 3)
 
     def to_string(self):
         return "#<primitive operate>"
@@ -498,11 +1322,83 @@ class W_Operate(W_BasePrimitive):
 
 
 class W_Eval(W_BasePrimitive):
+    __slots__ = []
     CallClass = W_EvalCall
 
     def __init__(self):
-        self.arg_count = 2
+        W_BasePrimitive.__init__(self, 2)
 
     def to_string(self):
         return "#<primitive eval>"
     to_repr = to_string    
+
+
+class W_Wrap(W_BasePrimitive):
+    # evaluates the operative once, when wrapping it, where the prelude's
+    # wrap evaluates it again on every call
+    __slots__ = []
+    CallClass = W_WrapCall
+
+    def __init__(self):
+        W_BasePrimitive.__init__(self, 1)
+
+    def to_string(self):
+        return "#<primitive wrap>"
+    to_repr = to_string
+
+
+class W_Unwrap(W_BasePrimitive):
+    __slots__ = []
+    CallClass = W_UnwrapCall
+
+    def __init__(self):
+        W_BasePrimitive.__init__(self, 1)
+
+    def to_string(self):
+        return "#<primitive unwrap>"
+    to_repr = to_string
+
+
+class W_ApplicativeCall(W_PrimitiveCall):
+    __slots__ = ["arg_count"]
+    _immutable_fields_ = ["arg_count"]
+
+    def __init__(self, w_primitive, arg_count):
+        self.w_primitive = w_primitive
+        self.arg_count = arg_count
+
+    @jit.unroll_safe
+    def compile(self, runtime, machine):
+        w_applicative = self.w_primitive
+        assert isinstance(w_applicative, W_Applicative)
+        w_args = w_nil
+        for i in xrange(self.arg_count):
+            w_args = W_List(machine.stack.pop(), w_args)
+        machine.stack.push(w_args)
+        machine.operand_stack.push(w_applicative.w_operative)
+
+
+class W_Applicative(W_BasePrimitive):
+    # an operative wrapped to get its operands evaluated in the caller's
+    # env, like the fexprs built by the wrap of prelude.qop
+    __slots__ = ["w_operative", "calls_w"]
+    _immutable_fields_ = ["w_operative"]
+
+    def __init__(self, w_operative):
+        self.arg_count = -1
+        self.w_operative = w_operative
+        self.calls_w = []
+
+    @jit.elidable
+    def call_instruction_for(self, argcount):
+        while len(self.calls_w) <= argcount:
+            self.calls_w.append(W_ApplicativeCall(self, len(self.calls_w)))
+        return self.calls_w[argcount]
+
+    def call_with_values(self, machine, args_w):
+        machine.stack.push(w_list(args_w))
+        machine.operand_stack.push(self.w_operative)
+
+    def to_string(self):
+        return '#<an fexpr>'
+    to_repr = to_string
@@ -0,0 +1,45 @@
+from execution_model import (W_HashTable, W_Vector, QuoppaException,
+                             w_undefined, w_true, w_false, w_integer)
+
+
+# Hash table primitives. An eq hashtable compares its keys with eqv, like
+# memq and assq do, so numbers that are not the same object still find
+# each other; an equal hashtable compares them with equal.
+
+def hashtable_argument(w_obj, name):
+    if not isinstance(w_obj, W_HashTable):
+        raise QuoppaException("wrong type argument %s for %s" % (w_obj.to_string(), name))
+    return w_obj
+
+def hashtable_p(w_obj):
+    if isinstance(w_obj, W_HashTable):
+        return w_true
+    return w_false
+
+def make_eq_hashtable():
+    return W_HashTable(False)
+
+def make_equal_hashtable():
+    return W_HashTable(True)
+
+def hashtable_ref(w_table, w_key, w_default):
+    entries = hashtable_argument(w_table, "hashtable-ref").entries
+    return entries.get(w_key, w_default)
+
+def hashtable_set_b(w_table, w_key, w_value):
+    hashtable_argument(w_table, "hashtable-set!").entries[w_key] = w_value
+    return w_undefined
+
+def hashtable_delete_b(w_table, w_key):
+    entries = hashtable_argument(w_table, "hashtable-delete!").entries
+    if w_key in entries:
+        del entries[w_key]
+    return w_undefined
+
+def hashtable_count(w_table):
+    return w_integer(len(hashtable_argument(w_table, "hashtable-count").entries))
+
+def hashtable_keys(w_table):
+    # a vector, in no particular order
+    entries = hashtable_argument(w_table, "hashtable-keys").entries
+    return W_Vector(entries.keys())
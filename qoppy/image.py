@@ -0,0 +1,317 @@
+from pypy.rlib.rarithmetic import intmask, r_longlong
+from pypy.rlib.longlong2float import float2longlong, longlong2float
+from pypy.rlib.rbigint import rbigint
+
+from execution_model import (W_List, W_Binding, W_Frame, W_CallEnv, W_Symbol,
+                             W_Integer, W_BigInteger, W_Real, W_String,
+                             W_Fexpr, W_Applicative, W_Vector,
+                             QuoppaException, intern_symbol, w_integer,
+                             w_nil, w_true, w_false, w_undefined, w_eof)
+
+
+# A heap image of the global env, taken after the prelude ran so a later
+# run can start from it instead of evaluating the prelude again.
+#
+# The image is a table of records, one per object reachable from the global
+# frame, that refer to each other by index, so shared and circular structure
+# comes back as it was. Primitives, the special forms of Runtime and the
+# natives of native.py are saved by name and looked up in the loading
+# runtime, the global env cell itself is saved as a reference too.
+#
+# Loading makes every pair and vector first and fills in their cars, cdrs
+# and items last, fexprs and applicatives are immutable and are made in
+# between, once what they refer to exists.
+
+MAGIC = "QOPPYIMG1\n"
+
+TAG_NIL = 0
+TAG_TRUE = 1
+TAG_FALSE = 2
+TAG_UNDEFINED = 3
+TAG_EOF = 4
+TAG_BUILTIN = 5
+TAG_SYMBOL = 6
+TAG_INTEGER = 7
+TAG_BIGINT = 8
+TAG_REAL = 9
+TAG_STRING = 10
+TAG_PAIR = 11
+TAG_BINDING = 12
+TAG_FRAME = 13
+TAG_FEXPR = 14
+TAG_APPLICATIVE = 15
+TAG_VECTOR = 16
+
+GLOBAL_ENV = "global-env"
+
+
+def builtin_objects(runtime):
+    # name -> object of everything saved by name
+    builtins_w = {}
+    for name in runtime.builtins_w:
+        builtins_w[name] = runtime.builtins_w[name]
+    for native_form in runtime.native_forms:
+        items_w = native_form.w_replacement.to_array()
+        builtins_w["native " + items_w[1].to_string()] = items_w[2]
+    builtins_w[GLOBAL_ENV] = runtime.global_env
+    return builtins_w
+
+
+class ImageWriter(object):
+    def __init__(self, runtime):
+        self.names = {}
+        builtins_w = builtin_objects(runtime)
+        for name in builtins_w:
+            self.names[builtins_w[name]] = name
+        self.indexes = {}
+        self.objects_w = []
+        self.out = []
+
+    def index(self, w_obj):
+        index = self.indexes.get(w_obj, -1)
+        if index == -1:
+            index = len(self.objects_w)
+            self.indexes[w_obj] = index
+            self.objects_w.append(w_obj)
+        return index
+
+    def write_byte(self, byte):
+        self.out.append(chr(byte))
+
+    def write_varint(self, value):
+        assert value >= 0
+        while value >= 0x80:
+            self.out.append(chr((value & 0x7f) | 0x80))
+            value >>= 7
+        self.out.append(chr(value))
+
+    def write_int64(self, value):
+        for i in range(8):
+            self.out.append(chr((value >> (i * 8)) & 0xff))
+
+    def write_str(self, s):
+        self.write_varint(len(s))
+        self.out.append(s)
+
+    def write_refs(self, refs_w):
+        for w_obj in refs_w:
+            self.write_varint(self.index(w_obj))
+
+    def save(self, w_root):
+        # records are written in index order, each one giving indexes to the
+        # objects it refers to, which are then written in turn
+        records = []
+        self.index(w_root)
+        i = 0
+        while i < len(self.objects_w):
+            self.out = []
+            self.write_object(self.objects_w[i])
+            records.append("".join(self.out))
+            i += 1
+        self.out = [MAGIC]
+        self.write_varint(len(records))
+        for record in records:
+            self.out.append(record)
+        return "".join(self.out)
+
+    def write_object(self, w_obj):
+        name = self.names.get(w_obj, None)
+        if name is not None:
+            self.write_byte(TAG_BUILTIN)
+            self.write_str(name)
+        elif w_obj is w_nil:
+            self.write_byte(TAG_NIL)
+        elif w_obj is w_true:
+            self.write_byte(TAG_TRUE)
+        elif w_obj is w_false:
+            self.write_byte(TAG_FALSE)
+        elif w_obj is w_undefined:
+            self.write_byte(TAG_UNDEFINED)
+        elif w_obj is w_eof:
+            self.write_byte(TAG_EOF)
+        elif isinstance(w_obj, W_Symbol):
+            self.write_byte(TAG_SYMBOL)
+            self.write_str(w_obj.name)
+        elif isinstance(w_obj, W_Integer):
+            self.write_byte(TAG_INTEGER)
+            self.write_int64(w_obj.intval)
+        elif isinstance(w_obj, W_BigInteger):
+            self.write_byte(TAG_BIGINT)
+            self.write_str(w_obj.bigval.str())
+        elif type(w_obj) is W_Real:
+            self.write_byte(TAG_REAL)
+            self.write_int64(intmask(float2longlong(w_obj.realval)))
+        elif isinstance(w_obj, W_String):
+            # substrings are saved as the strings they stand for
+            self.write_byte(TAG_STRING)
+            self.write_str(w_obj.to_string())
+        elif type(w_obj) is W_List or type(w_obj) is W_CallEnv:
+            # a call env is saved as the plain pair it is to the program
+            self.write_byte(TAG_PAIR)
+            self.write_refs([w_obj.car, w_obj.cdr])
+        elif type(w_obj) is W_Binding:
+            self.write_byte(TAG_BINDING)
+            self.write_refs([w_obj.car, w_obj.cdr])
+        elif type(w_obj) is W_Frame:
+            self.write_byte(TAG_FRAME)
+            self.write_refs([w_obj.car, w_obj.cdr])
+        elif type(w_obj) is W_Fexpr:
+            self.write_byte(TAG_FEXPR)
+            self.write_refs([w_obj.env_param, w_obj.params, w_obj.static_env, w_obj.body])
+        elif type(w_obj) is W_Applicative:
+            self.write_byte(TAG_APPLICATIVE)
+            self.write_refs([w_obj.w_operative])
+        elif type(w_obj) is W_Vector:
+            self.write_byte(TAG_VECTOR)
+            self.write_varint(len(w_obj.items_w))
+            self.write_refs(w_obj.items_w)
+        else:
+            raise QuoppaException("cannot save %s in an image" % w_obj.to_repr())
+
+
+class ImageReader(object):
+    def __init__(self, runtime, data):
+        self.builtins_w = builtin_objects(runtime)
+        self.data = data
+        self.pos = 0
+        self.objects_w = []
+        self.tags = []
+        self.refs = []
+        self.building = []
+
+    def read_byte(self):
+        if self.pos >= len(self.data):
+            raise QuoppaException("truncated image")
+        byte = ord(self.data[self.pos])
+        self.pos += 1
+        return byte
+
+    def read_varint(self):
+        value = 0
+        shift = 0
+        while True:
+            byte = self.read_byte()
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def read_int64(self):
+        value = 0
+        for i in range(8):
+            value |= self.read_byte() << (i * 8)
+        return intmask(value)
+
+    def read_str(self):
+        length = self.read_varint()
+        start = self.pos
+        end = start + length
+        if end > len(self.data):
+            raise QuoppaException("truncated image")
+        self.pos = end
+        assert start >= 0 and end >= 0
+        return self.data[start:end]
+
+    def read_refs(self, count):
+        refs = [0] * count
+        for i in range(count):
+            refs[i] = self.read_varint()
+        return refs
+
+    def load(self):
+        if not self.data.startswith(MAGIC):
+            raise QuoppaException("not a qoppy image")
+        self.pos = len(MAGIC)
+        count = self.read_varint()
+        for i in range(count):
+            tag = self.read_byte()
+            self.tags.append(tag)
+            self.refs.append(None)
+            self.building.append(False)
+            self.objects_w.append(self.read_object(i, tag))
+        for i in range(count):
+            self.build(i)
+        for i in range(count):
+            w_obj = self.objects_w[i]
+            if self.refs[i] is not None and isinstance(w_obj, W_List):
+                refs = self.refs[i]
+                w_obj.car = self.objects_w[refs[0]]
+                w_obj.cdr = self.objects_w[refs[1]]
+            elif self.refs[i] is not None and isinstance(w_obj, W_Vector):
+                for j in range(len(w_obj.items_w)):
+                    w_obj.items_w[j] = self.objects_w[self.refs[i][j]]
+        return self.objects_w[0]
+
+    def read_object(self, i, tag):
+        if tag == TAG_NIL:
+            return w_nil
+        elif tag == TAG_TRUE:
+            return w_true
+        elif tag == TAG_FALSE:
+            return w_false
+        elif tag == TAG_UNDEFINED:
+            return w_undefined
+        elif tag == TAG_EOF:
+            return w_eof
+        elif tag == TAG_BUILTIN:
+            name = self.read_str()
+            w_obj = self.builtins_w.get(name, None)
+            if w_obj is None:
+                raise QuoppaException("image refers to %s, which this runtime lacks" % name)
+            return w_obj
+        elif tag == TAG_SYMBOL:
+            return intern_symbol(self.read_str())
+        elif tag == TAG_INTEGER:
+            return w_integer(self.read_int64())
+        elif tag == TAG_BIGINT:
+            return W_BigInteger(rbigint.fromdecimalstr(self.read_str()))
+        elif tag == TAG_REAL:
+            return W_Real(longlong2float(r_longlong(self.read_int64())))
+        elif tag == TAG_STRING:
+            return W_String(self.read_str())
+        elif tag == TAG_PAIR:
+            self.refs[i] = self.read_refs(2)
+            return W_List(w_nil, w_nil)
+        elif tag == TAG_BINDING:
+            self.refs[i] = self.read_refs(2)
+            return W_Binding(w_nil, w_nil)
+        elif tag == TAG_FRAME:
+            self.refs[i] = self.read_refs(2)
+            return W_Frame(w_nil, w_nil)
+        elif tag == TAG_FEXPR:
+            self.refs[i] = self.read_refs(4)
+            return None
+        elif tag == TAG_APPLICATIVE:
+            self.refs[i] = self.read_refs(1)
+            return None
+        elif tag == TAG_VECTOR:
+            count = self.read_varint()
+            self.refs[i] = self.read_refs(count)
+            return W_Vector([w_nil] * count)
+        raise QuoppaException("bad image record %d" % tag)
+
+    def build(self, i):
+        # makes the fexpr or applicative of record i after what it refers to
+        if self.objects_w[i] is not None:
+            return self.objects_w[i]
+        if self.building[i]:
+            raise QuoppaException("bad image, record %d refers to itself" % i)
+        self.building[i] = True
+        refs = self.refs[i]
+        refs_w = [self.build(ref) for ref in refs]
+        if self.tags[i] == TAG_FEXPR:
+            w_obj = W_Fexpr(refs_w[0], refs_w[1], refs_w[2], refs_w[3])
+        else:
+            w_obj = W_Applicative(refs_w[0])
+        self.objects_w[i] = w_obj
+        return w_obj
+
+
+def save_image(runtime):
+    return ImageWriter(runtime).save(runtime.global_env.car)
+
+
+def load_image(runtime, data):
+    w_frame = ImageReader(runtime, data).load()
+    # set-car! lets the lookup caches know the global frame changed
+    runtime.global_env.set_car(w_frame)
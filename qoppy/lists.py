@@ -0,0 +1,144 @@
+from execution_model import (W_List, W_Integer, QuoppaException, ListBuilder,
+                             w_nil, w_false, w_integer, variadic)
+
+
+# List primitives that walk their arguments in a loop instead of recursing,
+# so they run in constant stack on long lists. Arguments that are walked to
+# the end are checked up front for being proper, non-circular lists.
+
+def proper_length(w_lst, name):
+    # Floyd's cycle detection, w_fast moves two cells per cell of w_slow
+    length = 0
+    w_slow = w_lst
+    w_fast = w_lst
+    while True:
+        for i in range(2):
+            if w_fast.is_nil():
+                return length
+            if not isinstance(w_fast, W_List):
+                raise QuoppaException("wrong type argument %s for %s" % (
+                    w_fast.to_string(), name))
+            w_fast = w_fast.cdr
+            length += 1
+        assert isinstance(w_slow, W_List)
+        w_slow = w_slow.cdr
+        if w_fast is w_slow and not w_fast.is_nil():
+            raise QuoppaException("circular list passed to %s" % name)
+
+def index_argument(w_k, name):
+    if not isinstance(w_k, W_Integer) or w_k.intval < 0:
+        raise QuoppaException("wrong type argument %s for %s" % (w_k.to_string(), name))
+    return w_k.intval
+
+def length(w_lst):
+    return w_integer(proper_length(w_lst, "length"))
+
+def reverse(w_lst):
+    proper_length(w_lst, "reverse")
+    w_res = w_nil
+    while not w_lst.is_nil():
+        assert isinstance(w_lst, W_List)
+        w_res = W_List(w_lst.car, w_res)
+        w_lst = w_lst.cdr
+    return w_res
+
+def drop(w_lst, k, name):
+    # k is a bound on the walk, so circular lists need no check here
+    for i in range(k):
+        if not isinstance(w_lst, W_List) or w_lst.is_nil():
+            raise QuoppaException("index %d too large for %s" % (k, name))
+        w_lst = w_lst.cdr
+    return w_lst
+
+def list_tail(w_lst, w_k):
+    return drop(w_lst, index_argument(w_k, "list-tail"), "list-tail")
+
+def list_ref(w_lst, w_k):
+    k = index_argument(w_k, "list-ref")
+    w_tail = drop(w_lst, k, "list-ref")
+    if not isinstance(w_tail, W_List) or w_tail.is_nil():
+        raise QuoppaException("index %d too large for list-ref" % k)
+    return w_tail.car
+
+def memq(w_obj, w_lst):
+    proper_length(w_lst, "memq")
+    while not w_lst.is_nil():
+        assert isinstance(w_lst, W_List)
+        if w_obj.eqv(w_lst.car):
+            return w_lst
+        w_lst = w_lst.cdr
+    return w_false
+
+def member(w_obj, w_lst):
+    proper_length(w_lst, "member")
+    while not w_lst.is_nil():
+        assert isinstance(w_lst, W_List)
+        if w_obj.equal(w_lst.car):
+            return w_lst
+        w_lst = w_lst.cdr
+    return w_false
+
+def alist_pair(w_pair, name):
+    if not isinstance(w_pair, W_List) or w_pair.is_nil():
+        raise QuoppaException("wrong type argument %s for %s" % (w_pair.to_string(), name))
+    return w_pair
+
+def assq(w_key, w_alist):
+    proper_length(w_alist, "assq")
+    while not w_alist.is_nil():
+        assert isinstance(w_alist, W_List)
+        w_pair = alist_pair(w_alist.car, "assq")
+        if w_key.eqv(w_pair.car):
+            return w_pair
+        w_alist = w_alist.cdr
+    return w_false
+
+def assoc(w_key, w_alist):
+    proper_length(w_alist, "assoc")
+    while not w_alist.is_nil():
+        assert isinstance(w_alist, W_List)
+        w_pair = alist_pair(w_alist.car, "assoc")
+        if w_key.equal(w_pair.car):
+            return w_pair
+        w_alist = w_alist.cdr
+    return w_false
+
+@variadic
+def append(args_w):
+    # copies all lists but the last one, which is shared
+    if not args_w:
+        return w_nil
+    builder = ListBuilder()
+    for i in range(len(args_w) - 1):
+        proper_length(args_w[i], "append")
+        builder.append_copy(args_w[i])
+    return builder.finish(args_w[len(args_w) - 1])
+
+@variadic
+def append_b(args_w):
+    # links the lists together in place, through set-cdr! so frame indexes
+    # and compiled code notice
+    w_res = w_nil
+    w_last = None
+    for i in range(len(args_w)):
+        w_lst = args_w[i]
+        if w_lst.is_nil():
+            continue
+        if w_last is not None:
+            w_last.set_cdr(w_lst)
+        else:
+            w_res = w_lst
+        if i < len(args_w) - 1:
+            proper_length(w_lst, "append!")
+            assert isinstance(w_lst, W_List)
+            while not w_lst.cdr.is_nil():
+                w_lst = w_lst.cdr
+                assert isinstance(w_lst, W_List)
+            w_last = w_lst
+    return w_res
+
+def list_copy(w_lst):
+    proper_length(w_lst, "list-copy")
+    builder = ListBuilder()
+    builder.append_copy(w_lst)
+    return builder.finish()
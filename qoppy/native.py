@@ -0,0 +1,460 @@
+import os
+
+from pypy.rlib.objectmodel import specialize
+
+from parser import parse
+from execution_model import (W_Object, W_List, W_Fexpr, W_BasePrimitive,
+                             W_PrimitiveCall, W_VariadicPrimitive,
+                             W_Applicative, W_Wrap, QuoppaException, ListBuilder,
+                             symbol, w_nil, w_true, w_false, w_list,
+                             variadic, instruction)
+
+
+# Python versions of the forms prelude.qop defines. The runtime evaluates
+# these instead of a top-level define or set! that is the same as the one in
+# prelude.qop, any other definition of these names is left alone. wrap is
+# always swapped, the others only in native prelude mode.
+
+PRELUDE_PATH = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "prelude.qop")
+
+PRELUDE = open(PRELUDE_PATH).read()
+
+w_define = symbol("define")
+w_set = symbol("set!")
+w_else = symbol("else")
+w_lambda = symbol("lambda")
+w_begin = symbol("begin")
+w_quote = symbol("quote")
+w_underscore = symbol("_")
+
+
+def fixed_operands(w_operands, count):
+    args_w = []
+    while not w_operands.is_nil():
+        if not isinstance(w_operands, W_List) or len(args_w) == count:
+            raise QuoppaException("too many arguments")
+        args_w.append(w_operands.car)
+        w_operands = w_operands.cdr
+    if len(args_w) < count:
+        raise QuoppaException("too few arguments")
+    return args_w
+
+
+def list_items(w_lst):
+    items_w = []
+    while not w_lst.is_nil():
+        if not isinstance(w_lst, W_List):
+            raise QuoppaException("wrong type argument %s for car" % w_lst.to_string())
+        items_w.append(w_lst.car)
+        w_lst = w_lst.cdr
+    return items_w
+
+
+def fexpr_argument(w_obj):
+    if not isinstance(w_obj, W_Fexpr):
+        raise QuoppaException("cannot call %s" % w_obj.to_string())
+    return w_obj
+
+
+class W_NativeOperative(W_Fexpr):
+    # gets its operands unevaluated, like a vau
+    __slots__ = ["name"]
+
+    def __init__(self, name):
+        self.name = name
+
+    def to_string(self):
+        return '#<an fexpr>'
+    to_repr = to_string
+
+
+class W_NativeCall(W_PrimitiveCall):
+    __slots__ = []
+
+    def compile(self, runtime, machine):
+        w_native = self.w_primitive
+        assert isinstance(w_native, W_Native)
+        w_native.call(runtime, machine)
+
+
+class W_Native(W_BasePrimitive):
+    # an applicative that needs the machine, e.g. to call a fexpr it got as
+    # an argument. call() finds the evaluated operands on the value stack
+    __slots__ = ["name"]
+    CallClass = W_NativeCall
+
+    def __init__(self, name, arg_count):
+        W_BasePrimitive.__init__(self, arg_count)
+        self.name = name
+
+    def call_instruction_for(self, argcount):
+        if argcount < self.arg_count:
+            raise QuoppaException("too few arguments")
+        elif argcount > self.arg_count:
+            raise QuoppaException("too many arguments")
+        return self.call_instruction
+
+    def call(self, runtime, machine):
+        raise NotImplementedError
+
+    def to_string(self):
+        return '#<an fexpr>'
+    to_repr = to_string
+
+
+class W_NativeVariadic(W_VariadicPrimitive):
+    __slots__ = []
+
+    def to_string(self):
+        return '#<an fexpr>'
+    to_repr = to_string
+
+
+class W_Select(W_Object):
+    __slots__ = []
+
+    def compile(self, runtime, machine):
+        w_b = machine.stack.pop()
+        w_t = machine.stack.pop()
+        w_f = machine.stack.pop()
+        if w_b.to_boolean():
+            machine.operand_stack.push(instruction(w_t))
+        else:
+            machine.operand_stack.push(instruction(w_f))
+
+    def to_repr(self):
+        return "#<select>"
+
+w_select = W_Select()
+
+
+class W_If(W_NativeOperative):
+    __slots__ = []
+
+    def compile(self, runtime, machine):
+        args_w = fixed_operands(machine.stack.pop(), 3)
+        machine.stack.push(args_w[2])
+        machine.stack.push(args_w[1])
+        machine.operand_stack.push(w_select)
+        machine.operand_stack.push(instruction(args_w[0]))
+
+
+class W_AndOrNext(W_Object):
+    __slots__ = ["w_and_or"]
+    _immutable_fields_ = ["w_and_or"]
+
+    def __init__(self, w_and_or):
+        self.w_and_or = w_and_or
+
+    def compile(self, runtime, machine):
+        w_value = machine.stack.pop()
+        w_args = machine.stack.pop()
+        w_and_or = self.w_and_or
+        if w_value.to_boolean() == w_and_or.w_ident.to_boolean():
+            w_and_or.step(machine, w_args)
+        else:
+            machine.stack.push(w_and_or.w_other)
+
+    def to_repr(self):
+        return "#<%s>" % self.w_and_or.name
+
+
+class W_AndOr(W_NativeOperative):
+    __slots__ = ["w_ident", "w_other", "next_instruction"]
+    _immutable_fields_ = ["w_ident", "w_other", "next_instruction"]
+
+    def __init__(self, name, w_ident, w_other):
+        W_NativeOperative.__init__(self, name)
+        self.w_ident = w_ident
+        self.w_other = w_other
+        self.next_instruction = W_AndOrNext(self)
+
+    def compile(self, runtime, machine):
+        self.step(machine, machine.stack.pop())
+
+    def step(self, machine, w_args):
+        if w_args.is_nil():
+            machine.stack.push(self.w_ident)
+            return
+        if not isinstance(w_args, W_List):
+            raise QuoppaException("wrong type argument %s for car" % w_args.to_string())
+        machine.stack.push(w_args.cdr)
+        machine.operand_stack.push(self.next_instruction)
+        machine.operand_stack.push(instruction(w_args.car))
+
+
+def cond_step(machine, w_alts):
+    if w_alts.is_nil():
+        machine.stack.push(w_false)
+        return
+    if not isinstance(w_alts, W_List):
+        raise QuoppaException("can't bind ((test body) . rest) %s" % w_alts.to_string())
+    args_w = fixed_operands(w_alts.car, 2)
+    if args_w[0] is w_else:
+        machine.operand_stack.push(instruction(args_w[1]))
+        return
+    machine.stack.push(w_alts.cdr)
+    machine.stack.push(args_w[1])
+    machine.operand_stack.push(w_cond_next)
+    machine.operand_stack.push(instruction(args_w[0]))
+
+
+class W_CondNext(W_Object):
+    __slots__ = []
+
+    def compile(self, runtime, machine):
+        w_test = machine.stack.pop()
+        w_body = machine.stack.pop()
+        w_alts = machine.stack.pop()
+        if w_test.to_boolean():
+            machine.operand_stack.push(instruction(w_body))
+        else:
+            cond_step(machine, w_alts)
+
+    def to_repr(self):
+        return "#<cond>"
+
+w_cond_next = W_CondNext()
+
+
+class W_Cond(W_NativeOperative):
+    __slots__ = []
+
+    def compile(self, runtime, machine):
+        cond_step(machine, machine.stack.pop())
+
+
+class W_Let(W_NativeOperative):
+    # rewrites to ((lambda names . body) . inits) like the prelude does
+    __slots__ = []
+
+    def compile(self, runtime, machine):
+        w_operands = machine.stack.pop()
+        if not isinstance(w_operands, W_List) or w_operands.is_nil():
+            raise QuoppaException("too few arguments")
+        names = ListBuilder()
+        inits = ListBuilder()
+        for w_bind in list_items(w_operands.car):
+            if not isinstance(w_bind, W_List) or w_bind.is_nil():
+                raise QuoppaException("wrong type argument %s for car" % w_bind.to_string())
+            w_rest = w_bind.cdr
+            if not isinstance(w_rest, W_List) or w_rest.is_nil():
+                raise QuoppaException("wrong type argument %s for car" % w_rest.to_string())
+            names.append(w_bind.car)
+            inits.append(w_rest.car)
+        w_fun = W_List(runtime.global_value(w_lambda),
+                       W_List(names.finish(), w_operands.cdr))
+        machine.operand_stack.push(W_List(w_fun, inits.finish()))
+
+
+class W_Lambda(W_NativeOperative):
+    # the (params body) lambda first defined by the prelude, or with
+    # begin_body the (param . body) one it is then set! to
+    __slots__ = ["begin_body"]
+    _immutable_fields_ = ["begin_body"]
+
+    def __init__(self, name, begin_body):
+        W_NativeOperative.__init__(self, name)
+        self.begin_body = begin_body
+
+    def compile(self, runtime, machine):
+        w_operands = machine.stack.pop()
+        if self.begin_body:
+            if not isinstance(w_operands, W_List) or w_operands.is_nil():
+                raise QuoppaException("too few arguments")
+            w_params = w_operands.car
+            w_body = w_operands.cdr
+            if isinstance(w_body, W_List) and not w_body.is_nil() and w_body.cdr.is_nil():
+                w_body = w_body.car
+            else:
+                w_body = W_List(runtime.global_value(w_begin), w_body)
+        else:
+            args_w = fixed_operands(w_operands, 2)
+            w_params = args_w[0]
+            w_body = args_w[1]
+        w_operative = W_Fexpr(w_underscore, w_params,
+                              machine.env_stack.top(), w_body)
+        machine.stack.push(W_Applicative(w_operative))
+
+
+@variadic
+def m_list(args_w):
+    return w_list(args_w)
+
+@variadic
+def begin(args_w):
+    if not args_w:
+        raise QuoppaException("wrong type argument () for cdr")
+    return args_w[len(args_w) - 1]
+
+native_list = W_NativeVariadic(m_list)
+native_begin = W_NativeVariadic(begin)
+
+
+class W_MapLoop(W_Object):
+    __slots__ = ["w_f", "w_xs", "results", "started"]
+
+    def __init__(self, w_f, w_xs):
+        self.w_f = w_f
+        self.w_xs = w_xs
+        self.results = ListBuilder()
+        self.started = False
+
+    def compile(self, runtime, machine):
+        if self.started:
+            self.results.append(machine.stack.pop())
+        self.started = True
+        w_xs = self.w_xs
+        if w_xs.is_nil():
+            machine.stack.push(self.results.finish())
+            return
+        if not isinstance(w_xs, W_List):
+            raise QuoppaException("wrong type argument %s for car" % w_xs.to_string())
+        self.w_xs = w_xs.cdr
+        machine.operand_stack.push(self)
+        self.w_f.call_with_values(machine, [w_xs.car])
+
+    def to_repr(self):
+        return "#<map>"
+
+
+class W_FoldrLoop(W_Object):
+    # the accumulator is on the value stack between the calls of f
+    __slots__ = ["w_f", "items_w", "index"]
+
+    def __init__(self, w_f, items_w):
+        self.w_f = w_f
+        self.items_w = items_w
+        self.index = len(items_w)
+
+    def compile(self, runtime, machine):
+        w_acc = machine.stack.pop()
+        if self.index == 0:
+            machine.stack.push(w_acc)
+            return
+        self.index -= 1
+        machine.operand_stack.push(self)
+        self.w_f.call_with_values(machine, [self.items_w[self.index], w_acc])
+
+    def to_repr(self):
+        return "#<foldr>"
+
+
+def operate_prelude_body(runtime, machine, w_names, args_w, w_body):
+    # operatives get the unevaluated operands, so they are called the way
+    # the prelude definition would call them
+    env = W_List(runtime.bind(w_names, w_list(args_w)), runtime.global_env)
+    machine.push_frame(env)
+    machine.operand_stack.push(w_body)
+
+
+MAP_NAMES = parse("(f xs)")[0]
+MAP_BODY = parse("(cons (f (car xs)) (map f (cdr xs)))")[0]
+
+class W_Map(W_Native):
+    __slots__ = []
+
+    def call(self, runtime, machine):
+        w_xs = machine.stack.pop()
+        w_f = fexpr_argument(machine.stack.pop())
+        if w_f.takes_values():
+            machine.operand_stack.push(W_MapLoop(w_f, w_xs))
+        elif w_xs.is_nil():
+            machine.stack.push(w_nil)
+        else:
+            operate_prelude_body(runtime, machine, MAP_NAMES, [w_f, w_xs], MAP_BODY)
+
+
+FOLDR_NAMES = parse("(f z xs)")[0]
+FOLDR_BODY = parse("(f (car xs) (foldr f z (cdr xs)))")[0]
+
+class W_Foldr(W_Native):
+    __slots__ = []
+
+    def call(self, runtime, machine):
+        w_xs = machine.stack.pop()
+        w_z = machine.stack.pop()
+        w_f = fexpr_argument(machine.stack.pop())
+        if w_f.takes_values():
+            machine.stack.push(w_z)
+            machine.operand_stack.push(W_FoldrLoop(w_f, list_items(w_xs)))
+        elif w_xs.is_nil():
+            machine.stack.push(w_z)
+        else:
+            operate_prelude_body(runtime, machine, FOLDR_NAMES, [w_f, w_z, w_xs], FOLDR_BODY)
+
+
+class W_Apply(W_Native):
+    __slots__ = []
+
+    def call(self, runtime, machine):
+        args_w = list_items(machine.stack.pop())
+        w_operative = fexpr_argument(machine.stack.pop())
+        if w_operative.takes_values():
+            w_operative.call_with_values(machine, args_w)
+            return
+        w_quote_value = runtime.global_value(w_quote)
+        operands = ListBuilder()
+        for w_arg in args_w:
+            operands.append(w_list([w_quote_value, w_arg]))
+        machine.stack.push(operands.finish())
+        machine.operand_stack.push(w_operative)
+
+
+class NativeForm(object):
+    def __init__(self, w_form, w_replacement):
+        self.w_form = w_form
+        self.w_replacement = w_replacement
+
+
+def defined_name(w_form):
+    # the name a top-level (define name ...), (define (name . params) ...)
+    # or (set! name ...) binds, or None
+    if not isinstance(w_form, W_List) or w_form.is_nil():
+        return None
+    if w_form.car is not w_define and w_form.car is not w_set:
+        return None
+    w_rest = w_form.cdr
+    if not isinstance(w_rest, W_List) or w_rest.is_nil():
+        return None
+    w_name = w_rest.car
+    if isinstance(w_name, W_List) and not w_name.is_nil():
+        w_name = w_name.car
+    return w_name
+
+
+CORE_NATIVES = ["wrap"]
+
+@specialize.memo()
+def native_prelude_forms(native_prelude):
+    natives = {
+        "if": W_If("if"),
+        "list": native_list,
+        "wrap": W_Wrap(),
+        "begin": native_begin,
+        "map": W_Map("map", 2),
+        "let": W_Let("let"),
+        "or": W_AndOr("or", w_false, w_true),
+        "and": W_AndOr("and", w_true, w_false),
+        "cond": W_Cond("cond"),
+        "foldr": W_Foldr("foldr", 3),
+        "apply": W_Apply("apply", 2),
+    }
+    forms = []
+    for w_form in parse(PRELUDE):
+        w_name = defined_name(w_form)
+        if w_name is None:
+            continue
+        name = w_name.to_string()
+        if not native_prelude and name not in CORE_NATIVES:
+            continue
+        elif name == "lambda":
+            w_native = W_Lambda("lambda", w_form.car is w_set)
+        elif name in natives:
+            w_native = natives[name]
+        else:
+            continue
+        w_replacement = w_list([w_form.car, w_name, w_native])
+        forms.append(NativeForm(w_form, w_replacement))
+    return forms
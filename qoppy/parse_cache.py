@@ -0,0 +1,275 @@
+import os
+
+from pypy.rlib.rarithmetic import r_uint, r_longlong, intmask
+from pypy.rlib.streamio import open_file_as_stream
+
+from pypy.rlib.longlong2float import float2longlong, longlong2float
+from pypy.rlib.rbigint import rbigint
+
+from execution_model import (W_List, W_Symbol, W_Integer, W_BigInteger,
+                             W_Real, W_String, W_Vector, QuoppaException,
+                             ListBuilder,
+                             intern_symbol, w_integer, w_nil, w_true, w_false)
+from image import ImageWriter, ImageReader
+from parser import parse
+
+
+# Parsed source is cached in a .qopc file, next to the source or in a cache
+# directory. The cache is used only while its key matches, a hash of the
+# source and the format version, so an edited source or a new reader makes
+# it parse again.
+#
+# The forms are a tree, so unlike a heap image they are written in prefix
+# order: a list is its length, its elements and its tail, a vector is its
+# length and its items, and symbols are indexes into a table written up
+# front. Reading them back keeps open lists and vectors on a stack, like the
+# reader does.
+
+# bump when the reader or the encoding change
+FORMAT_VERSION = "2"
+MAGIC = "QOPC\n"
+
+TAG_NIL = 0
+TAG_TRUE = 1
+TAG_FALSE = 2
+TAG_SYMBOL = 3
+TAG_INTEGER = 4
+TAG_BIGINT = 5
+TAG_REAL = 6
+TAG_STRING = 7
+TAG_LIST = 8
+TAG_VECTOR = 9
+
+FNV_OFFSET_BASIS = r_uint(0xcbf29ce484222325)
+FNV_PRIME = r_uint(0x100000001b3)
+
+
+def source_hash(source):
+    # 64 bit FNV-1a, a single pass that is cheap next to parsing
+    h = FNV_OFFSET_BASIS
+    for ch in source:
+        h = (h ^ r_uint(ord(ch))) * FNV_PRIME
+    return intmask(h)
+
+
+class FormWriter(ImageWriter):
+    def __init__(self):
+        self.symbols = {}
+        self.symbol_names = []
+        self.out = []
+
+    def write_int(self, value):
+        # zigzag, so small negative numbers stay short too
+        self.write_varint(intmask((r_uint(value) << 1) ^ r_uint(value >> 63)))
+
+    def encode(self, forms_w):
+        stack = []
+        for i in range(len(forms_w) - 1, -1, -1):
+            stack.append(forms_w[i])
+        while stack:
+            w_obj = stack.pop()
+            if isinstance(w_obj, W_List) and not w_obj.is_nil():
+                items_w = []
+                w_rest = w_obj
+                while isinstance(w_rest, W_List) and not w_rest.is_nil():
+                    items_w.append(w_rest.car)
+                    w_rest = w_rest.cdr
+                self.write_byte(TAG_LIST)
+                self.write_varint(len(items_w))
+                stack.append(w_rest)
+                for i in range(len(items_w) - 1, -1, -1):
+                    stack.append(items_w[i])
+            elif isinstance(w_obj, W_Vector):
+                self.write_byte(TAG_VECTOR)
+                self.write_varint(len(w_obj.items_w))
+                for i in range(len(w_obj.items_w) - 1, -1, -1):
+                    stack.append(w_obj.items_w[i])
+            else:
+                self.write_atom(w_obj)
+        body = self.out
+        self.out = []
+        self.write_varint(len(self.symbol_names))
+        for name in self.symbol_names:
+            self.write_str(name)
+        self.write_varint(len(forms_w))
+        return "".join(self.out) + "".join(body)
+
+    def write_atom(self, w_obj):
+        if w_obj is w_nil:
+            self.write_byte(TAG_NIL)
+        elif w_obj is w_true:
+            self.write_byte(TAG_TRUE)
+        elif w_obj is w_false:
+            self.write_byte(TAG_FALSE)
+        elif isinstance(w_obj, W_Symbol):
+            index = self.symbols.get(w_obj.name, -1)
+            if index == -1:
+                index = len(self.symbol_names)
+                self.symbols[w_obj.name] = index
+                self.symbol_names.append(w_obj.name)
+            self.write_byte(TAG_SYMBOL)
+            self.write_varint(index)
+        elif isinstance(w_obj, W_Integer):
+            self.write_byte(TAG_INTEGER)
+            self.write_int(w_obj.intval)
+        elif isinstance(w_obj, W_BigInteger):
+            self.write_byte(TAG_BIGINT)
+            self.write_str(w_obj.bigval.str())
+        elif isinstance(w_obj, W_Real):
+            self.write_byte(TAG_REAL)
+            self.write_int64(intmask(float2longlong(w_obj.realval)))
+        elif isinstance(w_obj, W_String):
+            self.write_byte(TAG_STRING)
+            self.write_str(w_obj.to_string())
+        else:
+            raise QuoppaException("cannot cache %s" % w_obj.to_repr())
+
+
+class OpenList(object):
+    def __init__(self, remaining, vector=False):
+        self.builder = ListBuilder()
+        self.items_w = []
+        self.remaining = remaining
+        # a vector has no tail, it is complete after its last item
+        self.vector = vector
+
+    def finish(self, w_tail):
+        if self.vector:
+            return W_Vector(self.items_w)
+        return self.builder.finish(w_tail)
+
+
+class FormReader(ImageReader):
+    def __init__(self, data, pos):
+        self.data = data
+        self.pos = pos
+
+    def read_int(self):
+        value = r_uint(self.read_varint())
+        return intmask((value >> 1) ^ (-(value & 1)))
+
+    def decode(self):
+        symbols_w = []
+        for i in range(self.read_varint()):
+            symbols_w.append(intern_symbol(self.read_str()))
+        forms_w = []
+        count = self.read_varint()
+        stack = []
+        while len(forms_w) < count:
+            tag = self.read_byte()
+            if tag == TAG_LIST:
+                stack.append(OpenList(self.read_varint()))
+                continue
+            elif tag == TAG_VECTOR:
+                remaining = self.read_varint()
+                if remaining > 0:
+                    stack.append(OpenList(remaining, vector=True))
+                    continue
+                w_obj = W_Vector([])
+            elif tag == TAG_NIL:
+                w_obj = w_nil
+            elif tag == TAG_TRUE:
+                w_obj = w_true
+            elif tag == TAG_FALSE:
+                w_obj = w_false
+            elif tag == TAG_SYMBOL:
+                index = self.read_varint()
+                if index >= len(symbols_w):
+                    raise QuoppaException("bad symbol in cache")
+                w_obj = symbols_w[index]
+            elif tag == TAG_INTEGER:
+                w_obj = w_integer(self.read_int())
+            elif tag == TAG_BIGINT:
+                w_obj = W_BigInteger(rbigint.fromdecimalstr(self.read_str()))
+            elif tag == TAG_REAL:
+                w_obj = W_Real(longlong2float(r_longlong(self.read_int64())))
+            elif tag == TAG_STRING:
+                w_obj = W_String(self.read_str())
+            else:
+                raise QuoppaException("bad cache record %d" % tag)
+            # a datum is complete, the last one of a list is its tail
+            while stack:
+                open_list = stack[-1]
+                if open_list.vector:
+                    open_list.items_w.append(w_obj)
+                    open_list.remaining -= 1
+                    if open_list.remaining > 0:
+                        break
+                elif open_list.remaining > 0:
+                    open_list.builder.append(w_obj)
+                    open_list.remaining -= 1
+                    break
+                stack.pop()
+                w_obj = open_list.finish(w_obj)
+            if not stack:
+                forms_w.append(w_obj)
+        return forms_w
+
+
+class ParseCacheStats(object):
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.failed_writes = 0
+
+    def to_string(self):
+        return "parse cache: %d hits, %d misses, %d failed writes" % (
+            self.hits, self.misses, self.failed_writes)
+
+
+class ParseCache(object):
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.stats = ParseCacheStats()
+
+    def cache_path(self, filename):
+        if self.cache_dir is None:
+            return filename + "c"
+        start = filename.rfind("/") + 1
+        assert start >= 0
+        return self.cache_dir + "/" + filename[start:] + "c"
+
+    def parse_file(self, filename, source):
+        key = MAGIC + FORMAT_VERSION + ":" + str(source_hash(source)) + "\n"
+        path = self.cache_path(filename)
+        data = read_file(path)
+        if data is not None and data.startswith(key):
+            try:
+                forms_w = FormReader(data, len(key)).decode()
+            except QuoppaException:
+                forms_w = None
+            if forms_w is not None:
+                self.stats.hits += 1
+                return forms_w
+        self.stats.misses += 1
+        forms_w = parse(source)
+        try:
+            write_file(path, key + FormWriter().encode(forms_w))
+        except OSError:
+            # a read-only source tree just doesn't get cached
+            self.stats.failed_writes += 1
+        return forms_w
+
+
+def read_file(path):
+    try:
+        stream = open_file_as_stream(path)
+    except OSError:
+        return None
+    try:
+        return stream.readall()
+    finally:
+        stream.close()
+
+
+def write_file(path, data):
+    # written aside and renamed, so a concurrent run never sees half a file
+    tmp_path = path + ".tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+    try:
+        while data:
+            written = os.write(fd, data)
+            data = data[written:]
+    finally:
+        os.close(fd)
+    os.rename(tmp_path, path)
@@ -1,8 +1,11 @@
 from pypy.rlib.parsing.pypackrat import PackratParser
 from pypy.rlib.parsing.makepackrat import BacktrackException, Status
+from pypy.rlib.rbigint import rbigint
 
-from execution_model import (W_List, W_Integer, W_Real, W_String, w_nil,
-                             symbol, w_true, w_false, QuoppaException)
+from execution_model import (W_List, W_Integer, W_Real, W_String, W_Vector, w_nil,
+                             w_bigint,
+                             symbol, w_true, w_false, QuoppaException, w_list)
+from reader import read_all
 
 def str_unquote(s):
     str_lst = []
@@ -51,7 +54,7 @@ class QuoppaParser(PackratParser):
     FIXNUM:
         c = `\-?(0|([1-9][0-9]*))`
         IGNORE*
-        return {W_Integer(int(c))};
+        return {w_bigint(rbigint.fromdecimalstr(c))};
 
     FLOAT:
         c = `\-?([0-9]*\.[0-9]+|[0-9]+\.[0-9]*)`
@@ -98,6 +101,7 @@ class QuoppaParser(PackratParser):
     
     sexpr:
         list
+      | vector
       | quote
       | qq
       | unquote_splicing
@@ -113,24 +117,33 @@ class QuoppaParser(PackratParser):
     list:
         '('
         IGNORE*
-        p = pair
+        cars = sexpr*
+        cdr = dotted
         ')'
         IGNORE*
-        return {p};
+        return {w_list(cars, cdr)};
 
-    pair:
-        car = sexpr
+    vector:
+        '#('
+        IGNORE*
+        items = sexpr*
+        ')'
+        IGNORE*
+        return {W_Vector(items)};
+
+    dotted:
         '.'
         IGNORE*
         cdr = sexpr
-        return {W_List(car, cdr)}
-      | car = sexpr
-        cdr = pair
-        return {W_List(car, cdr)}
+        return {cdr}
       | return {w_nil};
     """
 
 def parse(code):
+    return read_all(code)
+
+def parse_packrat(code):
+    # the grammar above, kept as the reference the reader is tested against
     p = QuoppaParser(code)
     # p.init_parser(code)
     return p.file()
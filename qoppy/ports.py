@@ -0,0 +1,189 @@
+import os
+
+from pypy.rlib.streamio import open_file_as_stream
+
+from execution_model import W_Object, W_String, QuoppaException, w_eof
+from reader import Reader, IncompleteInput
+
+
+# Input is read a buffer at a time. read parses one datum from the buffer,
+# and when the datum runs past its end the next chunk is appended and the
+# datum is read again, the input before the datum is dropped then.
+#
+# Output is collected until OUTPUT_BUFFER_SIZE bytes are pending and then
+# written with one syscall. Runtime.execute flushes stdout when it returns
+# or raises.
+
+CHUNK_SIZE = 64 * 1024
+OUTPUT_BUFFER_SIZE = 64 * 1024
+
+
+class W_Port(W_Object):
+    __slots__ = ["filename", "closed"]
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.closed = False
+
+    def check_open(self):
+        if self.closed:
+            raise QuoppaException("%s is closed" % self.to_string())
+
+
+class W_InputPort(W_Port):
+    __slots__ = ["stream", "buffer", "pos", "at_eof", "line", "column"]
+
+    def __init__(self, filename):
+        W_Port.__init__(self, filename)
+        try:
+            self.stream = open_file_as_stream(filename)
+        except OSError:
+            raise QuoppaException("cannot open %s" % filename)
+        self.buffer = ""
+        self.pos = 0
+        self.at_eof = False
+        # line and column of the start of the buffer, for read errors
+        self.line = 1
+        self.column = 0
+
+    def to_string(self):
+        return "#<input-port %s>" % self.filename
+    to_repr = to_string
+
+    def fill(self):
+        # drops the consumed input and appends the next chunk, at least as
+        # much as is left so a datum larger than a chunk is read again only
+        # a logarithmic number of times
+        self.drop_consumed()
+        size = len(self.buffer)
+        if size < CHUNK_SIZE:
+            size = CHUNK_SIZE
+        chunk = self.stream.read(size)
+        if chunk:
+            self.buffer += chunk
+        else:
+            self.at_eof = True
+
+    def drop_consumed(self):
+        pos = self.pos
+        for i in range(pos):
+            if self.buffer[i] == "\n":
+                self.line += 1
+                self.column = 0
+            else:
+                self.column += 1
+        assert pos >= 0
+        self.buffer = self.buffer[pos:]
+        self.pos = 0
+
+    def read(self):
+        self.check_open()
+        while True:
+            reader = Reader(self.buffer, self.pos, self.at_eof, self.line, self.column)
+            try:
+                w_obj = reader.read()
+            except IncompleteInput:
+                self.fill()
+                continue
+            self.pos = reader.pos
+            if w_obj is None:
+                return w_eof
+            return w_obj
+
+    def peek_char(self):
+        self.check_open()
+        while self.pos >= len(self.buffer):
+            if self.at_eof:
+                return w_eof
+            self.fill()
+        return W_String(self.buffer[self.pos])
+
+    def read_char(self):
+        w_char = self.peek_char()
+        if w_char is not w_eof:
+            self.pos += 1
+        return w_char
+
+    def close(self):
+        if not self.closed:
+            self.stream.close()
+            self.closed = True
+
+
+class W_OutputPort(W_Port):
+    __slots__ = ["pieces", "size"]
+
+    def __init__(self, filename):
+        W_Port.__init__(self, filename)
+        self.pieces = []
+        self.size = 0
+
+    def to_string(self):
+        return "#<output-port %s>" % self.filename
+    to_repr = to_string
+
+    def write(self, s):
+        self.check_open()
+        self.pieces.append(s)
+        self.size += len(s)
+        if self.size >= OUTPUT_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+        self.closed = True
+
+
+class W_FileOutputPort(W_OutputPort):
+    __slots__ = ["fd"]
+
+    def __init__(self, fd, filename):
+        W_OutputPort.__init__(self, filename)
+        self.fd = fd
+
+    def flush(self):
+        if not self.pieces:
+            return
+        data = "".join(self.pieces)
+        self.pieces = []
+        self.size = 0
+        while data:
+            written = os.write(self.fd, data)
+            assert written >= 0
+            data = data[written:]
+
+    def close(self):
+        if not self.closed:
+            W_OutputPort.close(self)
+            if self.fd > 2:
+                os.close(self.fd)
+
+
+class W_StringOutputPort(W_OutputPort):
+    __slots__ = []
+
+    def __init__(self):
+        W_OutputPort.__init__(self, "string")
+
+    def write(self, s):
+        self.check_open()
+        self.pieces.append(s)
+
+    def get_string(self):
+        s = "".join(self.pieces)
+        self.pieces = [s]
+        return s
+
+
+def open_output_file(filename):
+    try:
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+    except OSError:
+        raise QuoppaException("cannot open %s" % filename)
+    return W_FileOutputPort(fd, filename)
+
+
+stdout = W_FileOutputPort(1, "stdout")
@@ -1,9 +1,12 @@
-import os
+from pypy.rlib.rarithmetic import ovfcheck
 
-from parser import parse
-from execution_model import (w_nil, w_true, w_false, w_eof, W_Real,
+import ports
+from ports import W_InputPort, W_OutputPort, W_StringOutputPort
+from execution_model import (w_nil, w_true, w_false, w_eof, W_Real, W_Number,
+                             W_Integer, w_integer, w_bigint, to_bigint,
+                             is_exact_integer, variadic,
                              W_Symbol, W_String, W_List, QuoppaException,
-                             W_Stream)
+                             W_Frame, W_Binding, is_binding)
 
 def m_bool(b, t, f):
     if b.to_boolean():
@@ -36,6 +39,11 @@ def pair_p(w_obj):
         return w_false
 
 def cons(w_car, w_cdr):
+    if isinstance(w_cdr, W_Frame) and is_binding(w_car):
+        return w_cdr.extend(w_car)
+    if isinstance(w_car, W_Symbol) and isinstance(w_cdr, W_List):
+        # may end up as the (name value) pair define puts into a frame
+        return W_Binding(w_car, w_cdr)
     return W_List(w_car, w_cdr)
 
 def car(w_pair):
@@ -52,61 +60,146 @@ def cdr(w_pair):
 
 def set_car_b(w_pair, w_val):
     if isinstance(w_pair, W_List) and not w_pair.is_nil():
-        w_pair.car = w_val
+        w_pair.set_car(w_val)
         return w_pair
     else:
         raise QuoppaException("wrong type argument %s for set-car!" % w_pair.to_string())
 
 def set_cdr_b(w_pair, w_val):
     if isinstance(w_pair, W_List) and not w_pair.is_nil():
-        w_pair.cdr = w_val
+        w_pair.set_cdr(w_val)
         return w_pair
     else:
         raise QuoppaException("wrong type argument %s for set-cdr!" % w_pair.to_string())
 
-def plus(a, b):
-    if isinstance(a, W_Real) and isinstance(b, W_Real):
-        return W_Real(a.to_number() + b.to_number())
-    else:
-        raise QuoppaException("cannot %s + %s" % (a.to_string(), b.to_string()))
+def add(a, b):
+    if isinstance(a, W_Integer) and isinstance(b, W_Integer):
+        try:
+            return w_integer(ovfcheck(a.intval + b.intval))
+        except OverflowError:
+            pass
+    if is_exact_integer(a) and is_exact_integer(b):
+        return w_bigint(to_bigint(a).add(to_bigint(b)))
+    if isinstance(a, W_Number) and isinstance(b, W_Number):
+        return W_Real(a.to_float() + b.to_float())
+    raise QuoppaException("cannot %s + %s" % (a.to_string(), b.to_string()))
 
-def times(a, b):
-    if isinstance(a, W_Real) and isinstance(b, W_Real):
-        return W_Real(a.to_number() * b.to_number())
-    else:
-        raise QuoppaException("cannot %s * %s" % (a.to_string(), b.to_string()))
+def sub(a, b):
+    if isinstance(a, W_Integer) and isinstance(b, W_Integer):
+        try:
+            return w_integer(ovfcheck(a.intval - b.intval))
+        except OverflowError:
+            pass
+    if is_exact_integer(a) and is_exact_integer(b):
+        return w_bigint(to_bigint(a).sub(to_bigint(b)))
+    if isinstance(a, W_Number) and isinstance(b, W_Number):
+        return W_Real(a.to_float() - b.to_float())
+    raise QuoppaException("cannot %s - %s" % (a.to_string(), b.to_string()))
 
-def minus(a, b):
-    if isinstance(a, W_Real) and isinstance(b, W_Real):
-        return W_Real(a.to_number() - b.to_number())
-    else:
-        raise QuoppaException("cannot %s - %s" % (a.to_string(), b.to_string()))
+def mul(a, b):
+    if isinstance(a, W_Integer) and isinstance(b, W_Integer):
+        try:
+            return w_integer(ovfcheck(a.intval * b.intval))
+        except OverflowError:
+            pass
+    if is_exact_integer(a) and is_exact_integer(b):
+        return w_bigint(to_bigint(a).mul(to_bigint(b)))
+    if isinstance(a, W_Number) and isinstance(b, W_Number):
+        return W_Real(a.to_float() * b.to_float())
+    raise QuoppaException("cannot %s * %s" % (a.to_string(), b.to_string()))
 
-def div(a, b):
-    if isinstance(a, W_Real) and isinstance(b, W_Real):
-        return W_Real(a.to_number() / b.to_number())
-    else:
-        raise QuoppaException("cannot %s / %s" % (a.to_string(), b.to_string()))
+@variadic
+def plus(args_w):
+    if len(args_w) == 2:
+        return add(args_w[0], args_w[1])
+    w_res = w_integer(0)
+    for w_arg in args_w:
+        w_res = add(w_res, w_arg)
+    return w_res
 
-def less_or_eq(a, b):
-    if isinstance(a, W_Real) and isinstance(b, W_Real):
-        if a.to_number() <= b.to_number():
-            return w_true
+@variadic
+def times(args_w):
+    if len(args_w) == 2:
+        return mul(args_w[0], args_w[1])
+    w_res = w_integer(1)
+    for w_arg in args_w:
+        w_res = mul(w_res, w_arg)
+    return w_res
+
+@variadic
+def minus(args_w):
+    if len(args_w) == 2:
+        return sub(args_w[0], args_w[1])
+    if not args_w:
+        raise QuoppaException("too few arguments to primitive")
+    if len(args_w) == 1:
+        return sub(w_integer(0), args_w[0])
+    w_res = args_w[0]
+    for i in range(1, len(args_w)):
+        w_res = sub(w_res, args_w[i])
+    return w_res
+
+def div(a, b):
+    # exact if the division is, otherwise a real
+    if is_exact_integer(a) and is_exact_integer(b):
+        if isinstance(b, W_Integer) and b.intval == 0:
+            raise QuoppaException("division by zero")
+        if isinstance(b, W_Integer) and b.intval == -1:
+            return sub(w_integer(0), a)
+        if isinstance(a, W_Integer) and isinstance(b, W_Integer):
+            if a.intval % b.intval == 0:
+                return w_integer(a.intval / b.intval)
         else:
-            return w_false
-    else:
-        raise QuoppaException("cannot %s <= %s" % (a.to_string(), b.to_string()))
+            quotient, remainder = to_bigint(a).divmod(to_bigint(b))
+            if remainder.sign == 0:
+                return w_bigint(quotient)
+    if isinstance(a, W_Number) and isinstance(b, W_Number):
+        if b.to_float() == 0.0:
+            raise QuoppaException("division by zero")
+        return W_Real(a.to_float() / b.to_float())
+    raise QuoppaException("cannot %s / %s" % (a.to_string(), b.to_string()))
 
-def eq(a, b):
-    if isinstance(a, W_Real) and isinstance(b, W_Real):
-        test = a.to_number() == b.to_number()
-    else:
-        test = a.equal(b)
+def compare(a, b, op):
+    # -1, 0 or 1 as a is less than, equal to or greater than b
+    if isinstance(a, W_Integer) and isinstance(b, W_Integer):
+        if a.intval < b.intval:
+            return -1
+        return int(a.intval > b.intval)
+    if is_exact_integer(a) and is_exact_integer(b):
+        big_a = to_bigint(a)
+        big_b = to_bigint(b)
+        if big_a.lt(big_b):
+            return -1
+        return int(big_b.lt(big_a))
+    if isinstance(a, W_Number) and isinstance(b, W_Number):
+        if a.to_float() < b.to_float():
+            return -1
+        return int(a.to_float() > b.to_float())
+    raise QuoppaException("cannot %s %s %s" % (a.to_string(), op, b.to_string()))
+
+def m_boolean(test):
     if test:
         return w_true
     else:
         return w_false
 
+def less(a, b):
+    return m_boolean(compare(a, b, "<") < 0)
+
+def less_or_eq(a, b):
+    return m_boolean(compare(a, b, "<=") <= 0)
+
+def greater(a, b):
+    return m_boolean(compare(a, b, ">") > 0)
+
+def greater_or_eq(a, b):
+    return m_boolean(compare(a, b, ">=") >= 0)
+
+def eq(a, b):
+    if isinstance(a, W_Number) and isinstance(b, W_Number):
+        return m_boolean(compare(a, b, "=") == 0)
+    return m_boolean(a.equal(b))
+
 def error(w_msg = None):
     if w_msg is None:
         msg = ""
@@ -114,20 +207,76 @@ def error(w_msg = None):
         msg = w_msg.to_string()
     raise QuoppaException(msg)
 
-def display(w_str):
-    os.write(1, w_str.to_string())
+def output_port(args_w, arg_count, name):
+    # the optional port argument following arg_count others
+    if len(args_w) < arg_count:
+        raise QuoppaException("too few arguments to %s" % name)
+    if len(args_w) > arg_count + 1:
+        raise QuoppaException("too many arguments to %s" % name)
+    if len(args_w) == arg_count:
+        return ports.stdout
+    w_port = args_w[arg_count]
+    if not isinstance(w_port, W_OutputPort):
+        raise QuoppaException("wrong type argument %s for %s" % (w_port.to_string(), name))
+    return w_port
+
+@variadic
+def display(args_w):
+    output_port(args_w, 1, "display").write(args_w[0].to_string())
     return w_nil
 
-def read(w_stream):
-    if isinstance(w_stream, W_Stream):
-        if w_stream.sexprs is None:
-            try:
-                w_stream.sexprs = parse(w_stream.contents)
-            except:
-                w_stream.sexprs = [W_String(w_stream.contents)]
-        return w_stream.next_sexpr()
-    else:
-        raise QuoppaException("cannot read from %r" % w_stream)
+@variadic
+def write(args_w):
+    output_port(args_w, 1, "write").write(args_w[0].to_repr())
+    return w_nil
+
+@variadic
+def newline(args_w):
+    output_port(args_w, 0, "newline").write("\n")
+    return w_nil
+
+@variadic
+def flush_output(args_w):
+    output_port(args_w, 0, "flush-output").flush()
+    return w_nil
+
+def current_output_port():
+    return ports.stdout
+
+def open_output_file(w_str):
+    return ports.open_output_file(w_str.to_string())
+
+def open_output_string():
+    return W_StringOutputPort()
+
+def get_output_string(w_port):
+    if not isinstance(w_port, W_StringOutputPort):
+        raise QuoppaException("wrong type argument %s for get-output-string" % w_port.to_string())
+    return W_String(w_port.get_string())
+
+def close_output_port(w_port):
+    if not isinstance(w_port, W_OutputPort):
+        raise QuoppaException("wrong type argument %s for close-output-port" % w_port.to_string())
+    w_port.close()
+    return w_nil
+
+def input_port(w_port, name):
+    if not isinstance(w_port, W_InputPort):
+        raise QuoppaException("wrong type argument %s for %s" % (w_port.to_string(), name))
+    return w_port
+
+def read(w_port):
+    return input_port(w_port, "read").read()
+
+def read_char(w_port):
+    return input_port(w_port, "read-char").read_char()
+
+def peek_char(w_port):
+    return input_port(w_port, "peek-char").peek_char()
+
+def close_input_port(w_port):
+    input_port(w_port, "close-input-port").close()
+    return w_nil
 
 def eof_object_p(w_obj):
     if w_obj is w_eof:
@@ -136,4 +285,4 @@ def eof_object_p(w_obj):
         return w_false
 
 def open_input_file(w_str):
-    return W_Stream(w_str.to_string())
+    return W_InputPort(w_str.to_string())
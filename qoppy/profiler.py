@@ -0,0 +1,359 @@
+import time
+
+from execution_model import W_List, W_Fexpr, W_CallEnv, symbol
+from reader import Reader
+
+
+# Profiles of qoppa code by fexpr. Every evaluation of a vau or lambda makes
+# a new fexpr, so fexprs are told apart by their body, which those share,
+# and named by a SourceMap after the define around them or the place of
+# their lambda or vau in the source.
+#
+# Profiler traces every call: a call starts when a W_Fexpr runs and ends
+# when the env stack is popped below the env it pushed. A tail call replaces
+# that env instead of pushing one, so it is counted as a callee of the call
+# it was made from, which lasts until the tail call returns. Steps are
+# counted in Runtime.steps, a call's steps include those of its callees,
+# its self steps don't.
+#
+# SamplingProfiler only looks at the env stack once every interval steps,
+# where the W_CallEnv of every call remembers its fexpr, so between samples
+# it costs a counter. It only sees the envs still on the stack, so a call
+# whose env a tail call replaced is gone from its samples.
+
+w_define = symbol("define")
+w_lambda = symbol("lambda")
+w_vau = symbol("vau")
+w_begin = symbol("begin")
+
+LABEL_LENGTH = 40
+
+
+class SourceMap(object):
+    def __init__(self):
+        # fexpr body -> name@file:line
+        self.labels = {}
+
+    def read(self, filename, source):
+        # reads source like parse does, naming the fexpr bodies in it
+        reader = Reader(source)
+        reader.positions = {}
+        forms_w = reader.read_all()
+        line_starts = [0]
+        for i in range(len(source)):
+            if source[i] == "\n":
+                line_starts.append(i + 1)
+        stack = []
+        for i in range(len(forms_w) - 1, -1, -1):
+            stack.append(forms_w[i])
+        while stack:
+            w_form = stack.pop()
+            if not isinstance(w_form, W_List) or w_form.is_nil():
+                continue
+            w_head = w_form.car
+            if w_head is w_define or w_head is w_lambda or w_head is w_vau:
+                location = "%s:%d" % (filename, line_of(
+                    line_starts, reader.positions.get(w_form, 0)))
+                if w_head is w_define:
+                    self.name_define(w_form, location)
+                else:
+                    self.name_fexpr(w_form, "%s@%s" % (w_head.to_string(), location))
+            # enclosing forms are named first, so a named lambda keeps its
+            # name when it is visited itself
+            w_rest = w_form
+            items_w = []
+            while isinstance(w_rest, W_List) and not w_rest.is_nil():
+                items_w.append(w_rest.car)
+                w_rest = w_rest.cdr
+            stack.append(w_rest)
+            for i in range(len(items_w) - 1, -1, -1):
+                stack.append(items_w[i])
+        return forms_w
+
+    def name_define(self, w_form, location):
+        w_target = nth_cell(w_form, 1)
+        if w_target is None:
+            return
+        w_target = w_target.car
+        if isinstance(w_target, W_List) and not w_target.is_nil():
+            # (define (name . params) . body)
+            self.name_body(nth_cell(w_form, 2), "%s@%s" % (
+                w_target.car.to_string(), location))
+            return
+        w_value = nth_cell(w_form, 2)
+        if w_value is None:
+            return
+        w_value = w_value.car
+        if (isinstance(w_value, W_List) and not w_value.is_nil() and
+                (w_value.car is w_lambda or w_value.car is w_vau)):
+            self.name_fexpr(w_value, "%s@%s" % (w_target.to_string(), location))
+
+    def name_fexpr(self, w_form, label):
+        if w_form.car is w_lambda:
+            # (lambda params . body)
+            self.name_body(nth_cell(w_form, 2), label)
+        else:
+            # (vau params env body)
+            self.name_body(nth_cell(w_form, 3), label)
+
+    def name_body(self, w_cell, label):
+        # a single body is the fexpr's body, more than one get wrapped in a
+        # fresh (begin . body) by lambda
+        if w_cell is None:
+            return
+        if w_cell not in self.labels:
+            self.labels[w_cell] = label
+        w_body = w_cell.car
+        if isinstance(w_body, W_List) and not w_body.is_nil() and w_body not in self.labels:
+            self.labels[w_body] = label
+
+    def label(self, w_body):
+        label = self.labels.get(w_body, None)
+        if label is None and isinstance(w_body, W_List) and not w_body.is_nil():
+            if w_body.car is w_begin:
+                label = self.labels.get(w_body.cdr, None)
+        if label is not None:
+            return label
+        # not read through this map, e.g. loaded from a heap image
+        text = w_body.to_repr()
+        if len(text) > LABEL_LENGTH:
+            end = LABEL_LENGTH - 3
+            assert end >= 0
+            text = text[:end] + "..."
+        chars = []
+        for ch in text:
+            # collapsed stacks are separated by ; and lines
+            if ch == ";" or ch == "\n":
+                chars.append(" ")
+            else:
+                chars.append(ch)
+        return "".join(chars)
+
+
+def nth_cell(w_list, n):
+    for i in range(n):
+        if not isinstance(w_list, W_List) or w_list.is_nil():
+            return None
+        w_list = w_list.cdr
+    if not isinstance(w_list, W_List) or w_list.is_nil():
+        return None
+    return w_list
+
+
+def line_of(line_starts, pos):
+    # the 1 based line of offset pos, by bisecting the line start offsets
+    low = 0
+    high = len(line_starts)
+    while high - low > 1:
+        middle = (low + high) / 2
+        if line_starts[middle] <= pos:
+            low = middle
+        else:
+            high = middle
+    return low + 1
+
+
+class FexprStats(object):
+    def __init__(self, w_body):
+        self.w_body = w_body
+        self.calls = 0
+        self.steps = 0
+        self.self_steps = 0
+        self.seconds = 0.0
+        # calls of this fexpr now running, recursive calls only count once
+        # towards steps and seconds
+        self.active = 0
+
+
+class CallNode(object):
+    # a node of the calling context tree, one per path of fexpr bodies
+    def __init__(self, w_body):
+        self.w_body = w_body
+        self.children = {}
+        self.self_steps = 0
+
+    def child(self, w_body):
+        node = self.children.get(w_body, None)
+        if node is None:
+            node = CallNode(w_body)
+            self.children[w_body] = node
+        return node
+
+
+class Profile(object):
+    traced = True
+
+    def __init__(self, source_map):
+        self.source_map = source_map
+        self.root = CallNode(None)
+        self.stats = {}
+
+    def stats_for(self, w_body):
+        stats = self.stats.get(w_body, None)
+        if stats is None:
+            stats = FexprStats(w_body)
+            self.stats[w_body] = stats
+        return stats
+
+    def run(self, runtime, machine, w_exp):
+        # runs one instruction for Runtime.interpret
+        raise NotImplementedError
+
+    def finish(self, runtime):
+        pass
+
+    def collapsed_stacks(self):
+        # one line per call path, the labels from the outermost call on
+        # separated by ;, then its self steps, as flamegraph.pl reads them
+        lines = []
+        if self.root.self_steps > 0:
+            lines.append("toplevel %d" % self.root.self_steps)
+        paths = []
+        nodes = []
+        for w_body in self.root.children:
+            nodes.append(self.root.children[w_body])
+            paths.append(self.source_map.label(w_body))
+        while nodes:
+            node = nodes.pop()
+            path = paths.pop()
+            if node.self_steps > 0:
+                lines.append("%s %d" % (path, node.self_steps))
+            for w_body in node.children:
+                nodes.append(node.children[w_body])
+                paths.append(path + ";" + self.source_map.label(w_body))
+        lines.sort()
+        return "".join([line + "\n" for line in lines])
+
+    def report(self, count):
+        # the count fexprs with the most self steps
+        remaining = self.stats.values()
+        lines = ["%10s %12s %12s %10s  %s" % (
+            "calls", "steps", "self steps", "ms", "fexpr")]
+        while remaining and len(lines) <= count:
+            best = 0
+            for i in range(1, len(remaining)):
+                if remaining[i].self_steps > remaining[best].self_steps:
+                    best = i
+            stats = remaining.pop(best)
+            if self.traced:
+                calls = str(stats.calls)
+                ms = str(int(stats.seconds * 1000))
+            else:
+                calls = "-"
+                ms = "-"
+            lines.append("%10s %12d %12d %10s  %s" % (
+                calls, stats.steps, stats.self_steps, ms,
+                self.source_map.label(stats.w_body)))
+        return "".join([line + "\n" for line in lines])
+
+
+class ActiveCall(object):
+    def __init__(self, machine, node, stats, depth, steps):
+        self.machine = machine
+        self.node = node
+        self.stats = stats
+        # the depth of the env stack the call's env was pushed at
+        self.depth = depth
+        self.start_steps = steps
+        self.start_time = time.time()
+        self.child_steps = 0
+
+
+class Profiler(Profile):
+    def __init__(self, source_map):
+        Profile.__init__(self, source_map)
+        self.calls = []
+
+    def run(self, runtime, machine, w_exp):
+        # the step about to run belongs to whatever is still running
+        self.end_calls(machine, runtime.steps - 1)
+        if not self.calls:
+            self.root.self_steps += 1
+        w_exp.compile(runtime, machine)
+        if type(w_exp) is W_Fexpr:
+            self.start_call(machine, w_exp, runtime.steps)
+
+    def finish(self, runtime):
+        while self.calls:
+            self.end_call(runtime.steps)
+
+    def start_call(self, machine, w_fexpr, steps):
+        w_body = w_fexpr.body
+        stats = self.stats_for(w_body)
+        stats.calls += 1
+        depth = machine.env_stack.depth
+        # a tail call replaced the env of the calls at this depth, which
+        # only end when it returns, a fexpr that is already running there
+        # just goes on, so a loop of tail calls doesn't pile up calls
+        i = len(self.calls) - 1
+        while i >= 0 and self.calls[i].depth == depth:
+            if self.calls[i].stats is stats:
+                return
+            i -= 1
+        if self.calls:
+            node = self.calls[-1].node.child(w_body)
+        else:
+            node = self.root.child(w_body)
+        stats.active += 1
+        self.calls.append(ActiveCall(machine, node, stats, depth, steps))
+
+    def end_calls(self, machine, steps):
+        depth = machine.env_stack.depth
+        while self.calls:
+            call = self.calls[-1]
+            if call.machine is machine and call.depth <= depth:
+                return
+            self.end_call(steps)
+
+    def end_call(self, steps):
+        call = self.calls.pop()
+        steps -= call.start_steps
+        self_steps = steps - call.child_steps
+        call.node.self_steps += self_steps
+        stats = call.stats
+        stats.self_steps += self_steps
+        stats.active -= 1
+        if stats.active == 0:
+            stats.steps += steps
+            stats.seconds += time.time() - call.start_time
+        if self.calls:
+            self.calls[-1].child_steps += steps
+
+
+class SamplingProfiler(Profile):
+    traced = False
+
+    def __init__(self, source_map, interval):
+        Profile.__init__(self, source_map)
+        self.interval = interval
+        self.countdown = interval
+
+    def run(self, runtime, machine, w_exp):
+        self.countdown -= 1
+        if self.countdown == 0:
+            self.countdown = self.interval
+            self.sample(machine)
+        w_exp.compile(runtime, machine)
+
+    def sample(self, machine):
+        # every sample stands for interval steps of the calls on the stack
+        node = self.root
+        stats = None
+        seen_envs = {}
+        seen_bodies = {}
+        env_stack = machine.env_stack
+        for i in range(env_stack.depth):
+            env = env_stack.items_w[i]
+            # an eval in tail position pushes an env that is already below
+            if not isinstance(env, W_CallEnv) or env in seen_envs:
+                continue
+            seen_envs[env] = True
+            w_body = env.w_fexpr.body
+            node = node.child(w_body)
+            stats = self.stats_for(w_body)
+            if w_body not in seen_bodies:
+                seen_bodies[w_body] = True
+                stats.steps += self.interval
+        node.self_steps += self.interval
+        if stats is not None:
+            stats.self_steps += self.interval
@@ -0,0 +1,280 @@
+from pypy.rlib.rbigint import rbigint
+
+from execution_model import (W_List, W_Real, W_String, W_Vector,
+                             QuoppaException, ListBuilder, w_nil, w_true, w_false, w_list,
+                             w_integer, w_bigint, symbol, intern_symbol)
+
+
+# A single pass reader producing the same objects as the QuoppaParser grammar
+# in parser.py. Nesting is kept on an explicit stack of ReadFrames instead of
+# the Python stack, so memory is proportional to the nesting depth and the
+# number of data read so far.
+
+SYMBOL_START = "+-*^?abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ!<=>_~/$%&:"
+SYMBOL_CHARS = SYMBOL_START + "0123456789."
+DELIMITERS = " \n\t\r()\";'`,"
+# longest decimal that always fits a machine word
+MAX_FIXNUM_DIGITS = 18
+
+quote_symbols = {
+    "'": symbol("quote"),
+    "`": symbol("quasiquote"),
+    ",": symbol("unquote"),
+    ",@": symbol("unquote-splicing"),
+}
+
+
+class ReadError(QuoppaException):
+    def __init__(self, msg, line, column):
+        QuoppaException.__init__(self, "parse error in line %d, column %d: %s" % (
+            line, column, msg))
+        self.line = line
+        self.column = column
+
+
+class IncompleteInput(Exception):
+    # the buffer ended inside a datum, but more input may follow
+    pass
+
+
+class ReadFrame(object):
+    # an open list, or with w_quote set, a quote prefix waiting for its datum,
+    # or with items_w set, an open vector
+    def __init__(self, start, w_quote=None, vector=False):
+        self.start = start
+        self.w_quote = w_quote
+        self.items_w = [] if vector else None
+        self.builder = ListBuilder()
+        self.w_cdr = None
+        # 0 reading cars, 1 after the dot, 2 after the datum following it
+        self.dotted = 0
+
+
+class Reader(object):
+    def __init__(self, source, pos=0, final=True, line=1, column=0):
+        self.source = source
+        self.pos = pos
+        # whether the end of source is the end of the input, a port reading
+        # a buffer at a time catches IncompleteInput and retries with more
+        self.final = final
+        # where source starts in the input, for error messages
+        self.line = line
+        self.column = column
+        # when set to a dict, the offset every list read starts at, by list
+        self.positions = None
+
+    def error(self, msg, pos):
+        line = self.line
+        line_start = -self.column
+        for i in range(pos):
+            if self.source[i] == "\n":
+                line += 1
+                line_start = i + 1
+        return ReadError(msg, line, pos - line_start + 1)
+
+    def end_of_input(self, msg, pos):
+        if not self.final:
+            raise IncompleteInput
+        return self.error(msg, pos)
+
+    def skip_whitespace(self):
+        source = self.source
+        pos = self.pos
+        while pos < len(source):
+            ch = source[pos]
+            if ch == ";":
+                while pos < len(source) and source[pos] != "\n":
+                    pos += 1
+            elif ch == " " or ch == "\n" or ch == "\t" or ch == "\r":
+                pos += 1
+            else:
+                break
+        self.pos = pos
+
+    def read_all(self):
+        result = []
+        while True:
+            w_obj = self.read()
+            if w_obj is None:
+                return result
+            result.append(w_obj)
+
+    def read(self):
+        # the next datum, or None at the end of the input
+        stack = []
+        while True:
+            self.skip_whitespace()
+            start = self.pos
+            if start >= len(self.source):
+                if stack:
+                    raise self.end_of_input("unexpected end of input", stack[-1].start)
+                if not self.final:
+                    raise IncompleteInput
+                return None
+            ch = self.source[start]
+            if ch == "(":
+                self.pos += 1
+                stack.append(ReadFrame(start))
+                continue
+            elif ch == ")":
+                self.pos += 1
+                if not stack or stack[-1].w_quote is not None:
+                    raise self.error("unexpected )", start)
+                frame = stack.pop()
+                if frame.dotted == 1:
+                    raise self.error("expected a datum after .", start)
+                if frame.items_w is not None:
+                    w_obj = W_Vector(frame.items_w)
+                else:
+                    w_obj = frame.builder.finish(frame.w_cdr)
+                if self.positions is not None and not w_obj.is_nil():
+                    self.positions[w_obj] = frame.start
+            elif ch == "'" or ch == "`" or ch == ",":
+                self.pos += 1
+                prefix = ch
+                if ch == "," and self.pos == len(self.source) and not self.final:
+                    raise IncompleteInput
+                if ch == "," and self.pos < len(self.source) and self.source[self.pos] == "@":
+                    self.pos += 1
+                    prefix = ",@"
+                stack.append(ReadFrame(start, quote_symbols[prefix]))
+                continue
+            elif ch == '"':
+                w_obj = self.read_string()
+            elif ch == "#" and start + 1 == len(self.source) and not self.final:
+                raise IncompleteInput
+            elif ch == "#" and start + 1 < len(self.source) and self.source[start + 1] == "\\":
+                w_obj = self.read_character()
+            elif ch == "#" and start + 1 < len(self.source) and self.source[start + 1] == "(":
+                self.pos += 2
+                stack.append(ReadFrame(start, vector=True))
+                continue
+            else:
+                token = self.read_token()
+                if token == ".":
+                    if (not stack or stack[-1].w_quote is not None or
+                            stack[-1].items_w is not None or
+                            stack[-1].dotted != 0 or stack[-1].builder.w_tail is None):
+                        raise self.error("unexpected .", start)
+                    stack[-1].dotted = 1
+                    continue
+                w_obj = self.atom(token, start)
+            # a datum is complete, hand it to the enclosing frames
+            while stack and stack[-1].w_quote is not None:
+                w_obj = w_list([stack.pop().w_quote, w_obj])
+            if not stack:
+                return w_obj
+            frame = stack[-1]
+            if frame.items_w is not None:
+                frame.items_w.append(w_obj)
+            elif frame.dotted == 0:
+                frame.builder.append(w_obj)
+            elif frame.dotted == 1:
+                frame.w_cdr = w_obj
+                frame.dotted = 2
+            else:
+                raise self.error("more than one datum after .", start)
+
+    def read_token(self):
+        source = self.source
+        start = self.pos
+        pos = start
+        while pos < len(source) and source[pos] not in DELIMITERS:
+            pos += 1
+        if pos == len(source) and not self.final:
+            # the token may go on in the next buffer
+            raise IncompleteInput
+        self.pos = pos
+        assert start >= 0
+        return source[start:pos]
+
+    def read_string(self):
+        source = self.source
+        start = self.pos
+        pos = start + 1
+        chars = []
+        while True:
+            if pos >= len(source):
+                raise self.end_of_input("unterminated string", start)
+            ch = source[pos]
+            if ch == '"':
+                break
+            if ch == "\\":
+                pos += 1
+                if pos >= len(source):
+                    raise self.end_of_input("unterminated string", start)
+                ch = source[pos]
+                if ch == "n":
+                    ch = "\n"
+                elif ch != "\\" and ch != '"':
+                    raise self.error("unknown escape \\%s" % ch, pos - 1)
+            chars.append(ch)
+            pos += 1
+        self.pos = pos + 1
+        return W_String("".join(chars))
+
+    def read_character(self):
+        # #\x or a name like #\space, read as the string after the #\
+        source = self.source
+        start = self.pos + 2
+        if start >= len(source):
+            raise self.end_of_input("unexpected end of input", self.pos)
+        pos = start + 1
+        if source[start].isalpha():
+            while pos < len(source) and source[pos].isalpha():
+                pos += 1
+            if pos == len(source) and not self.final:
+                raise IncompleteInput
+        self.pos = pos
+        return W_String(source[start:pos])
+
+    def atom(self, token, start):
+        if token == "nil":
+            return w_nil
+        elif token == "#t":
+            return w_true
+        elif token == "#f":
+            return w_false
+        w_number = read_number(token)
+        if w_number is not None:
+            return w_number
+        if is_symbol(token):
+            for ch in token:
+                if "A" <= ch <= "Z":
+                    return symbol(token)
+            return intern_symbol(token)
+        raise self.error("invalid token %s" % token, start)
+
+
+def read_number(token):
+    # the number token is written as, None if it isn't one
+    digits = 0
+    dots = 0
+    for i in range(len(token)):
+        ch = token[i]
+        if "0" <= ch <= "9":
+            digits += 1
+        elif ch == ".":
+            dots += 1
+    sign = 1 if token[0] == "-" else 0
+    if digits > 0 and digits + dots + sign == len(token):
+        if dots == 0:
+            if digits <= MAX_FIXNUM_DIGITS:
+                return w_integer(int(token))
+            return w_bigint(rbigint.fromdecimalstr(token))
+        elif dots == 1:
+            return W_Real(float(token))
+    return None
+
+
+def is_symbol(token):
+    if token[0] not in SYMBOL_START:
+        return False
+    for i in range(1, len(token)):
+        if token[i] not in SYMBOL_CHARS:
+            return False
+    return True
+
+
+def read_all(source):
+    return Reader(source).read_all()
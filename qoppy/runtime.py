@@ -1,17 +1,45 @@
 from pypy.rlib import jit
 from pypy.rlib.objectmodel import specialize
 
+import ports
 from parser import parse
+from native import native_prelude_forms
+from bytecode import AstEngine, BytecodeEngine
 from execution_model import (W_List, symbol, w_nil, W_Symbol, QuoppaException,
-                             W_Vau, W_Operate, W_Eval, W_Primitive, W_Fexpr, w_list)
+                             W_Vau, W_Operate, W_Eval, W_Lookup, W_Fexpr, w_list,
+                             W_Wrap, W_Unwrap,
+                             primitive,
+                             W_Frame, W_Binding, instruction, frame_version,
+                             MachineState, ListBuilder,
+                             global_version)
+import stats
 
 
 @specialize.memo()
-def get_runtime():
+def get_runtime(native_prelude=False, bytecode=False):
     from primitives import (m_bool, eq_p, null_p, symbol_p, pair_p, cons,
                             car, cdr, set_car_b, set_cdr_b, plus, times, minus,
-                            div, less_or_eq, eq, error, display,
-                            read, eof_object_p, open_input_file)
+                            div, less, less_or_eq, greater, greater_or_eq,
+                            eq, error, display, write, newline, flush_output,
+                            current_output_port, open_output_file,
+                            open_output_string, get_output_string,
+                            close_output_port,
+                            read, read_char, peek_char, eof_object_p,
+                            open_input_file, close_input_port)
+    from lists import (length, reverse, list_tail, list_ref, memq, member,
+                       assq, assoc, append, append_b, list_copy)
+    from vectors import (vector_p, make_vector, vector, vector_ref,
+                         vector_set_b, vector_length, vector_fill_b,
+                         vector_to_list, list_to_vector, vector_copy)
+    from hashtables import (hashtable_p, make_eq_hashtable,
+                            make_equal_hashtable, hashtable_ref,
+                            hashtable_set_b, hashtable_delete_b,
+                            hashtable_count, hashtable_keys)
+    from strings import (string_p, string_length, string_ref, substring,
+                         string_index, string_split, string_to_symbol,
+                         string_to_number, string_builder,
+                         string_builder_append_b, string_builder_length,
+                         string_builder_to_string)
     return Runtime({
             "bool": m_bool,
             "eq?": eq_p,
@@ -27,14 +55,69 @@ def get_runtime():
             "*": times,
             "-": minus,
             "/": div,
+            "<": less,
             "<=": less_or_eq,
+            ">": greater,
+            ">=": greater_or_eq,
             "=": eq,
             "error": error,
             "display": display,
+            "write": write,
+            "newline": newline,
+            "flush-output": flush_output,
+            "current-output-port": current_output_port,
+            "open-output-file": open_output_file,
+            "open-output-string": open_output_string,
+            "get-output-string": get_output_string,
+            "close-output-port": close_output_port,
             "read": read,
+            "read-char": read_char,
+            "peek-char": peek_char,
             "eof-object?": eof_object_p,
-            "open-input-file": open_input_file
-    })
+            "open-input-file": open_input_file,
+            "close-input-port": close_input_port,
+            "length": length,
+            "reverse": reverse,
+            "list-tail": list_tail,
+            "list-ref": list_ref,
+            "memq": memq,
+            "member": member,
+            "assq": assq,
+            "assoc": assoc,
+            "append": append,
+            "append!": append_b,
+            "list-copy": list_copy,
+            "vector?": vector_p,
+            "make-vector": make_vector,
+            "vector": vector,
+            "vector-ref": vector_ref,
+            "vector-set!": vector_set_b,
+            "vector-length": vector_length,
+            "vector-fill!": vector_fill_b,
+            "vector->list": vector_to_list,
+            "list->vector": list_to_vector,
+            "vector-copy": vector_copy,
+            "hashtable?": hashtable_p,
+            "make-eq-hashtable": make_eq_hashtable,
+            "make-equal-hashtable": make_equal_hashtable,
+            "hashtable-ref": hashtable_ref,
+            "hashtable-set!": hashtable_set_b,
+            "hashtable-delete!": hashtable_delete_b,
+            "hashtable-count": hashtable_count,
+            "hashtable-keys": hashtable_keys,
+            "string?": string_p,
+            "string-length": string_length,
+            "string-ref": string_ref,
+            "substring": substring,
+            "string-index": string_index,
+            "string-split": string_split,
+            "string->symbol": string_to_symbol,
+            "string->number": string_to_number,
+            "string-builder": string_builder,
+            "string-builder-append!": string_builder_append_b,
+            "string-builder-length": string_builder_length,
+            "string-builder->string": string_builder_to_string
+    }, native_prelude, bytecode)
 
 def get_printable_location(self, w_exp):
     # stack = []
@@ -44,68 +127,152 @@ def get_printable_location(self, w_exp):
     return w_exp.to_string()
 
 
+class LookupCacheStats(object):
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def to_string(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return "lookup cache: no lookups"
+        return "lookup cache: %d hits, %d misses (%d%% hit rate)" % (
+            self.hits, self.misses, self.hits * 100 / total)
+
+
 class Runtime(object):
     jitdriver = jit.JitDriver(
         greens=["self", "w_exp"],
-        reds=["env_stack", "stack", "operand_stack"],
+        reds=["machine"],
         get_printable_location=get_printable_location,
     )
 
+    _immutable_fields_ = ["global_env", "engine", "profiler?", "stats?"]
+
     w_underscore = symbol("_")
 
     @specialize.memo()
-    def __init__(self, primitives):
-        vau = W_Vau(self.vau)
-        global_frame = self.bind(symbol("vau"), vau)
-        global_frame.comma(w_list([w_list([symbol("operate"), W_Operate()])]))
-        global_frame.comma(w_list([w_list([symbol("eval"), W_Eval()])]))
-
-        primitives["lookup"] = self.lookup
+    def __init__(self, primitives, native_prelude=False, bytecode=False):
+        # the values global_binding bound, by name, heap images refer to
+        # these by name
+        self.builtins_w = {}
+        global_frame = w_nil
         for name in primitives:
-            prim = W_Primitive(primitives[name])
-            global_frame.comma(w_list([w_list([symbol(name), prim])]))
+            global_frame = self.global_binding(name, primitive(primitives[name]), global_frame)
+        global_frame = self.global_binding("lookup", W_Lookup(), global_frame)
+        global_frame = self.global_binding("eval", W_Eval(), global_frame)
+        global_frame = self.global_binding("operate", W_Operate(), global_frame)
+        global_frame = self.global_binding("vau", W_Vau(), global_frame)
+        global_frame = self.global_binding("wrap", W_Wrap(), global_frame)
+        global_frame = self.global_binding("unwrap", W_Unwrap(), global_frame)
         self.global_env = w_list([global_frame])
+        self.lookup_cache = LookupCacheStats()
+        # instructions run by interpret, for benchmarks/run.py
+        self.steps = 0
+        # a Profiler or SamplingProfiler from profiler.py, when profiling
+        self.profiler = None
+        # an InterpreterStats from stats.py, when counting
+        self.stats = None
+        self.native_forms = native_prelude_forms(native_prelude)
+        if bytecode:
+            self.engine = BytecodeEngine()
+        else:
+            self.engine = AstEngine()
+
+    def global_binding(self, name, w_value, global_frame):
+        self.builtins_w[name] = w_value
+        return W_Frame(W_Binding(symbol(name), w_list([w_value])), global_frame)
 
     def bind(self, param, val):
-        if param.is_nil() and val.is_nil():
-            return w_nil
-        elif isinstance(param, W_Symbol):
-            if param is self.w_underscore:
-                return w_nil
+        builder = ListBuilder()
+        self.bind_into(builder, param, val)
+        return builder.finish()
+
+    def bind_into(self, builder, param, val):
+        # iterates along the parameter list, recursing only into nested
+        # destructuring patterns
+        while True:
+            if param.is_nil() and val.is_nil():
+                return
+            elif isinstance(param, W_Symbol):
+                if param is not self.w_underscore:
+                    builder.append(w_list([param, val]))
+                return
+            elif param.is_nil():
+                raise QuoppaException("too many arguments")
+            elif val.is_nil():
+                raise QuoppaException("too few arguments")
+            elif isinstance(param, W_List) and isinstance(val, W_List):
+                self.bind_into(builder, param.car, val.car)
+                param = param.cdr
+                val = val.cdr
             else:
-                return w_list([w_list([param, val])])
-        elif param.is_nil():
-            raise QuoppaException("too many arguments")
-        elif val.is_nil():
-            raise QuoppaException("too few arguments")
-        elif isinstance(param, W_List) and isinstance(val, W_List):
-            return self.bind(param.car, val.car).comma(self.bind(param.cdr, val.cdr))
-        else:
-            raise QuoppaException("can't bind %s %s" % (param.to_string(), val.to_string()))
+                raise QuoppaException("can't bind %s %s" % (param.to_string(), val.to_string()))
 
-    # TODO: Probably wrong, look into this
     @jit.unroll_safe
     def lookup(self, w_name, env):
         if env.is_nil() or not isinstance(env, W_List):
             raise QuoppaException("cannot find %s in %s" % (w_name.to_string(), env.to_string()))
+        if not isinstance(w_name, W_Symbol):
+            raise QuoppaException("cannot find non symbol %s" % w_name.to_string())
+        version = frame_version.counter
+        depth = 0
         while not env.is_nil():
-            frame = env.car
-            while not frame.is_nil():
-                if not isinstance(frame, W_List):
-                    raise QuoppaException("Consistency! Non pair %s as frame" % frame.to_string())
-                pair = frame.car
-                if not isinstance(pair, W_List):
-                    raise QuoppaException("Consistency! Non pair %s in frame" % pair.to_string())
-                if not isinstance(pair.car, W_Symbol):
-                    raise QuoppaException("Consistency! Non symbol %s in pair" % pair.to_string())
-                if pair.car.equal(w_name):
-                    return pair
-                frame = frame.cdr
+            depth += 1
+            if env is self.global_env and self.globals_foldable(global_version.version):
+                pair = self.lookup_global(w_name, global_version.version)
+            elif w_name.cache_env is env and w_name.cache_version == version:
+                self.lookup_cache.hits += 1
+                pair = w_name.cache_pair
+            else:
+                pair = self.lookup_in_frame(w_name, env.car)
+                if pair is not None:
+                    self.lookup_cache.misses += 1
+                    w_name.cache_env = env
+                    w_name.cache_pair = pair
+                    w_name.cache_version = version
+            if pair is not None:
+                if self.stats is not None:
+                    self.stats.looked_up(depth)
+                return pair
             env = env.cdr
             if not isinstance(env, W_List):
                 raise QuoppaException("Consistency! Non cons %s as env cdr" % env.to_string())
         raise QuoppaException("cannot find %s in env" % w_name.to_string())
 
+    def global_value(self, w_name):
+        cdr = self.lookup(w_name, self.global_env).cdr
+        assert isinstance(cdr, W_List) and not cdr.is_nil()
+        return cdr.car
+
+    @jit.elidable
+    def globals_foldable(self, version):
+        frame = self.global_env.car
+        return isinstance(frame, W_Frame) and frame.is_foldable()
+
+    @jit.elidable
+    def lookup_global(self, w_name, version):
+        frame = self.global_env.car
+        assert isinstance(frame, W_Frame)
+        return frame.find(w_name)
+
+    @jit.unroll_safe
+    def lookup_in_frame(self, w_name, frame):
+        while not frame.is_nil():
+            if isinstance(frame, W_Frame):
+                return frame.find(w_name)
+            if not isinstance(frame, W_List):
+                raise QuoppaException("Consistency! Non pair %s as frame" % frame.to_string())
+            pair = frame.car
+            if not isinstance(pair, W_List):
+                raise QuoppaException("Consistency! Non pair %s in frame" % pair.to_string())
+            if not isinstance(pair.car, W_Symbol):
+                raise QuoppaException("Consistency! Non symbol %s in pair" % pair.to_string())
+            if pair.car.equal(w_name):
+                return pair
+            frame = frame.cdr
+        return None
+
     def vau(self, static_env, vau_operands):
         assert isinstance(vau_operands, W_List)
         params = vau_operands.car
@@ -120,32 +287,47 @@ class Runtime(object):
 
         return W_Fexpr(env_param, params, static_env, body)
 
-    def interpret(self, env, w_exp):
-        stack = w_nil
-        operand_stack = w_list([w_exp])
-        env_stack = w_list([self.global_env if env.is_nil() else env])
-        while not operand_stack.is_nil():
-            w_exp = operand_stack.car
+    def interpret(self, env, w_exp, machine=None):
+        if machine is None:
+            machine = MachineState()
+        machine.operand_stack.push(instruction(w_exp))
+        machine.env_stack.push(self.global_env if env.is_nil() else env)
+        while not machine.operand_stack.is_empty():
+            w_exp = machine.operand_stack.pop()
+            self.steps += 1
             if isinstance(w_exp, W_Fexpr):
                 self.jitdriver.can_enter_jit(
-                    self=self, w_exp=w_exp,
-                    env_stack=env_stack, stack=stack,
-                    operand_stack=operand_stack
+                    self=self, w_exp=w_exp, machine=machine
                 )
             self.jitdriver.jit_merge_point(
-                self=self, w_exp=w_exp,
-                env_stack=env_stack, stack=stack,
-                operand_stack=operand_stack
+                self=self, w_exp=w_exp, machine=machine
             )
-            env_stack, stack, operand_stack = w_exp.compile(self, env_stack, stack, operand_stack.cdr)
-            assert isinstance(env_stack, W_List)
-            assert isinstance(stack, W_List)
-            assert isinstance(operand_stack, W_List)
-        return stack.car
+            if self.profiler is None:
+                w_exp.compile(self, machine)
+            else:
+                self.profiler.run(self, machine, w_exp)
+            if self.stats is not None:
+                self.stats.dispatched(w_exp, machine)
+        if self.profiler is not None:
+            self.profiler.finish(self)
+        return machine.stack.pop()
 
     def execute(self, code):
-        t = parse(code)
+        return self.execute_forms(parse(code))
+
+    def execute_forms(self, t):
         w_res = None
-        for s in t:
-            w_res = self.interpret(w_nil, s)
+        try:
+            for s in t:
+                w_res = self.interpret(w_nil, self.toplevel_form(s))
+        finally:
+            ports.stdout.flush()
         return w_res
+
+    def toplevel_form(self, w_exp):
+        # a definition from prelude.qop is swapped for one binding the name
+        # to its native equivalent, see native.py
+        for native_form in self.native_forms:
+            if native_form.w_form.equal(w_exp):
+                return native_form.w_replacement
+        return w_exp
@@ -0,0 +1,111 @@
+from execution_model import (W_Object, W_PrimitiveCall, W_Primitive,
+                             list_allocations)
+from native import W_Native
+# imported for their W_ classes, which get named below
+import bytecode
+import ports
+
+
+# Counters of what Runtime.interpret did, for telling why a program is slow
+# without a Python profiler. Runtime.stats is None unless --stats is given,
+# and like the profiler it is quasi-immutable, so the JIT folds the checks
+# away when it is off.
+#
+# Instructions are counted by class. The name of every W_ class is put on
+# the class below, once all the modules defining them are imported.
+
+# lookups walking more env cells than this count towards the last bucket
+LOOKUP_DEPTH_BUCKETS = 32
+
+
+def name_classes(cls):
+    cls.class_name = cls.__name__
+    for subclass in cls.__subclasses__():
+        name_classes(subclass)
+
+name_classes(W_Object)
+
+
+class InterpreterStats(object):
+    def __init__(self):
+        self.dispatches = {}
+        self.primitive_calls = {}
+        # lookup_depth[i] is the number of lookups found after walking i + 1
+        # env cells
+        self.lookup_depth = [0] * LOOKUP_DEPTH_BUCKETS
+        self.max_stack = 0
+        self.max_env_stack = 0
+        self.max_operand_stack = 0
+        list_allocations.start()
+
+    def dispatched(self, w_exp, machine):
+        # after an instruction ran
+        name = w_exp.class_name
+        self.dispatches[name] = self.dispatches.get(name, 0) + 1
+        if isinstance(w_exp, W_PrimitiveCall):
+            # one call instruction per primitive, names are looked up when
+            # dumping
+            self.primitive_calls[w_exp] = self.primitive_calls.get(w_exp, 0) + 1
+        if machine.stack.depth > self.max_stack:
+            self.max_stack = machine.stack.depth
+        if machine.env_stack.depth > self.max_env_stack:
+            self.max_env_stack = machine.env_stack.depth
+        if machine.operand_stack.depth > self.max_operand_stack:
+            self.max_operand_stack = machine.operand_stack.depth
+
+    def looked_up(self, depth):
+        if depth > LOOKUP_DEPTH_BUCKETS:
+            depth = LOOKUP_DEPTH_BUCKETS
+        self.lookup_depth[depth - 1] += 1
+
+    def to_json(self, runtime):
+        # primitives by the name they are bound to in the global env
+        names = {}
+        for name in runtime.builtins_w:
+            names[runtime.builtins_w[name]] = name
+        primitive_calls = {}
+        for w_call in self.primitive_calls:
+            name = primitive_name(w_call, names)
+            if name is not None:
+                primitive_calls[name] = primitive_calls.get(name, 0) + self.primitive_calls[w_call]
+        depths = self.lookup_depth[:]
+        while depths and depths[-1] == 0:
+            depths.pop()
+        return "{\n%s\n}\n" % ",\n".join([
+            '  "steps": %d' % runtime.steps,
+            '  "dispatches": %s' % json_counts(self.dispatches),
+            '  "list_allocations": %d' % list_allocations.count,
+            '  "lookup_depth": [%s]' % ", ".join([str(count) for count in depths]),
+            '  "max_stack_depth": {"stack": %d, "env_stack": %d, "operand_stack": %d}' % (
+                self.max_stack, self.max_env_stack, self.max_operand_stack),
+            '  "primitive_calls": %s' % json_counts(primitive_calls)])
+
+
+def primitive_name(w_call, names):
+    # None for calls of applicatives, which are not primitives
+    w_primitive = w_call.w_primitive
+    name = names.get(w_primitive, None)
+    if name is not None:
+        return name
+    if isinstance(w_primitive, W_Primitive):
+        return w_primitive.name
+    if isinstance(w_primitive, W_Native):
+        return w_primitive.name
+    return None
+
+
+def json_counts(counts):
+    names = counts.keys()
+    names.sort()
+    return "{%s}" % ", ".join(["%s: %d" % (json_string(name), counts[name])
+                               for name in names])
+
+
+def json_string(s):
+    chars = ['"']
+    for ch in s:
+        if ch == '"' or ch == "\\":
+            chars.append("\\")
+        chars.append(ch)
+    chars.append('"')
+    return "".join(chars)
@@ -0,0 +1,113 @@
+from execution_model import (W_String, W_StringBuilder, QuoppaException,
+                             ListBuilder, w_undefined, w_true, w_false,
+                             w_integer, intern_symbol, variadic)
+from lists import index_argument
+from reader import read_number
+
+
+# String primitives. substring and string-split hand out W_Substrings that
+# share the storage of the string they are taken from, so taking a string
+# apart copies nothing until a piece is displayed or compared. Characters
+# are strings of length one, as #\x reads them.
+
+def string_argument(w_obj, name):
+    if not isinstance(w_obj, W_String):
+        raise QuoppaException("wrong type argument %s for %s" % (w_obj.to_string(), name))
+    return w_obj
+
+def char_argument(w_obj, name):
+    if not isinstance(w_obj, W_String) or w_obj.length() != 1:
+        raise QuoppaException("wrong type argument %s for %s" % (w_obj.to_string(), name))
+    return w_obj.char_at(0)
+
+def string_builder_argument(w_obj, name):
+    if not isinstance(w_obj, W_StringBuilder):
+        raise QuoppaException("wrong type argument %s for %s" % (w_obj.to_string(), name))
+    return w_obj
+
+def string_p(w_obj):
+    if isinstance(w_obj, W_String):
+        return w_true
+    return w_false
+
+def string_length(w_str):
+    return w_integer(string_argument(w_str, "string-length").length())
+
+def string_ref(w_str, w_k):
+    w_str = string_argument(w_str, "string-ref")
+    k = index_argument(w_k, "string-ref")
+    if k >= w_str.length():
+        raise QuoppaException("index %d too large for string-ref" % k)
+    return W_String(w_str.char_at(k))
+
+@variadic
+def substring(args_w):
+    # (substring string start [end])
+    if len(args_w) < 2 or len(args_w) > 3:
+        raise QuoppaException("substring takes 2 or 3 arguments")
+    w_str = string_argument(args_w[0], "substring")
+    start = index_argument(args_w[1], "substring")
+    end = w_str.length()
+    if len(args_w) == 3:
+        end = index_argument(args_w[2], "substring")
+    if start > end or end > w_str.length():
+        raise QuoppaException("range %d to %d out of bounds for substring" % (start, end))
+    return w_str.substring(start, end)
+
+@variadic
+def string_index(args_w):
+    # (string-index string char [start]), the index of char or #f
+    if len(args_w) < 2 or len(args_w) > 3:
+        raise QuoppaException("string-index takes 2 or 3 arguments")
+    w_str = string_argument(args_w[0], "string-index")
+    ch = char_argument(args_w[1], "string-index")
+    start = 0
+    if len(args_w) == 3:
+        start = index_argument(args_w[2], "string-index")
+        if start > w_str.length():
+            raise QuoppaException("index %d too large for string-index" % start)
+    index = w_str.find(ch, start)
+    if index == -1:
+        return w_false
+    return w_integer(index)
+
+def string_split(w_str, w_char):
+    # the pieces between the occurrences of char, empty ones included
+    w_str = string_argument(w_str, "string-split")
+    ch = char_argument(w_char, "string-split")
+    builder = ListBuilder()
+    start = 0
+    while True:
+        index = w_str.find(ch, start)
+        if index == -1:
+            builder.append(w_str.substring(start, w_str.length()))
+            return builder.finish()
+        builder.append(w_str.substring(start, index))
+        start = index + 1
+
+def string_to_symbol(w_str):
+    return intern_symbol(string_argument(w_str, "string->symbol").to_string())
+
+def string_to_number(w_str):
+    # the number the reader would read from the string, #f if it isn't one
+    s = string_argument(w_str, "string->number").to_string()
+    if not s:
+        return w_false
+    w_number = read_number(s)
+    if w_number is None:
+        return w_false
+    return w_number
+
+def string_builder():
+    return W_StringBuilder()
+
+def string_builder_append_b(w_builder, w_str):
+    w_builder = string_builder_argument(w_builder, "string-builder-append!")
+    w_builder.append(string_argument(w_str, "string-builder-append!").to_string())
+    return w_undefined
+
+def string_builder_length(w_builder):
+    return w_integer(string_builder_argument(w_builder, "string-builder-length").size)
+
+def string_builder_to_string(w_builder):
+    return W_String(string_builder_argument(w_builder, "string-builder->string").build())
@@ -0,0 +1,88 @@
+from execution_model import (W_Vector, W_List, QuoppaException, ListBuilder,
+                             w_undefined, w_true, w_false, w_integer, variadic)
+from lists import proper_length, index_argument
+
+
+# Vector primitives. A W_Vector is an array, so indexing and length take
+# constant time, and the primitives walking one run in a loop.
+
+def vector_argument(w_obj, name):
+    if not isinstance(w_obj, W_Vector):
+        raise QuoppaException("wrong type argument %s for %s" % (w_obj.to_string(), name))
+    return w_obj
+
+def vector_index(w_vector, w_k, name):
+    k = index_argument(w_k, name)
+    if k >= len(w_vector.items_w):
+        raise QuoppaException("index %d too large for %s" % (k, name))
+    return k
+
+def vector_p(w_obj):
+    if isinstance(w_obj, W_Vector):
+        return w_true
+    return w_false
+
+@variadic
+def make_vector(args_w):
+    # (make-vector k [fill])
+    if len(args_w) < 1 or len(args_w) > 2:
+        raise QuoppaException("make-vector takes 1 or 2 arguments")
+    k = index_argument(args_w[0], "make-vector")
+    w_fill = w_undefined
+    if len(args_w) == 2:
+        w_fill = args_w[1]
+    return W_Vector([w_fill] * k)
+
+@variadic
+def vector(args_w):
+    return W_Vector(args_w[:])
+
+def vector_ref(w_vector, w_k):
+    w_vector = vector_argument(w_vector, "vector-ref")
+    return w_vector.items_w[vector_index(w_vector, w_k, "vector-ref")]
+
+def vector_set_b(w_vector, w_k, w_obj):
+    w_vector = vector_argument(w_vector, "vector-set!")
+    w_vector.items_w[vector_index(w_vector, w_k, "vector-set!")] = w_obj
+    return w_undefined
+
+def vector_length(w_vector):
+    return w_integer(len(vector_argument(w_vector, "vector-length").items_w))
+
+def vector_fill_b(w_vector, w_obj):
+    items_w = vector_argument(w_vector, "vector-fill!").items_w
+    for i in range(len(items_w)):
+        items_w[i] = w_obj
+    return w_undefined
+
+def vector_to_list(w_vector):
+    items_w = vector_argument(w_vector, "vector->list").items_w
+    builder = ListBuilder()
+    for w_obj in items_w:
+        builder.append(w_obj)
+    return builder.finish()
+
+def list_to_vector(w_lst):
+    items_w = [None] * proper_length(w_lst, "list->vector")
+    for i in range(len(items_w)):
+        assert isinstance(w_lst, W_List)
+        items_w[i] = w_lst.car
+        w_lst = w_lst.cdr
+    return W_Vector(items_w)
+
+@variadic
+def vector_copy(args_w):
+    # (vector-copy vector [start [end]])
+    if len(args_w) < 1 or len(args_w) > 3:
+        raise QuoppaException("vector-copy takes 1 to 3 arguments")
+    items_w = vector_argument(args_w[0], "vector-copy").items_w
+    start = 0
+    end = len(items_w)
+    if len(args_w) > 1:
+        start = index_argument(args_w[1], "vector-copy")
+    if len(args_w) > 2:
+        end = index_argument(args_w[2], "vector-copy")
+    if start > end or end > len(items_w):
+        raise QuoppaException("range %d to %d out of bounds for vector-copy" % (start, end))
+    assert start >= 0 and end >= 0
+    return W_Vector(items_w[start:end])
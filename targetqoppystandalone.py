@@ -3,29 +3,118 @@ import sys, traceback, os
 
 from pypy.rlib.objectmodel import specialize
 from pypy.rlib.streamio import open_file_as_stream
-from pypy.rlib.parsing.makepackrat import BacktrackException
 
 from qoppy.runtime import Runtime, get_runtime
 from qoppy.execution_model import QuoppaException
+from qoppy.reader import ReadError
+from qoppy import ports
+from qoppy.image import save_image, load_image
+from qoppy.parse_cache import ParseCache, write_file
+from qoppy.profiler import SourceMap, Profiler, SamplingProfiler
+from qoppy.stats import InterpreterStats
 
+# fexprs listed in the profile report
+PROFILE_REPORT_SIZE = 20
+
+
+def make_runtime(native_prelude, bytecode):
+    # get_runtime is memoized on constant arguments
+    if native_prelude:
+        if bytecode:
+            return get_runtime(True, True)
+        return get_runtime(True, False)
+    if bytecode:
+        return get_runtime(False, True)
+    return get_runtime(False, False)
 
 def entry_point(argv):
+    cache_stats = False
+    native_prelude = False
+    bytecode = False
+    image = None
+    save_image_to = None
+    parse_cache_dir = None
+    profile_to = None
+    profile_interval = 0
+    stats_to = None
+    while len(argv) > 2 and argv[1].startswith("--"):
+        if argv[1] == "--cache-stats":
+            cache_stats = True
+        elif argv[1] == "--native-prelude":
+            native_prelude = True
+        elif argv[1] == "--bytecode":
+            bytecode = True
+        elif argv[1] == "--image" and len(argv) > 3:
+            image = argv[2]
+            argv = [argv[0]] + argv[2:]
+        elif argv[1] == "--save-image" and len(argv) > 3:
+            save_image_to = argv[2]
+            argv = [argv[0]] + argv[2:]
+        elif argv[1] == "--parse-cache-dir" and len(argv) > 3:
+            parse_cache_dir = argv[2]
+            argv = [argv[0]] + argv[2:]
+        elif argv[1] == "--profile" and len(argv) > 3:
+            profile_to = argv[2]
+            argv = [argv[0]] + argv[2:]
+        elif argv[1] == "--stats" and len(argv) > 3:
+            stats_to = argv[2]
+            argv = [argv[0]] + argv[2:]
+        elif argv[1] == "--profile-interval" and len(argv) > 3:
+            profile_interval = int(argv[2])
+            argv = [argv[0]] + argv[2:]
+        else:
+            break
+        argv = [argv[0]] + argv[2:]
     if len(argv) == 2:
-        runtime = get_runtime()
+        runtime = make_runtime(native_prelude, bytecode)
+        parse_cache = ParseCache(parse_cache_dir)
         code = open_file_as_stream(argv[1]).readall()
+        image_data = None
+        if image is not None:
+            try:
+                image_data = open_file_as_stream(image).readall()
+            except OSError:
+                os.write(1, "cannot open image %s\n" % image)
+                return 1
+        if stats_to is not None:
+            runtime.stats = InterpreterStats()
         try:
-            runtime.execute(code)
-        except BacktrackException, e:
-            (line, col) = e.error.get_line_column(code)
-            print "parse error in line %d, column %d" % (line, col)
+            if image_data is not None:
+                load_image(runtime, image_data)
+            if profile_to is not None:
+                # read without the parse cache, which has no source
+                # positions to name the fexprs by
+                source_map = SourceMap()
+                if profile_interval > 0:
+                    runtime.profiler = SamplingProfiler(source_map, profile_interval)
+                else:
+                    runtime.profiler = Profiler(source_map)
+                runtime.execute_forms(source_map.read(argv[1], code))
+            else:
+                runtime.execute_forms(parse_cache.parse_file(argv[1], code))
+            if save_image_to is not None:
+                write_file(save_image_to, save_image(runtime))
+        except ReadError as e:
+            os.write(1, "%s\n" % e.msg)
             return 1
         except QuoppaException as e:
             os.write(1, "%s\n" % str(e))
             os.write(1, "%s\n" % str(e.msg))
             return 1
+        finally:
+            ports.stdout.flush()
+            if cache_stats:
+                os.write(2, "%s\n" % runtime.lookup_cache.to_string())
+                os.write(2, "%s\n" % parse_cache.stats.to_string())
+                os.write(2, "interpreter steps: %d\n" % runtime.steps)
+            if runtime.profiler is not None:
+                write_file(profile_to, runtime.profiler.collapsed_stacks())
+                os.write(2, runtime.profiler.report(PROFILE_REPORT_SIZE))
+            if runtime.stats is not None:
+                write_file(stats_to, runtime.stats.to_json(runtime))
         return 0
     else:
-        print "Usage: %s [quoppa source file]" % argv[0]
+        print "Usage: %s [--cache-stats] [--native-prelude] [--bytecode] [--image file] [--save-image file] [--parse-cache-dir dir] [--profile file [--profile-interval steps]] [--stats file] [quoppa source file]" % argv[0]
         return 1
 
 def target(driver, *args):
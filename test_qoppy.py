@@ -106,3 +106,720 @@ class TestQoppa(object):
          (+ 1 2))
         """)
         assert w_res.intval == 3
+
+    def test_indexed_frame(self):
+        frame = W_Frame(w_list([symbol("a"), W_Integer(1)]),
+                        w_list([w_list([symbol("b"), W_Integer(2)])]))
+        env = w_list([frame])
+        assert self.r.lookup(symbol("b"), env).cdr.car.intval == 2
+
+        w_pair = w_list([symbol("c"), W_Integer(3)])
+        frame = frame.extend(w_pair)
+        env = w_list([frame])
+        assert self.r.lookup(symbol("c"), env) is w_pair
+
+        # mutating the frame like an assoc list must be seen by lookup
+        frame.cdr.set_car(w_list([symbol("a"), W_Integer(4)]))
+        assert self.r.lookup(symbol("a"), env).cdr.car.intval == 4
+
+    def test_lookup_cache(self):
+        w_pair = w_list([symbol("cached"), W_Integer(1)])
+        env = w_list([w_list([w_pair])])
+        assert self.r.lookup(symbol("cached"), env) is w_pair
+        hits = self.r.lookup_cache.hits
+        assert self.r.lookup(symbol("cached"), env) is w_pair
+        assert self.r.lookup_cache.hits == hits + 1
+
+        # redefining through set-car! on the env must invalidate the cache
+        w_shadow = w_list([symbol("cached"), W_Integer(2)])
+        env.set_car(w_list([w_shadow]))
+        assert self.r.lookup(symbol("cached"), env) is w_shadow
+
+    def test_global_frame_foldable(self):
+        from qoppy.execution_model import global_version
+        from qoppy.primitives import cons, set_car_b, set_cdr_b
+        env = self.r.global_env
+        w_pair = cons(symbol("folded"), w_list([W_Integer(1)]))
+        set_car_b(env, cons(w_pair, env.car))
+        assert self.r.globals_foldable(global_version.version)
+        assert self.r.lookup(symbol("folded"), env) is w_pair
+
+        # rebinding the value keeps the version, renaming bumps it
+        version = global_version.version
+        set_cdr_b(w_pair, w_list([W_Integer(2)]))
+        assert global_version.version == version
+        assert self.r.lookup(symbol("folded"), env).cdr.car.intval == 2
+        set_car_b(w_pair, symbol("unfolded"))
+        assert global_version.version != version
+        assert self.r.lookup(symbol("unfolded"), env) is w_pair
+
+    def test_operand_order(self):
+        try:
+            self.r.execute('(cons (error "first") (error "second"))')
+        except QuoppaException as e:
+            assert e.msg == "first"
+        else:
+            assert False
+
+    def test_machine_stack(self):
+        stack = Stack(2)
+        for i in range(5):
+            stack.push(W_Integer(i))
+        assert stack.depth == 5
+        stack.reverse_top(1)
+        assert [stack.pop().intval for i in range(5)] == [1, 2, 3, 4, 0]
+        assert stack.is_empty()
+
+    def test_fexpr_body_instruction(self):
+        w_fexpr = self.r.execute("(vau (x) e x)")
+        assert w_fexpr.body_instruction is symbol("x")
+        # a fexpr as the body evaluates to itself instead of being called
+        w_outer = W_Fexpr(symbol("_"), w_nil, self.r.global_env, w_fexpr)
+        assert isinstance(w_outer.body_instruction, W_Literal)
+        assert self.r.interpret(w_nil, w_list([w_outer])) is w_fexpr
+
+    def test_long_lists(self):
+        from qoppy.parser import parse
+        n = 3000
+        w_lst = parse("(%s)" % " ".join(["1"] * n))[0]
+        assert len(w_lst.to_array()) == n
+
+        names = " ".join(["a%d" % i for i in range(n)])
+        w_res = self.r.execute("((vau (%s) e a%d) %s)" % (
+            names, n - 1, " ".join([str(i) for i in range(n)])))
+        assert w_res.intval == n - 1
+
+    def test_list_builder(self):
+        builder = ListBuilder()
+        assert builder.finish() is w_nil
+        w_lst = w_list([W_Integer(1), W_Integer(2)])
+        assert w_lst.cons(w_list([W_Integer(3)])).to_repr() == "(1 2 3)"
+        assert w_lst.to_repr() == "(1 2)"
+        assert w_lst.comma(W_Integer(3)).to_repr() == "(1 2 . 3)"
+        assert w_lst.to_repr() == "(1 2 . 3)"
+
+    def test_primitive_arity(self):
+        from qoppy.primitives import car, cons
+        assert isinstance(primitive(car), W_Primitive1)
+        assert isinstance(primitive(cons), W_Primitive2)
+
+        @variadic
+        def count(args_w):
+            return W_Integer(len(args_w))
+        w_count = primitive(count)
+        assert isinstance(w_count, W_VariadicPrimitive)
+        for n in range(4):
+            w_operands = w_list([W_Integer(i) for i in range(n)]) if n else w_nil
+            w_res = self.r.interpret(w_nil, W_List(w_count, w_operands))
+            assert w_res.intval == n
+
+        try:
+            self.r.execute("(car 1 2)")
+        except QuoppaException as e:
+            assert e.msg == "too many arguments to primitive"
+        else:
+            assert False
+
+    def run_both_ways(self, capfd, code):
+        from qoppy import ports
+        from qoppy.parser import parse
+        results = []
+        for native_prelude in [False, True]:
+            runtime = get_runtime(native_prelude)
+            reprs = []
+            for w_exp in parse(code):
+                w_res = runtime.interpret(w_nil, runtime.toplevel_form(w_exp))
+                reprs.append(w_res.to_repr())
+            ports.stdout.flush()
+            out, err = capfd.readouterr()
+            results.append((out, reprs))
+        return results
+
+    def test_native_prelude(self, capfd):
+        import os
+        prelude = open(os.path.join(os.path.dirname(__file__), "prelude.qop")).read()
+        interpreted, native = self.run_both_ways(capfd, prelude + """
+        (define (sq x) (* x x))
+        (display (map sq (list 1 2 3)))
+        (display (map (vau (x) _ x) (list 1 2)))
+        (display (foldr + 0 (list 1 2 3 4)))
+        (display (foldr (vau (x y) _ (list x y)) 0 (list 1 2)))
+        (display (append (list 1 2) (list 3)))
+        (display (let ((a 1) (b 2)) (+ a b)))
+        (display (cond ((eq? 1 2) 5) ((<= 1 2) 6) (else 7)))
+        (display (cond ((eq? 1 2) 5) (else 7)))
+        (display (list (and 1 2) (and 1 #f) (or #f #f) (or #f 3) (and) (or)))
+        (display (assq 'b (list (list 'a 1) (list 'b 2))))
+        (display (list (apply + (list 1 2)) (apply sq (list 5))))
+        (display ((lambda (x) (display x) (+ x 1)) 4))
+        (set! map (lambda (f xs) 42))
+        (display (map sq (list 1 2)))
+        (set! if (vau (b t f) _ 7))
+        (display (if #t 1 2))
+        """)
+        assert interpreted == native
+        assert native[0].startswith("(1 4 9)((car xs) (car xs))10")
+        assert native[0].endswith("4542" "7")
+
+    def test_native_prelude_test_qop(self, capfd):
+        import os
+        code = open(os.path.join(os.path.dirname(__file__), "test.qop")).read()
+        code = code.replace("(fact_tail 2500 1)", "(fact_tail 20 1)")
+        interpreted, native = self.run_both_ways(capfd, code)
+        assert interpreted == native
+        assert "AND THAT WAS" in native[0]
+
+    def test_wrap_unwrap(self):
+        w_res = self.r.execute("((wrap (vau (x) _ x)) (+ 1 2))")
+        assert w_res.to_number() == 3
+        w_res = self.r.execute("((unwrap (wrap (vau (x) _ x))) (+ 1 2))")
+        assert w_res.to_repr() == "(+ 1 2)"
+        w_vau = self.r.execute("vau")
+        assert self.r.execute("(unwrap (wrap vau))") is w_vau
+
+        # the prelude's definition of wrap is swapped for the native one
+        import os
+        runtime = get_runtime()
+        runtime.execute(open(os.path.join(os.path.dirname(__file__), "prelude.qop")).read())
+        assert isinstance(runtime.execute("wrap"), W_Wrap)
+        assert isinstance(runtime.execute("(lambda (x) x)"), W_Applicative)
+
+    def test_bytecode_engine(self, capfd):
+        import os
+        from qoppy.bytecode import W_CodeFrame
+        prelude = open(os.path.join(os.path.dirname(__file__), "prelude.qop")).read()
+        code = prelude + """
+        (define (fib n) (if (<= n 1) n (+ (fib (- n 1)) (fib (- n 2)))))
+        (display (list (fib 10) (map (lambda (x) (* x x)) (list 1 2 3))))
+        (define (shadow x) (define x 5) x)
+        (display (shadow 1))
+        (define body (list + 'x 1))
+        (define f (eval nil (list vau '(x) '_ body)))
+        (display (f 1))
+        (set-car! (cdr (cdr body)) 5)
+        (display (f 1))
+        """
+        outputs = []
+        for bytecode in [False, True]:
+            runtime = get_runtime(False, bytecode)
+            runtime.execute(code)
+            out, err = capfd.readouterr()
+            outputs.append(out)
+        assert outputs[0] == outputs[1] == "(55 (1 4 9))526"
+
+        w_fib = runtime.execute("fib")
+        w_operative = w_fib.w_operative
+        assert isinstance(w_operative.code.disassemble(), str)
+        w_instruction = runtime.engine.body_instruction(w_operative, w_nil, w_nil)
+        assert isinstance(w_instruction, W_CodeFrame)
+        # the code of the reflected on body was thrown away
+        w_f = runtime.execute("f")
+        assert not w_f.code.is_valid()
+        assert runtime.engine.body_instruction(w_f, w_nil, w_nil) is w_f.body_instruction
+
+    def test_tail_calls(self):
+        import os
+        from qoppy.parser import parse
+        prelude = open(os.path.join(os.path.dirname(__file__), "prelude.qop")).read()
+        code = prelude + """
+        (define (count-down n) (if (<= n 0) n (count-down (- n 1))))
+        (define (cond-loop n acc)
+            (cond ((<= n 0) acc)
+                  (else (cond-loop (- n 1) (+ acc 1)))))
+        """
+        for native_prelude, bytecode in [(False, False), (True, True)]:
+            runtime = get_runtime(native_prelude, bytecode)
+            runtime.execute(code)
+            for loop in ["(count-down 200)", "(cond-loop 200 0)"]:
+                machine = MachineState()
+                [w_exp] = parse(loop)
+                w_res = runtime.interpret(w_nil, w_exp, machine)
+                assert w_res.to_number() in (0, 200)
+                # the stacks never grew past a handful of frames
+                assert len(machine.env_stack.items_w) <= 32
+                assert len(machine.operand_stack.items_w) <= 32
+                assert len(machine.stack.items_w) <= 32
+
+    def test_exact_arithmetic(self):
+        import os, sys
+        assert self.r.execute("(+ 1 2)") is self.r.execute("3")
+        assert isinstance(self.r.execute("(* 2 3 4)"), W_Integer)
+        assert self.r.execute("(+)").to_repr() == "0"
+        assert self.r.execute("(- 5)").to_repr() == "-5"
+        assert self.r.execute("(- 10 1 2)").to_repr() == "7"
+        assert self.r.execute("(/ 6 3)").to_repr() == "2"
+        assert self.r.execute("(/ 7 2)").to_repr() == "3.5"
+        assert self.r.execute("(+ 1 0.5)").to_repr() == "1.5"
+        assert self.r.execute("(< 1 2)") is w_true
+        assert self.r.execute("(> 1 2)") is w_false
+        assert self.r.execute("(>= 2 2)") is w_true
+
+        # overflow promotes to a bigint, results that fit become fixnums again
+        w_res = self.r.execute("(+ %d 1)" % sys.maxint)
+        assert isinstance(w_res, W_BigInteger)
+        assert w_res.to_repr() == str(sys.maxint + 1)
+        w_res = self.r.execute("(- (+ %d 1) 1)" % sys.maxint)
+        assert isinstance(w_res, W_Integer) and w_res.intval == sys.maxint
+
+        runtime = get_runtime()
+        runtime.execute(open(os.path.join(os.path.dirname(__file__), "prelude.qop")).read())
+        runtime.execute("(define (fact n) (if (<= n 1) 1 (* n (fact (- n 1)))))")
+        assert runtime.execute("(= (fact 20) 2432902008176640000)") is w_true
+        assert runtime.execute("(fact 25)").to_repr() == "15511210043330985984000000"
+
+    def test_list_library(self):
+        import os
+        runtime = get_runtime()
+        runtime.execute(open(os.path.join(os.path.dirname(__file__), "prelude.qop")).read())
+        runtime.execute("""
+        (define (build n acc) (if (= n 0) acc (build (- n 1) (cons n acc))))
+        (define big (build 100000 ()))
+        """)
+        assert runtime.execute("(length big)").to_repr() == "100000"
+        assert runtime.execute("(list-ref (reverse big) 0)").to_repr() == "100000"
+        assert runtime.execute("(car (memq 99999 big))").to_repr() == "99999"
+        assert runtime.execute("(length (append big big))").to_repr() == "200000"
+        assert runtime.execute("(list-tail (list 1 2 3) 2)").to_repr() == "(3)"
+        assert runtime.execute("(append (list 1) () (list 2) 3)").to_repr() == "(1 2 . 3)"
+        assert runtime.execute("(assq 'b (list (list 'a 1) (list 'b 2)))").to_repr() == "(b 2)"
+        # memq and assq compare with eqv, member and assoc with equal
+        assert runtime.execute("(assq (list 1) (list (list (list 1) 2)))") is w_false
+        assert runtime.execute("(assoc (list 1) (list (list (list 1) 2)))").to_repr() == "((1) 2)"
+        assert runtime.execute("(member (list 2) (list 1 (list 2)))").to_repr() == "((2))"
+
+        runtime.execute("(define a (list 1 2)) (define b (list-copy a))")
+        assert runtime.execute("(append! a (list 3))").to_repr() == "(1 2 3)"
+        assert runtime.execute("a").to_repr() == "(1 2 3)"
+        assert runtime.execute("b").to_repr() == "(1 2)"
+
+        runtime.execute("(set-cdr! (cdr b) b)")
+        for code, msg in [("(length b)", "circular list passed to length"),
+                          ("(reverse (cons 1 2))", "wrong type argument 2 for reverse"),
+                          ("(list-ref (list 1) 1)", "index 1 too large for list-ref")]:
+            try:
+                runtime.execute(code)
+            except QuoppaException as e:
+                assert e.msg == msg
+            else:
+                assert False
+
+    def test_reader(self):
+        import os
+        from qoppy.parser import parse, parse_packrat
+        from qoppy.reader import ReadError
+        sources = ["(1 . 2) '(a ,b ,@c `d) (a (b (c . d)) . e)",
+                   '#\\space #\\( "a\\"b\\\\c\\n" -1.5 .5 1. -7 FooBar nil #t #f',
+                   "123456789012345678901234 ; comment\n(+ - <= a.b)"]
+        for name in ["prelude.qop", "test.qop", "qoppa-scheme.qop"]:
+            sources.append(open(os.path.join(os.path.dirname(__file__), name)).read())
+        for source in sources:
+            assert ([w_obj.to_repr() for w_obj in parse(source)] ==
+                    [w_obj.to_repr() for w_obj in parse_packrat(source)])
+
+        # nesting doesn't use the Python stack
+        w_lst = parse("(" * 100000 + ")" * 100000)[0]
+        for i in range(100000 - 1):
+            w_lst = w_lst.car
+        assert w_lst is w_nil
+
+        for source, line, column in [("(1 . 2 3)", 1, 8), ("(a\n (b", 2, 2),
+                                     ('(a "b\\q")', 1, 6), ("(1.2.3)", 1, 2)]:
+            try:
+                parse(source)
+            except ReadError as e:
+                assert (e.line, e.column) == (line, column)
+            else:
+                assert False
+
+    def test_input_ports(self, tmpdir, monkeypatch):
+        import os
+        from qoppy import ports
+        from qoppy.reader import ReadError
+        # a tiny buffer, so data are split across refills
+        monkeypatch.setattr(ports, "CHUNK_SIZE", 4)
+        data = tmpdir.join("data.qop")
+        data.write('(define (f x) "a \\" string")\n  abc 12345678901234567890 (1 . 2)')
+        runtime = get_runtime()
+        runtime.execute(open(os.path.join(os.path.dirname(__file__), "prelude.qop")).read())
+        runtime.execute('(define p (open-input-file "%s"))' % data)
+        assert runtime.execute("(read p)").to_repr() == '(define (f x) "a \\" string")'
+        assert runtime.execute("(peek-char p)").to_repr() == '"\n"'
+        assert runtime.execute("(read-char p)").to_repr() == '"\n"'
+        assert runtime.execute("(read p)").to_repr() == "abc"
+        assert runtime.execute("(read p)").to_repr() == "12345678901234567890"
+        assert runtime.execute("(read p)").to_repr() == "(1 . 2)"
+        assert runtime.execute("(eof-object? (read p))") is w_true
+        assert runtime.execute("(eof-object? (read-char p))") is w_true
+        runtime.execute("(close-input-port p)")
+        try:
+            runtime.execute("(read p)")
+        except QuoppaException as e:
+            assert e.msg.endswith("is closed")
+        else:
+            assert False
+
+        # parse errors are raised, not returned as a string
+        data.write("(a)\n(b\n  (c")
+        runtime.execute('(define p (open-input-file "%s"))' % data)
+        assert runtime.execute("(read p)").to_repr() == "(a)"
+        try:
+            runtime.execute("(read p)")
+        except ReadError as e:
+            assert (e.line, e.column) == (3, 3)
+        else:
+            assert False
+
+    def test_output_ports(self, capfd, tmpdir):
+        import os
+        from qoppy import ports
+        from qoppy.parser import parse
+        runtime = get_runtime()
+        runtime.execute(open(os.path.join(os.path.dirname(__file__), "prelude.qop")).read())
+        # display only buffers, execute flushes when it is done
+        [w_exp] = parse('(display "buffered")')
+        runtime.interpret(w_nil, w_exp)
+        out, err = capfd.readouterr()
+        assert out == ""
+        ports.stdout.flush()
+        out, err = capfd.readouterr()
+        assert out == "buffered"
+
+        runtime.execute("""
+        (define s (open-output-string))
+        (write "a\\"b" s)
+        (display 12 s)
+        (newline s)
+        (display (get-output-string s))
+        (write 'sym (current-output-port))
+        """)
+        out, err = capfd.readouterr()
+        assert out == '"a\\"b"12\nsym'
+
+        out_file = tmpdir.join("out.txt")
+        runtime.execute("""
+        (define f (open-output-file "%s"))
+        (write (list 1 "x" 'y) f)
+        (close-output-port f)
+        """ % out_file)
+        assert out_file.read() == '(1 "x" y)'
+        try:
+            runtime.execute("(display 1 f)")
+        except QuoppaException as e:
+            assert e.msg.endswith("is closed")
+        else:
+            assert False
+
+    def test_heap_image(self, capfd):
+        import os
+        from qoppy.image import save_image, load_image
+        runtime = get_runtime(True)
+        runtime.execute(open(os.path.join(os.path.dirname(__file__), "prelude.qop")).read())
+        runtime.execute("""
+        (define shared (list 1 2.5 "s" 123456789012345678901234567))
+        (define both (cons shared shared))
+        (define cyc (list 1 2))
+        (set-cdr! (cdr cyc) cyc)
+        (define (counter n) (lambda () (set! n (+ n 1)) n))
+        (define next (counter 10))
+        (next)
+        """)
+        data = save_image(runtime)
+
+        loaded = get_runtime(True)
+        load_image(loaded, data)
+        loaded.execute("""
+        (display (list (next) (next) (map (lambda (x) (* x x)) (list 1 2 3))))
+        (display (car both))
+        (set-car! (car both) 5)
+        (display (cdr both))
+        (display (list (car cyc) (car (cdr (cdr cyc)))))
+        """)
+        out, err = capfd.readouterr()
+        assert out == ('(12 13 (1 4 9))(1 2.5 s 123456789012345678901234567)'
+                       '(5 2.5 s 123456789012345678901234567)(1 1)')
+
+        # the natives of native prelude mode are not in a plain runtime
+        try:
+            load_image(get_runtime(), data)
+        except QuoppaException as e:
+            assert e.msg.endswith("which this runtime lacks")
+        else:
+            assert False
+
+    def test_parse_cache(self, tmpdir):
+        from qoppy.parse_cache import ParseCache
+        from qoppy.parser import parse
+        source = "(define (f x) (g 'x -300 123456789012345678901234 2.5 \"s\" #t nil (a . b)))"
+        source_file = tmpdir.join("code.qop")
+        source_file.write(source)
+        cache = ParseCache()
+        expected = [w_obj.to_repr() for w_obj in parse(source)]
+        for i in range(2):
+            forms_w = cache.parse_file(str(source_file), source)
+            assert [w_obj.to_repr() for w_obj in forms_w] == expected
+        assert (cache.stats.hits, cache.stats.misses) == (1, 1)
+        assert tmpdir.join("code.qopc").check()
+
+        # an edited source or a damaged cache file is parsed again
+        cache.parse_file(str(source_file), source + " 1")
+        assert (cache.stats.hits, cache.stats.misses) == (1, 2)
+        cache_file = tmpdir.join("code.qopc")
+        cache_file.write_binary(cache_file.read_binary()[:-3])
+        cache.parse_file(str(source_file), source + " 1")
+        assert (cache.stats.hits, cache.stats.misses) == (1, 3)
+
+        cache_dir = tmpdir.mkdir("cache")
+        cache = ParseCache(str(cache_dir))
+        cache.parse_file(str(source_file), source)
+        assert cache_dir.join("code.qopc").check()
+        assert cache.stats.to_string() == "parse cache: 0 hits, 1 misses, 0 failed writes"
+
+    def test_profiler(self):
+        import os
+        from qoppy.profiler import SourceMap, Profiler, SamplingProfiler
+        prelude = open(os.path.join(os.path.dirname(__file__), "prelude.qop")).read()
+        code = prelude + """
+(define (count-down n) (if (<= n 0) n (count-down (- n 1))))
+(define (fact n)
+    (if (<= n 1) 1 (* n (fact (- n 1)))))
+(count-down 50)
+(fact 10)
+"""
+        line = prelude.count("\n") + 2
+        runtime = get_runtime()
+        source_map = SourceMap()
+        runtime.profiler = Profiler(source_map)
+        runtime.execute_forms(source_map.read("code.qop", code))
+        stats = {}
+        for w_body, fexpr_stats in runtime.profiler.stats.items():
+            stats[source_map.label(w_body)] = fexpr_stats
+        count_down = stats["count-down@code.qop:%d" % line]
+        fact = stats["fact@code.qop:%d" % (line + 1)]
+        assert (count_down.calls, fact.calls) == (51, 10)
+        # recursive calls count once towards the steps of the outermost one
+        assert 0 < fact.self_steps < fact.steps < runtime.steps
+
+        # tail calls don't nest, non tail calls do
+        stacks = runtime.profiler.collapsed_stacks()
+        assert "count-down@code.qop:%d;count-down" % line not in stacks
+        assert ("fact@code.qop:%d;if@code.qop:12;fact" % (line + 1)) in stacks
+        for stack in stacks.splitlines():
+            assert int(stack.rsplit(" ", 1)[1]) > 0
+        report = runtime.profiler.report(3).splitlines()
+        assert len(report) == 4
+        assert report[1].endswith("if@code.qop:12")
+
+        runtime = get_runtime()
+        source_map = SourceMap()
+        runtime.profiler = SamplingProfiler(source_map, 10)
+        runtime.execute_forms(source_map.read("code.qop", code))
+        samples = 0
+        for stack in runtime.profiler.collapsed_stacks().splitlines():
+            samples += int(stack.rsplit(" ", 1)[1])
+        assert samples == runtime.steps / 10 * 10
+        assert "fact@code.qop:%d;fact" % (line + 1) in runtime.profiler.collapsed_stacks()
+
+    def test_interpreter_stats(self):
+        import json
+        from qoppy.execution_model import list_allocations
+        from qoppy.stats import InterpreterStats
+        runtime = get_runtime()
+        runtime.stats = InterpreterStats()
+        try:
+            runtime.execute("""
+            ((vau (a) e
+                ((vau (b) e2
+                    (cons (car (cons a b)) (eval e2 b)))
+                 a))
+             1)
+            """)
+            stats = json.loads(runtime.stats.to_json(runtime))
+        finally:
+            list_allocations.counting = False
+        assert stats["steps"] == runtime.steps
+        assert stats["dispatches"]["W_Fexpr"] == 2
+        assert stats["dispatches"]["W_PrimitiveCall2"] == 2
+        assert stats["primitive_calls"] == {"cons": 2, "car": 1, "eval": 1}
+        assert stats["list_allocations"] > 0
+        # a and b are found one and two envs up from the inner body
+        assert sum(stats["lookup_depth"]) > 0
+        assert stats["lookup_depth"][1] >= 1
+        assert stats["max_stack_depth"]["env_stack"] == 3
+        assert sum(stats["dispatches"].values()) == runtime.steps
+
+    def test_compact_objects(self):
+        from qoppy.primitives import cons
+        w_sym = symbol("x")
+        w_fexpr = W_Fexpr(w_nil, w_nil, w_nil, w_nil)
+        for w_obj in [W_List(w_nil, w_nil), W_Binding(w_sym, w_nil),
+                      W_Frame(w_nil, w_nil), W_CallEnv(w_nil, w_nil, w_fexpr),
+                      w_fexpr, w_integer(5000), W_Real(0.5), W_String("s"),
+                      w_sym, W_Call(w_nil), W_Literal(w_nil)]:
+            assert not hasattr(w_obj, "__dict__"), w_obj
+        assert W_Integer.__slots__ == ["intval"]
+        assert W_Real.__slots__ == ["realval"]
+
+        # a frame built by define hands its index on to the one extending it
+        w_env = self.r.global_env
+        w_frame = w_env.car
+        w_frame.find(w_sym)
+        index = w_frame.index
+        w_extended = cons(cons(w_sym, cons(w_true, w_nil)), w_frame)
+        assert w_frame.index is None and w_extended.index is index
+        assert w_extended.find(w_sym).cdr.car is w_true
+        assert w_frame.find(w_sym) is None
+
+    def test_vectors(self, tmpdir):
+        import os
+        from qoppy.parser import parse, parse_packrat
+        from qoppy.parse_cache import ParseCache
+        from qoppy.image import save_image, load_image
+        runtime = get_runtime()
+        runtime.execute(open(os.path.join(os.path.dirname(__file__), "prelude.qop")).read())
+        source = '#(1 "s" (a . #(b)) #()) (x #(y) . z)'
+        assert ([w_obj.to_repr() for w_obj in parse(source)] ==
+                [w_obj.to_repr() for w_obj in parse_packrat(source)] ==
+                ['#(1 "s" (a . #(b)) #())', "(x #(y) . z)"])
+        assert runtime.execute("(vector? '#(1))") is w_true
+        assert runtime.execute("(vector? '(1))") is w_false
+
+        runtime.execute("(define v (make-vector 3 0)) (vector-set! v 1 'a)")
+        assert runtime.execute("v").to_repr() == "#(0 a 0)"
+        assert runtime.execute("(vector-ref v 1)").to_repr() == "a"
+        assert runtime.execute("(vector-length (make-vector 100000))").to_repr() == "100000"
+        assert runtime.execute("(vector 1 (+ 1 1))").to_repr() == "#(1 2)"
+        assert runtime.execute("(vector->list (vector-copy v 1))").to_repr() == "(a 0)"
+        assert runtime.execute("(vector-copy v 1 2)").to_repr() == "#(a)"
+        assert runtime.execute("(list->vector (list 1 2))").to_repr() == "#(1 2)"
+        runtime.execute("(vector-fill! v 7)")
+        assert runtime.execute("v").to_repr() == "#(7 7 7)"
+        assert runtime.execute("(eq? (vector 1 (list 2)) '#(1 (2)))") is w_true
+        assert runtime.execute("(eq? (vector 1) '#(1 2))") is w_false
+        for code, msg in [("(vector-ref v 3)", "index 3 too large for vector-ref"),
+                          ("(vector-set! v -1 0)", "wrong type argument -1 for vector-set!"),
+                          ("(vector-length '(1))", "wrong type argument (1) for vector-length"),
+                          ("(vector-copy v 2 1)", "range 2 to 1 out of bounds for vector-copy"),
+                          ("(list->vector (cons 1 2))", "wrong type argument 2 for list->vector")]:
+            try:
+                runtime.execute(code)
+            except QuoppaException as e:
+                assert e.msg == msg
+            else:
+                assert False
+
+        # printing and comparing deep nesting doesn't use the Python stack
+        w_a = parse("#(" * 10000 + "(1 . 2)" + ")" * 10000)[0]
+        w_b = parse("#(" * 10000 + "(1 . 2)" + ")" * 10000)[0]
+        assert w_a.to_repr() == "#(" * 10000 + "(1 . 2)" + ")" * 10000
+        assert w_a.equal(w_b)
+
+        source_file = tmpdir.join("code.qop")
+        source_file.write(source)
+        cache = ParseCache()
+        for i in range(2):
+            forms_w = cache.parse_file(str(source_file), source)
+            assert [w_obj.to_repr() for w_obj in forms_w] == [w_obj.to_repr() for w_obj in parse(source)]
+        assert cache.stats.hits == 1
+
+        runtime.execute("(define shared (list 1)) (define w (vector shared shared))")
+        loaded = get_runtime()
+        load_image(loaded, save_image(runtime))
+        loaded.execute("(set-car! (vector-ref w 0) 2)")
+        assert loaded.execute("w").to_repr() == "#((2) (2))"
+
+    def test_hashtables(self):
+        import os
+        from qoppy.parser import parse
+        runtime = get_runtime()
+        runtime.execute(open(os.path.join(os.path.dirname(__file__), "prelude.qop")).read())
+        runtime.execute("""
+        (define eq-table (make-eq-hashtable))
+        (define equal-table (make-equal-hashtable))
+        (define (fill n)
+            (if (= n 0)
+                0
+                (begin
+                    (hashtable-set! eq-table (* n 10000) n)
+                    (hashtable-set! equal-table (list "key" n (vector n)) n)
+                    (fill (- n 1)))))
+        (fill 2000)
+        """)
+        assert runtime.execute("(hashtable-count eq-table)").to_repr() == "2000"
+        # eq hashtables compare numbers by value, equal ones compare structure
+        assert runtime.execute("(hashtable-ref eq-table 15000000 #f)").to_repr() == "1500"
+        assert runtime.execute("(hashtable-ref eq-table (list 1) 'none)").to_repr() == "none"
+        assert runtime.execute("(hashtable-ref equal-table (list \"key\" 7 (vector 7)) #f)").to_repr() == "7"
+        runtime.execute("(define k (list 1)) (hashtable-set! eq-table k 'k)")
+        assert runtime.execute("(hashtable-ref eq-table k #f)").to_repr() == "k"
+        assert runtime.execute("(hashtable-ref eq-table (list 1) #f)") is w_false
+        runtime.execute("(hashtable-delete! equal-table (list \"key\" 7 (vector 7)))")
+        runtime.execute("(hashtable-delete! equal-table 'missing)")
+        assert runtime.execute("(hashtable-count equal-table)").to_repr() == "1999"
+        runtime.execute("(define t (make-equal-hashtable)) (hashtable-set! t \"a\" 1)")
+        assert runtime.execute("(hashtable-keys t)").to_repr() == '#("a")'
+        try:
+            runtime.execute("(hashtable-ref (list 1) 1 #f)")
+        except QuoppaException as e:
+            assert e.msg == "wrong type argument (1) for hashtable-ref"
+        else:
+            assert False
+
+        # objects that are equal hash the same, only a bounded prefix of
+        # long or circular structure is looked at
+        for source in ['(1 #(2 "x" 123456789012345678901) . 2.5)', "(a (b (c)))"]:
+            w_a, w_b = parse(source + " " + source)
+            assert w_a.equal(w_b) and w_a.hash_equal() == w_b.hash_equal()
+        w_cycle = parse("(1 2)")[0]
+        w_cycle.cdr.cdr = w_cycle
+        assert w_cycle.hash_equal() == w_cycle.hash_equal()
+        assert w_integer(5000).hash_eqv() == w_integer(5000).hash_eqv()
+
+    def test_strings(self):
+        import os
+        runtime = get_runtime()
+        runtime.execute(open(os.path.join(os.path.dirname(__file__), "prelude.qop")).read())
+        runtime.execute('(define s "alpha,beta,,gamma")')
+        # substrings share the storage of the string they are taken from
+        w_str = runtime.execute("s")
+        w_sub = runtime.execute("(substring (substring s 6) 0 4)")
+        assert isinstance(w_sub, W_Substring) and w_sub.strval is w_str.strval
+        assert w_sub.to_repr() == '"beta"'
+        assert runtime.execute("(string-length (substring s 6 10))").to_repr() == "4"
+        assert runtime.execute("(string-ref (substring s 6) 1)").to_repr() == '"e"'
+        assert runtime.execute("(string-index s #\\,)").to_repr() == "5"
+        assert runtime.execute("(string-index (substring s 6) #\\, 5)").to_repr() == "5"
+        assert runtime.execute("(string-index s #\\z)") is w_false
+        assert (runtime.execute("(string-split s #\\,)").to_repr() ==
+                '("alpha" "beta" "" "gamma")')
+        assert runtime.execute('(eq? (substring s 0 5) "alpha")') is w_true
+        assert runtime.execute('(eq? (string->symbol (substring s 0 5)) \'alpha)') is w_true
+        assert runtime.execute('(+ (string->number "-12") (string->number "0.5"))').to_repr() == "-11.5"
+        assert runtime.execute('(string->number "1x")') is w_false
+        assert runtime.execute('(string->number "")') is w_false
+        runtime.execute('(define t (make-equal-hashtable)) (hashtable-set! t "beta" 1)')
+        assert runtime.execute("(hashtable-ref t (substring s 6 10) #f)").to_repr() == "1"
+
+        runtime.execute("""
+        (define b (string-builder))
+        (define (fill n)
+            (if (= n 0)
+                0
+                (begin (string-builder-append! b "ab") (fill (- n 1)))))
+        (fill 1000)
+        (string-builder-append! b (substring s 0 1))
+        """)
+        assert runtime.execute("(string-builder-length b)").to_repr() == "2001"
+        assert runtime.execute("(string-builder->string b)").to_string() == "ab" * 1000 + "a"
+        runtime.execute('(string-builder-append! b "!")')
+        assert runtime.execute("(string-length (string-builder->string b))").to_repr() == "2002"
+
+        for code, msg in [("(substring s 3 2)", "range 3 to 2 out of bounds for substring"),
+                          ("(string-ref (substring s 0 2) 2)", "index 2 too large for string-ref"),
+                          ('(string-split s ",,")', 'wrong type argument ,, for string-split'),
+                          ("(string-length 'a)", "wrong type argument a for string-length")]:
+            try:
+                runtime.execute(code)
+            except QuoppaException as e:
+                assert e.msg == msg
+            else:
+                assert False